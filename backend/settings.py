@@ -18,11 +18,104 @@ load_dotenv()  # Load environment variables
 
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_REPO = os.getenv("GITHUB_REPO")
+GITHUB_BRANCH = os.getenv("GITHUB_BRANCH")  # Defaults to the repository's default branch
+
+# Shared GitHub client (one per worker process)
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+GITHUB_TIMEOUT = int(os.getenv("GITHUB_TIMEOUT", "15"))  # Seconds per HTTP request
+GITHUB_POOL_SIZE = int(os.getenv("GITHUB_POOL_SIZE", "20"))  # Keep-alive connections in the pool
+GITHUB_SECONDS_BETWEEN_REQUESTS = float(os.getenv("GITHUB_SECONDS_BETWEEN_REQUESTS", "0"))
+GITHUB_SECONDS_BETWEEN_WRITES = float(os.getenv("GITHUB_SECONDS_BETWEEN_WRITES", "0"))
+# Reads answered with a server error are retried this many times, waiting
+# GITHUB_RETRY_BACKOFF * 2**attempt seconds in between; writes never are
+GITHUB_RETRIES = int(os.getenv("GITHUB_RETRIES", "3"))
+GITHUB_RETRY_BACKOFF = float(os.getenv("GITHUB_RETRY_BACKOFF", "0.5"))
+
+# The contents API only carries files up to about 1 MB. Larger files are
+# written as git blobs and read from the blobs API, or downloaded raw into a
+# temporary file from GITHUB_RAW_DOWNLOAD_MIN_BYTES on
+GITHUB_CONTENTS_MAX_BYTES = int(os.getenv("GITHUB_CONTENTS_MAX_BYTES", str(1024 * 1024)))
+GITHUB_RAW_DOWNLOAD_MIN_BYTES = int(os.getenv("GITHUB_RAW_DOWNLOAD_MIN_BYTES", str(16 * 1024 * 1024)))
+
+# Rate-limit governor for GitHub calls: a token bucket refilled at this rate
+# (0: no pacing) up to the burst size; below GITHUB_RATE_RESERVE remaining
+# requests only interactive reads go on. A call that would wait longer than
+# GITHUB_RATE_MAX_WAIT seconds (GITHUB_RATE_BULK_MAX_WAIT for imports and
+# index builds) is answered with a 429. Rate limit answers are retried this
+# many times, backing off GITHUB_RATE_BACKOFF * 2**attempt seconds plus jitter
+GITHUB_RATE_PER_SECOND = float(os.getenv("GITHUB_RATE_PER_SECOND", "10"))
+GITHUB_RATE_BURST = int(os.getenv("GITHUB_RATE_BURST", "100"))
+GITHUB_RATE_RESERVE = int(os.getenv("GITHUB_RATE_RESERVE", "200"))
+GITHUB_RATE_MAX_WAIT = float(os.getenv("GITHUB_RATE_MAX_WAIT", "10"))
+GITHUB_RATE_BULK_MAX_WAIT = float(os.getenv("GITHUB_RATE_BULK_MAX_WAIT", "300"))
+GITHUB_RATE_RETRIES = int(os.getenv("GITHUB_RATE_RETRIES", "3"))
+GITHUB_RATE_BACKOFF = float(os.getenv("GITHUB_RATE_BACKOFF", "1"))
+
+# Cache of decoded file contents (0 disables it)
+STORAGE_CACHE_MAX_BYTES = int(os.getenv("STORAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+STORAGE_CACHE_TTL = float(os.getenv("STORAGE_CACHE_TTL", "0"))  # Seconds an entry is trusted without revalidation
+STORAGE_CATALOG_TTL = float(os.getenv("STORAGE_CATALOG_TTL", "30"))  # Seconds before the database list is reloaded
+
+# Cache of the blobs and trees read at a fixed commit by the history views,
+# which never need revalidating (0 disables it)
+STORAGE_OBJECT_CACHE_MAX_BYTES = int(os.getenv("STORAGE_OBJECT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Group commit for inserts: buffer rows per table for up to this many seconds
+# (0 disables it) or until this many rows are waiting, then write them at once
+TABLE_GROUP_COMMIT_WINDOW = float(os.getenv("TABLE_GROUP_COMMIT_WINDOW", "0"))
+TABLE_GROUP_COMMIT_MAX_ROWS = int(os.getenv("TABLE_GROUP_COMMIT_MAX_ROWS", "500"))
+
+# Table writes that lose a race are re-read and re-applied this many times,
+# sleeping a random time up to TABLE_WRITE_RETRY_BACKOFF * 2**attempt seconds
+TABLE_WRITE_RETRIES = int(os.getenv("TABLE_WRITE_RETRIES", "5"))
+TABLE_WRITE_RETRY_BACKOFF = float(os.getenv("TABLE_WRITE_RETRY_BACKOFF", "0.05"))
+
+# Table rows are stored in segments of about this many bytes; a write only
+# rewrites the segments it touches (well below the 1 MB contents API limit)
+TABLE_SEGMENT_MAX_BYTES = int(os.getenv("TABLE_SEGMENT_MAX_BYTES", str(256 * 1024)))
+
+# Row format of new tables: "ndjson" (one compact JSON object per line) or
+# "json" (an indented array); a table can pick another one when created
+TABLE_ROW_FORMAT = os.getenv("TABLE_ROW_FORMAT", "ndjson")
+
+# Files the primary key index of a table is split into (0: no index)
+TABLE_INDEX_SHARDS = int(os.getenv("TABLE_INDEX_SHARDS", "16"))
+
+# Streamed table reads are sent in chunks of about this many bytes
+TABLE_STREAM_CHUNK_BYTES = int(os.getenv("TABLE_STREAM_CHUNK_BYTES", str(64 * 1024)))
+
+# Exports read this many files ahead, concurrently
+STORAGE_EXPORT_WORKERS = int(os.getenv("STORAGE_EXPORT_WORKERS", "4"))
+
+# Bulk imports write about this many bytes of rows per commit
+TABLE_IMPORT_CHUNK_BYTES = int(os.getenv("TABLE_IMPORT_CHUNK_BYTES", str(4 * 1024 * 1024)))
+# Write-ahead log of row writes (empty: off): inserts, updates and deletes are
+# answered once fsynced to this SQLite file and shipped to storage in the
+# background, up to TABLE_WAL_BATCH_MAX writes per table and commit, at most
+# every TABLE_WAL_SHIP_INTERVAL seconds. A write that failed to ship
+# TABLE_WAL_MAX_ATTEMPTS times is given up and marked failed
+TABLE_WAL_PATH = os.getenv("TABLE_WAL_PATH", "")
+TABLE_WAL_BATCH_MAX = int(os.getenv("TABLE_WAL_BATCH_MAX", "500"))
+TABLE_WAL_SHIP_INTERVAL = float(os.getenv("TABLE_WAL_SHIP_INTERVAL", "0.5"))
+TABLE_WAL_MAX_ATTEMPTS = int(os.getenv("TABLE_WAL_MAX_ATTEMPTS", "10"))
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Storage engine for databases and tables: "github", "local" (a plain
+# directory) or "git" (a local bare git repository)
+STORAGE_ENGINE = os.getenv("STORAGE_ENGINE", "github")
+STORAGE_LOCAL_PATH = os.getenv("STORAGE_LOCAL_PATH", str(BASE_DIR / "storage"))
+# Local clone of the data repository serving the read-only endpoints (empty:
+# off), fetched from STORAGE_REPLICA_URL (default: the repository written to)
+# every STORAGE_REPLICA_SYNC_INTERVAL seconds (0: only on demand). Row
+# segments from STORAGE_REPLICA_MMAP_MIN_BYTES on are memory-mapped
+STORAGE_REPLICA_PATH = os.getenv("STORAGE_REPLICA_PATH", "")
+STORAGE_REPLICA_URL = os.getenv("STORAGE_REPLICA_URL", "")
+STORAGE_REPLICA_SYNC_INTERVAL = float(os.getenv("STORAGE_REPLICA_SYNC_INTERVAL", "30"))
+STORAGE_REPLICA_MMAP_MIN_BYTES = int(os.getenv("STORAGE_REPLICA_MMAP_MIN_BYTES", str(1024 * 1024)))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
@@ -55,6 +148,8 @@ INSTALLED_APPS = [
     'database',
     'table',
     'tableData',
+    'tableStorage',
+    'commits',
     #  'allauth',
     # 'allauth.account',
     # 'allauth.socialaccount',
@@ -63,6 +158,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'tableStorage.metrics.StorageMetricsMiddleware',  # First, so it times the whole request
+    'tableStorage.replica.ReplicaMiddleware',  # Staleness of reads served from the local clone
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
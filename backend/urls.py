@@ -3,6 +3,7 @@ from django.urls import path, include
 from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
+from tableStorage.views import metrics
 
 schema_view = get_schema_view(
    openapi.Info(
@@ -23,5 +24,8 @@ urlpatterns = [
     path('database/', include("database.urls")),
     path('table/',include("table.urls")),
     path('table/', include("tableData.urls")),
+    path('storage/', include("tableStorage.urls")),
+    path('commits/', include("commits.urls")),  # Reads of earlier versions of the data
+    path('metrics', metrics, name="metrics"),  # Prometheus scrape target
    #  path('auth/', include('allauth.urls')),  # Include Allauth authentication URLs
 ]
@@ -1,3 +1,17 @@
-from django.test import TestCase
+import tempfile
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+
+
+class SnapshotViewTests(SimpleTestCase):
+    def setUp(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(STORAGE_ENGINE="git", STORAGE_LOCAL_PATH=f"{root}/data.git"))
+        self.client.post("/database/folders/", {"database_name": "shop"}, content_type="application/json")
+
+    def test_listings_of_a_missing_commit_are_not_found(self):
+        self.assertEqual(self.client.get("/commits/tables/").json()["databases"], ["shop"])
+        for database_name in ("", "shop"):
+            response = self.client.get("/commits/tables/", {"commit": "0" * 40, "database_name": database_name})
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.json(), {"error": "Commit not found"})
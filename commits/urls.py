@@ -1,8 +1,9 @@
 from django.urls import path
-from .views import GitHubStorage
+from .views import SchemaSnapshot, TableHistory, TableSnapshot, TablesSnapshot
 
 urlpatterns = [
-    path('storage/', GitHubStorage.as_view(), name='store-data'),
-    path('storage/<str:file_name>/', GitHubStorage.as_view(), name='get-data'),
-    path('storage/delete/', GitHubStorage.as_view(), name='delete-data'),  # DELETE route
+    path("history/", TableHistory.as_view(), name="table-history"),
+    path("table-data/", TableSnapshot.as_view(), name="table-data-snapshot"),
+    path("schema/", SchemaSnapshot.as_view(), name="schema-snapshot"),
+    path("tables/", TablesSnapshot.as_view(), name="tables-snapshot"),
 ]
@@ -1,170 +1,141 @@
+import abc
 import json
-import os
-import uuid
-from github import Github
+
 from rest_framework.response import Response
 from rest_framework import status, views
-from dotenv import load_dotenv
-
-load_dotenv()
-
-class GitHubStorage(views.APIView):
-
-    def post(self, request, *args, **kwargs):
-        """Store JSON data in a GitHub repository, allowing multiple objects"""
-        file_name = request.data.get("file_name")
-        new_data = request.data.get("data")
-
-        if not file_name or not new_data:
-            return Response({"error": "File name and data are required"}, status=status.HTTP_400_BAD_REQUEST)
-
-        github_token = os.getenv("GITHUB_TOKEN")
-        repo_name = os.getenv("GITHUB_REPO")
-
-        try:
-            g = Github(github_token)
-            repo = g.get_repo(repo_name)
-            file_path = f"{file_name}.json"
-
-            try:
-                file = repo.get_contents(file_path)
-                existing_data = json.loads(file.decoded_content.decode("utf-8"))
+from tableStorage.engines import NotFound, get_storage_engine
+from tableStorage.governor import RateLimited, rate_limited_response
+from tableStorage.history import HistoryError, snapshot_engine, table_history
+from tableStorage.query import Query, QueryError
+from tableStorage.tables import Table, schema_path, table_path
 
-                if not isinstance(existing_data, list):
-                    existing_data = [existing_data]  # Convert to list if necessary
+# A version named by its full SHA never changes, so neither does the answer
+IMMUTABLE = "public, max-age=31536000, immutable"
 
-            except:
-                existing_data = []
 
-            # Ensure `new_data` is a list
-            if not isinstance(new_data, list):
-                new_data = [new_data]
+def _param(request, name):
+    return request.query_params.get(name) or request.data.get(name)
 
-            # Assign unique IDs to each object
-            for obj in new_data:
-                obj["id"] = str(uuid.uuid4())  # Generate a unique ID
 
-            updated_data = existing_data + new_data
-            updated_content = json.dumps(updated_data, indent=4)
+def _snapshot_response(request, commit, data):
+    response = Response({"commit": commit, **data}, status=status.HTTP_200_OK)
+    if _param(request, "commit") == commit and _param(request, "at") is None:
+        response["Cache-Control"] = IMMUTABLE
+    return response
 
-            if 'file' in locals():
-                repo.update_file(file_path, "Added new data", updated_content, file.sha)
-            else:
-                repo.create_file(file_path, "Created new file with data", updated_content)
 
-            return Response({"message": "Data stored successfully!"}, status=status.HTTP_201_CREATED)
+class Snapshot(views.APIView, metaclass=abc.ABCMeta):
+    """Base of the reads of one version of the data, named by "commit" and/or "at" (see tableStorage.history)."""
 
-        except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     def get(self, request, *args, **kwargs):
-        """Retrieve all JSON data or a specific object by ID"""
-        file_name = request.query_params.get("file_name")
-        obj_id = request.query_params.get("id")  # Get ID if provided
-
-        if not file_name:
-            return Response({"error": "File name is required"}, status=status.HTTP_400_BAD_REQUEST)
-
-        github_token = os.getenv("GITHUB_TOKEN")
-        repo_name = os.getenv("GITHUB_REPO")
-
         try:
-            g = Github(github_token)
-            repo = g.get_repo(repo_name)
-            file_path = f"{file_name}.json"
-
             try:
-                file = repo.get_contents(file_path)
-                existing_data = json.loads(file.decoded_content.decode("utf-8"))
-
-                if obj_id:
-                    filtered_data = next((obj for obj in existing_data if obj.get("id") == obj_id), None)
-                    if not filtered_data:
-                        return Response({"error": "Object not found"}, status=status.HTTP_404_NOT_FOUND)
-                    return Response(filtered_data, status=status.HTTP_200_OK)
-
-                return Response(existing_data, status=status.HTTP_200_OK)
-
-            except:
-                return Response({"error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+                engine, commit = snapshot_engine(_param(request, "commit"), _param(request, "at"))
+            except HistoryError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            except NotFound:
+                return Response({"error": "Commit not found"}, status=status.HTTP_404_NOT_FOUND)
+            try:
+                return self.read(request, engine, commit)
+            except NotFound:
+                # A full SHA is taken as it is, without asking if it exists
+                return Response({"error": "Commit not found"}, status=status.HTTP_404_NOT_FOUND)
 
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    def delete(self, request, *args, **kwargs):
-        """Delete an object from the JSON file by ID"""
-        file_name = request.data.get("file_name")
-        obj_id = request.data.get("id")
 
-        if not file_name or not obj_id:
-            return Response({"error": "File name and object ID are required"}, status=status.HTTP_400_BAD_REQUEST)
+    @abc.abstractmethod
+    def read(self, request, engine, commit):
+        """Return the response to `request`, read from `engine` serving the version `commit`."""
 
-        github_token = os.getenv("GITHUB_TOKEN")
-        repo_name = os.getenv("GITHUB_REPO")
 
-        try:
-            g = Github(github_token)
-            repo = g.get_repo(repo_name)
-            file_path = f"{file_name}.json"
+class TableSnapshot(Snapshot):
 
-            try:
-                file = repo.get_contents(file_path)
-                existing_data = json.loads(file.decoded_content.decode("utf-8"))
+    def get(self, request, *args, **kwargs):
+        """Retrieve the rows of a table, or one by ID, as they were at a commit or a time"""
+        if not _param(request, "database_name") or not _param(request, "table_name"):
+            return Response({"error": "Database name and table name are required"}, status=status.HTTP_400_BAD_REQUEST)
+        return super().get(request, *args, **kwargs)
 
-                if not isinstance(existing_data, list):
-                    existing_data = [existing_data]
+    def read(self, request, engine, commit):
+        # Optional "filter", "fields", "sort" and "limit", see tableStorage.query
+        try:
+            query = Query.from_request(request.data)
+        except QueryError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-                updated_data = [obj for obj in existing_data if obj.get("id") != obj_id]
+        try:
+            table = Table.load(engine, table_path(_param(request, "database_name"), _param(request, "table_name")))
+        except NotFound:
+            return Response({"error": "Table not found at this version"}, status=status.HTTP_404_NOT_FOUND)
 
-                if len(updated_data) == len(existing_data):
-                    return Response({"error": "Object not found"}, status=status.HTTP_404_NOT_FOUND)
+        object_id = _param(request, "id")
+        if object_id:
+            row = table.find(object_id)
+            if row is None:
+                return Response({"error": "Object not found"}, status=status.HTTP_404_NOT_FOUND)
+            return _snapshot_response(request, commit, {"row": query.project(row)})
+        return _snapshot_response(request, commit, {"rows": query.run(table)})
 
-                updated_content = json.dumps(updated_data, indent=4)
-                repo.update_file(file_path, "Deleted an object from the JSON file", updated_content, file.sha)
 
-                return Response({"message": "Object deleted successfully!"}, status=status.HTTP_200_OK)
+class SchemaSnapshot(Snapshot):
 
-            except:
-                return Response({"error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+    def get(self, request, *args, **kwargs):
+        """Retrieve the schema of a table as it was at a commit or a time"""
+        if not _param(request, "database_name") or not _param(request, "table_name"):
+            return Response({"error": "Database name and table name are required"}, status=status.HTTP_400_BAD_REQUEST)
+        return super().get(request, *args, **kwargs)
 
-        except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    def put(self, request, *args, **kwargs):
-        """Update a specific object by ID in the JSON file"""
-        file_name = request.data.get("file_name")
-        obj_id = request.data.get("id")
-        update_data = request.data.get("data")
+    def read(self, request, engine, commit):
+        try:
+            schema_file = engine.read(schema_path(_param(request, "database_name"), _param(request, "table_name")))
+        except NotFound:
+            return Response({"error": "Table schema not found at this version"}, status=status.HTTP_404_NOT_FOUND)
+        return _snapshot_response(request, commit, {"schema": json.loads(schema_file.decoded_content.decode("utf-8"))})
 
-        if not file_name or not obj_id or not update_data:
-            return Response({"error": "File name, object ID, and update data are required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        github_token = os.getenv("GITHUB_TOKEN")
-        repo_name = os.getenv("GITHUB_REPO")
+class TablesSnapshot(Snapshot):
 
-        try:
-            g = Github(github_token)
-            repo = g.get_repo(repo_name)
-            file_path = f"{file_name}.json"
+    def get(self, request, *args, **kwargs):
+        """List the tables of a database, or the databases, as they were at a commit or a time"""
+        return super().get(request, *args, **kwargs)
 
-            try:
-                file = repo.get_contents(file_path)
-                existing_data = json.loads(file.decoded_content.decode("utf-8"))
+    def read(self, request, engine, commit):
+        database_name = _param(request, "database_name")
+        if not database_name:
+            return _snapshot_response(request, commit, {"databases": engine.list_databases()})
+        if not engine.database_exists(database_name):
+            return Response({"error": "Database not found at this version"}, status=status.HTTP_404_NOT_FOUND)
+        return _snapshot_response(request, commit, {"tables": engine.list_tables(database_name)})
 
-                if not isinstance(existing_data, list):
-                    existing_data = [existing_data]
 
-                for obj in existing_data:
-                    if obj.get("id") == obj_id:
-                        obj.update(update_data)  # Update only the provided fields
-                        break
-                else:
-                    return Response({"error": "Object not found"}, status=status.HTTP_404_NOT_FOUND)
+class TableHistory(views.APIView):
 
-                updated_content = json.dumps(existing_data, indent=4)
-                repo.update_file(file_path, "Updated an object in the JSON file", updated_content, file.sha)
+    def get(self, request, *args, **kwargs):
+        """List the commits that changed the rows or the schema of a table, newest first"""
+        database_name = _param(request, "database_name")
+        table_name = _param(request, "table_name")
 
-                return Response({"message": "Object updated successfully!"}, status=status.HTTP_200_OK)
+        if not database_name or not table_name:
+            return Response({"error": "Database name and table name are required"}, status=status.HTTP_400_BAD_REQUEST)
 
-            except:
-                return Response({"error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            limit = int(_param(request, "limit") or 30)
+        except (TypeError, ValueError):
+            limit = 0
+        if not 1 <= limit <= 100:
+            return Response({"error": "Limit should be a number from 1 to 100"}, status=status.HTTP_400_BAD_REQUEST)
 
+        try:
+            # From the head of the branch, or from an older "commit"
+            commits = table_history(get_storage_engine(), database_name, table_name, _param(request, "commit"), limit)
+            return Response({"commits": commits}, status=status.HTTP_200_OK)
+
+        except NotFound:
+            return Response({"error": "Commit not found"}, status=status.HTTP_404_NOT_FOUND)
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -1,18 +1,15 @@
-import os 
-from github import Github
-
-GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-REPO_NAME = os.getenv("GITHUB_REPO")
+from tableStorage.engines import get_read_engine, get_storage_engine
+from tableStorage.governor import RateLimited
 
 
 class GitHubSerivce:
     @staticmethod
     def get_repo_content():
         try:
-            g = Github(GITHUB_TOKEN)
-            repo = g.get_repo(REPO_NAME)
-            contents = repo.get_contents("")
+            contents = get_storage_engine().list("")
             return contents
+        except RateLimited:
+            raise
         except Exception as e:
             raise Exception(f"Error fetching repo contents: {str(e)}")
         
@@ -23,9 +20,9 @@ class GitHubSerivce:
         """
 
         try:
-            contents = GitHubSerivce.get_repo_content()
-            folders = [content.path for content in contents if content.type == "dir"]
-            return folders
+            return get_read_engine().list_databases()
+        except RateLimited:
+            raise
         except Exception as e:
             raise Exception(f"Error fetching folder contents: {str(e)}")
         
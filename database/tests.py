@@ -1,3 +1,23 @@
-from django.test import TestCase
+import tempfile
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+
+from tableStorage.engines import get_storage_engine
+
+
+class DatabaseViewTests(SimpleTestCase):
+    files = {
+        "shop/Tables/orders.json": "[]", "shop/Tables/orders/000001.ndjson": "", "shop/Schema/orders.json": "{}",
+        "blog/Tables/posts.json": "[]", "blog/Schema/posts.json": "{}",
+    }
+
+    def test_database_is_deleted_in_one_commit(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(STORAGE_ENGINE="git", STORAGE_LOCAL_PATH=f"{root}/data.git"))
+        engine = get_storage_engine()
+        engine.commit("Created databases", self.files)
+        response = self.client.delete("/database/folders/", {"database_name": "shop"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(engine.list_databases(), ["blog"])
+        self.assertEqual([commit["message"] for commit in engine.history(["shop"])],
+                         ["Deleted database shop", "Created databases"])
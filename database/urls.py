@@ -1,6 +1,7 @@
 from django.urls import path
-from .views import DatabaseManager
+from .views import DatabaseExport, DatabaseManager
 
 urlpatterns = [
     path("folders/", DatabaseManager.as_view(), name="folder_manager"),
+    path("export/", DatabaseExport.as_view(), name="database_export"),
 ]
@@ -1,13 +1,12 @@
-import os 
-from github import Github, GithubException
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from django.http import StreamingHttpResponse
+from tableStorage.engines import Conflict, get_storage_engine
+from tableStorage.exports import ARCHIVE_FORMATS, export_database
+from tableStorage.governor import RateLimited, rate_limited_response
 from .methods import GitHubSerivce
 
-GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-REPO_NAME = os.getenv("GITHUB_REPO")
-
 class DatabaseManager(APIView):
 
     def post(self, request):
@@ -18,26 +17,25 @@ class DatabaseManager(APIView):
 
         try:
 
-            repo = Github(GITHUB_TOKEN).get_repo(REPO_NAME)
+            engine = get_storage_engine()
             
-            folders = GitHubSerivce.get_repo_folders()
-            if folders.__contains__(database_name):
+            if engine.database_exists(database_name):
                 return Response({"error" : f"Database '{database_name}' is already Present!"})
 
             subFolders = ['Tables', 'Schema']
 
-            for subfolder in subFolders:
-                table_path = f"{database_name}/{subfolder}/.gitkeep"
-
-                try:
-                    # Check if the file already exists
-                    repo.get_contents(table_path)
-                except GithubException:
-                    # Create an empty .gitkeep file in each subfolder
-                    repo.create_file(table_path, f"Created {database_name}/{subfolder}", "", branch="main")
+            # Create an empty .gitkeep file in each subfolder, all in one commit
+            with engine.batch(f"Created database {database_name}") as batch:
+                for subfolder in subFolders:
+                    batch.write(f"{database_name}/{subfolder}/.gitkeep", "")
 
             return Response({"message": f"Database '{database_name}' created successfully!"}, status=status.HTTP_201_CREATED)
 
+        except Conflict:
+            return Response({"error": "The repository kept changing while applying this request, please retry"},
+                            status=status.HTTP_409_CONFLICT)
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
@@ -48,6 +46,8 @@ class DatabaseManager(APIView):
             databases = GitHubSerivce.get_repo_folders()
             return Response({"databases": databases}, status=status.HTTP_200_OK)
 
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
      
@@ -59,35 +59,27 @@ class DatabaseManager(APIView):
             return Response({"error": "Database name is required"}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            g = Github(GITHUB_TOKEN)
-            repo = g.get_repo(REPO_NAME)
+            engine = get_storage_engine()
 
-            contents = repo.get_contents("")
-            folders = [content.path for content in contents if content.type == "dir"]
-            if not folders.__contains__(database_name):
+            if not engine.database_exists(database_name):
                             return Response({"error": "Database is not present"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            table_path = f"{database_name}/"
-
-            # Recursive function to delete all files in a folder (and its subfolders)
-            def delete_contents(path):
-                # Get all the contents in the folder (or subfolder)
-                contents = repo.get_contents(path)
-
-                for content in contents:
-                    if content.type == "dir":
-                        # Recursively delete contents of subfolders
-                        delete_contents(content.path)
-                    else:
-                        # Delete files
-                        repo.delete_file(content.path, f"Deleted file: {content.path}", content.sha)
-
-            # Start the deletion from the root folder
-            delete_contents(table_path)
+            # List every file of the database (including subfolders) in one go
+            # and delete them all in a single commit, unless any of them
+            # changed since it was listed
+            with engine.batch(f"Deleted database {database_name}") as batch:
+                for content in engine.walk(database_name):
+                    if content.type == "file":
+                        batch.delete(content.path, content.sha)
 
             # After deleting all files and subfolders, the parent folder is automatically removed if empty
             return Response({"message": f"Database '{database_name}' and its contents deleted successfully!"}, status=status.HTTP_200_OK)
 
+        except Conflict:
+            return Response({"error": "The repository kept changing while applying this request, please retry"},
+                            status=status.HTTP_409_CONFLICT)
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -135,3 +127,37 @@ class DatabaseManager(APIView):
     #     except Exception as e:
     #         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+
+class DatabaseExport(APIView):
+
+    def get(self, request):
+        """Stream the schemas and rows of every table of a database as a tar or zip archive"""
+        database_name = request.query_params.get("database_name") or request.data.get("database_name")
+        archive_format = request.query_params.get("archive") or request.data.get("archive") or "tar"
+
+        if not database_name:
+            return Response({"error": "Database name is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if archive_format not in ARCHIVE_FORMATS:
+            return Response(
+                {"error": f"Archive should be one of: {', '.join(ARCHIVE_FORMATS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            engine = get_storage_engine()
+
+            if not engine.database_exists(database_name):
+                return Response({"error": "Database is not present"}, status=status.HTTP_404_NOT_FOUND)
+
+            response = StreamingHttpResponse(
+                export_database(engine, database_name, archive_format),
+                content_type=ARCHIVE_FORMATS[archive_format]
+            )
+            response["Content-Disposition"] = f'attachment; filename="{database_name}.{archive_format}"'
+            return response
+
+        except RateLimited as e:
+            return rate_limited_response(e)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -1,12 +1,11 @@
 import json
-import os
-import uuid
-from github import Github
 from rest_framework.response import Response
 from rest_framework import status, views
-
-GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-REPO_NAME = os.getenv("GITHUB_REPO")
+from tableStorage.engines import Conflict, NotFound, get_storage_engine
+from tableStorage.governor import RateLimited, rate_limited_response
+from tableStorage.indexes import declared_indexes
+from tableStorage.schemas import validate_schema
+from tableStorage.tables import ROW_FORMATS, Table, new_table, segment_folder
 
 
 class CreateTable(views.APIView):
@@ -15,6 +14,7 @@ class CreateTable(views.APIView):
         database_name = request.data.get("database_name")
         table_name = request.data.get("table_name")
         schema = request.data.get("schema")
+        row_format = request.data.get("format")  # Optional, the default is TABLE_ROW_FORMAT
 
         if not database_name or not table_name or not schema:
             return Response(
@@ -22,6 +22,12 @@ class CreateTable(views.APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        if row_format is not None and row_format not in ROW_FORMATS:
+            return Response(
+                {"error": f"Format should be one of: {', '.join(ROW_FORMATS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
         # Validate the schema
         if not isinstance(schema, dict):
             return Response(
@@ -29,32 +35,9 @@ class CreateTable(views.APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        def validate_schema_field(field, field_type):
-            """Recursively validate schema fields to support nested objects and arrays"""
-            if isinstance(field_type, dict):
-                # If the field is a nested object, recursively validate its fields
-                for subfield, subfield_type in field_type.items():
-                    validate_schema_field(subfield, subfield_type)
-            elif isinstance(field_type, list):
-                # If the field is an array, check the type of items inside the array
-                if len(field_type) == 1 and isinstance(field_type[0], dict):
-                    # Array of objects (nested)
-                    for index, item in enumerate(field_type):
-                        # Validate the object inside the array
-                        for subfield, subfield_type in item.items():
-                            validate_schema_field(subfield, subfield_type)
-                else:
-                    # If it's an array of simple types, validate each item
-                    for item in field_type:
-                        if item not in ["string", "integer", "boolean"]:
-                            raise ValueError(f"Invalid array type '{item}' in field '{field}'")
-            elif field_type not in ["string", "integer", "boolean", "array", "object"]:
-                raise ValueError(f"Invalid type '{field_type}' for field '{field}'")
-
-        # Validate the schema fields
+        # Validate the schema fields and indexes
         try:
-            for field, field_type in schema.items():
-                validate_schema_field(field, field_type)
+            validate_schema(schema)
         except ValueError as e:
             return Response(
                 {"error": str(e)},
@@ -62,14 +45,10 @@ class CreateTable(views.APIView):
             )
 
         try:
-            g = Github(GITHUB_TOKEN)
-            repo = g.get_repo(REPO_NAME)
+            engine = get_storage_engine()
 
-            contents = repo.get_contents("")
-            folders = [content.path for content in contents if content.type == "dir"]
-            
             # Check if the database folder exists
-            if database_name not in folders:
+            if not engine.database_exists(database_name):
                 return Response({"error": "Database does not exist"}, status=status.HTTP_400_BAD_REQUEST)
 
             # Define paths for schema and table
@@ -81,28 +60,31 @@ class CreateTable(views.APIView):
 
             # Check if the schema file already exists
             try:
-                repo.get_contents(schema_path)  # This will raise an exception if file does not exist
+                engine.read(schema_path)  # This will raise an exception if file does not exist
                 return Response(
                     {"error": "Table schema already exists"},
                     status=status.HTTP_400_BAD_REQUEST
                 )
-            except:
-                # File does not exist, create schema and table files
-                repo.create_file(
-                    schema_path,
-                    f"Created schema for table {table_name}",
-                    schema_json
-                )
-                repo.create_file(
-                    table_path,
-                    f"Created table {table_name}",
-                    "[]"  # Initialize table as an empty list
-                )
-                return Response(
-                    {"message": "Table schema created successfully"},
-                    status=status.HTTP_201_CREATED
-                )
+            except NotFound:
+                pass
+
+            # File does not exist, create schema and table files in one commit,
+            # unless another request created either of them meanwhile
+            try:
+                with engine.batch(f"Created table {table_name}") as batch:
+                    batch.write(schema_path, schema_json)
+                    batch.write(table_path, new_table(row_format, declared_indexes(schema)))  # Initialize table with no rows
+                    batch.expect(schema_path, None)
+                    batch.expect(table_path, None)
+            except Conflict:
+                return Response({"error": "Table schema already exists"}, status=status.HTTP_409_CONFLICT)
+            return Response(
+                {"message": "Table schema created successfully"},
+                status=status.HTTP_201_CREATED
+            )
 
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -118,9 +100,14 @@ class CreateTable(views.APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        if old_table_name == new_table_name:
+            return Response(
+                {"error": "The new table name should differ from the old one"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
         try:
-            g = Github(GITHUB_TOKEN)
-            repo = g.get_repo(REPO_NAME)
+            engine = get_storage_engine()
 
             # Define the paths for the old and new table files
             old_schema_path = f"{database_name}/Schema/{old_table_name}.json"
@@ -131,30 +118,44 @@ class CreateTable(views.APIView):
 
             # Check if the old table and schema exist
             try:
-                old_schema_file = repo.get_contents(old_schema_path)
-                old_table_file = repo.get_contents(old_table_path)
+                old_schema_file = engine.read(old_schema_path)
+                old_table = Table.load(engine, old_table_path)
+            except RateLimited as e:
+                return rate_limited_response(e)
             except:
                 return Response(
                     {"error": f"Table or schema '{old_table_name}' does not exist."},
                     status=status.HTTP_404_NOT_FOUND
                 )
 
-            # Read the content of the old files
-            schema_content = old_schema_file.decoded_content.decode("utf-8")
-            table_content = old_table_file.decoded_content.decode("utf-8")
-
-            # Create the new schema and table files with the new name
-            repo.create_file(new_schema_path, f"Renamed schema for table {old_table_name} to {new_table_name}", schema_content)
-            repo.create_file(new_table_path, f"Renamed table {old_table_name} to {new_table_name}", table_content)
+            old_folder = segment_folder(old_table_path)
+            new_folder = segment_folder(new_table_path)
 
-            # Delete the old schema and table files
-            repo.delete_file(old_schema_file.path, f"Deleted old schema: {old_table_name}", old_schema_file.sha)
-            repo.delete_file(old_table_file.path, f"Deleted old table: {old_table_name}", old_table_file.sha)
+            try:
+                with engine.batch(f"Renamed table {old_table_name} to {new_table_name}") as batch:
+                    # Move the schema and table files to the new name, which
+                    # no table may have yet; the blobs are moved as they are,
+                    # as long as none of them changed since it was read
+                    batch.move(old_schema_file.path, new_schema_path, old_schema_file.sha)
+                    batch.expect(new_schema_path, None)
+                    batch.expect(new_table_path, None)
+
+                    # Move the table manifest and its segments along
+                    for path, sha in old_table.blobs().items():
+                        new_path = new_table_path if path == old_table_path else new_folder + path[len(old_folder):]
+                        batch.move(path, new_path, sha)
+            except Conflict:
+                return Response(
+                    {"error": f"Table '{old_table_name}' changed or '{new_table_name}' already exists, please retry."},
+                    status=status.HTTP_409_CONFLICT
+                )
 
             return Response(
                 {"message": f"Table renamed from '{old_table_name}' to '{new_table_name}' successfully."},
                 status=status.HTTP_200_OK
             )
 
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
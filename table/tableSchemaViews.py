@@ -1,11 +1,12 @@
 import json
-import os
-from github import Github
 from rest_framework.response import Response
 from rest_framework import status, views
-
-GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-REPO_NAME = os.getenv("GITHUB_REPO")
+from tableStorage.engines import Conflict, get_read_engine, get_storage_engine
+from tableStorage.backfill import get_index_backfill
+from tableStorage.governor import RateLimited, rate_limited_response
+from tableStorage.indexes import declared_indexes, schema_fields
+from tableStorage.schemas import validate_schema
+from tableStorage.wal import load_table
 
 class TableSchema(views.APIView):
     def post(self, request, *args, **kwargs):
@@ -27,32 +28,9 @@ class TableSchema(views.APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        def validate_schema_field(field, field_type):
-            """Recursively validate schema fields to support nested objects and arrays"""
-            if isinstance(field_type, dict):
-                # If the field is a nested object, recursively validate its fields
-                for subfield, subfield_type in field_type.items():
-                    validate_schema_field(subfield, subfield_type)
-            elif isinstance(field_type, list):
-                # If the field is an array, check the type of items inside the array
-                if len(field_type) == 1 and isinstance(field_type[0], dict):
-                    # Array of objects (nested)
-                    for index, item in enumerate(field_type):
-                        # Validate the object inside the array
-                        for subfield, subfield_type in item.items():
-                            validate_schema_field(subfield, subfield_type)
-                else:
-                    # If it's an array of simple types, validate each item
-                    for item in field_type:
-                        if item not in ["string", "integer", "boolean"]:
-                            raise ValueError(f"Invalid array type '{item}' in field '{field}'")
-            elif field_type not in ["string", "integer", "boolean", "array", "object"]:
-                raise ValueError(f"Invalid type '{field_type}' for field '{field}'")
-
-        # Validate the schema fields
+        # Validate the schema fields and indexes
         try:
-            for field, field_type in new_schema.items():
-                validate_schema_field(field, field_type)
+            validate_schema(new_schema)
         except ValueError as e:
             return Response(
                 {"error": str(e)},
@@ -60,14 +38,10 @@ class TableSchema(views.APIView):
             )
 
         try:
-            g = Github(GITHUB_TOKEN)
-            repo = g.get_repo(REPO_NAME)
+            engine = get_storage_engine()
 
-            contents = repo.get_contents("")
-            folders = [content.path for content in contents if content.type == "dir"]
-            
             # Check if the database folder exists
-            if database_name not in folders:
+            if not engine.database_exists(database_name):
                 return Response({"error": "Database does not exist"}, status=status.HTTP_400_BAD_REQUEST)
 
             # Define paths for schema and table
@@ -79,41 +53,49 @@ class TableSchema(views.APIView):
 
             try:
                 # Check if the schema file exists
-                schema_file = repo.get_contents(schema_path)
+                schema_file = engine.read(schema_path)
+                old_schema = json.loads(schema_file.decoded_content.decode("utf-8"))
                 
-                # Check if the table has data before allowing schema change
+                # Check if the table has data before allowing schema change,
+                # counting the writes still waiting in the log
                 try:
-                    table_file = repo.get_contents(table_path)
-                    table_data = json.loads(table_file.decoded_content.decode("utf-8"))
+                    table = load_table(engine, table_path)
 
-                    # Prevent schema change if table has data
-                    if table_data and isinstance(table_data, list) and len(table_data) > 0:
+                    # Prevent schema change if table has data (indexes may still change)
+                    if schema_fields(new_schema) != schema_fields(old_schema) and table.has_rows():
                         return Response(
                             {"error": "Table has data, schema cannot be changed."},
                             status=status.HTTP_400_BAD_REQUEST
                         )
+                except RateLimited as e:
+                    return rate_limited_response(e)
                 except:
                     # Table does not exist or is empty, allow schema change
                     pass
                 
-                # Delete old schema before creating the new one
-                repo.delete_file(
+                # Replace the old schema in a single commit
+                engine.write(
                     schema_path,
-                    f"Removed old schema for table {table_name}",
+                    f"Updated schema for table {table_name}",
+                    schema_json,
                     schema_file.sha
                 )
 
-                # Create the new schema
-                repo.create_file(
-                    schema_path,
-                    f"Created new schema for table {table_name}",
-                    schema_json
-                )
+                # Build (or drop) indexes in the background
+                if declared_indexes(new_schema) != declared_indexes(old_schema):
+                    get_index_backfill().schedule(engine, database_name, table_name)
                 
                 return Response(
                     {"message": "Table schema updated successfully"},
                     status=status.HTTP_200_OK
                 )
+            except Conflict:
+                return Response(
+                    {"error": "The schema changed while applying this request, please retry"},
+                    status=status.HTTP_409_CONFLICT
+                )
+            except RateLimited as e:
+                return rate_limited_response(e)
             except:
                 
                 return Response(
@@ -121,6 +103,8 @@ class TableSchema(views.APIView):
                     status=status.HTTP_201_CREATED
                 )
 
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -135,14 +119,10 @@ class TableSchema(views.APIView):
             )
 
         try:
-            g = Github(GITHUB_TOKEN)
-            repo = g.get_repo(REPO_NAME)
+            engine = get_read_engine()
 
-            contents = repo.get_contents("")  # Get contents at the root level
-            folders = [content.path for content in contents if content.type == "dir"]
-            
             # Check if the database folder exists
-            if database_name not in folders:
+            if not engine.database_exists(database_name):
                 return Response({"error": "Database does not exist"}, status=status.HTTP_400_BAD_REQUEST)
 
             # Define the path for the schema file
@@ -150,12 +130,14 @@ class TableSchema(views.APIView):
             
             try:
                 # Attempt to get the schema file
-                schema_file = repo.get_contents(schema_path)
+                schema_file = engine.read(schema_path)
                 schema = json.loads(schema_file.decoded_content.decode("utf-8"))
 
                 # Return the schema
                 return Response({"schema": schema}, status=status.HTTP_200_OK)
 
+            except RateLimited as e:
+                return rate_limited_response(e)
             except:
                 # If the schema file does not exist, return an error
                 return Response(
@@ -163,6 +145,8 @@ class TableSchema(views.APIView):
                     status=status.HTTP_404_NOT_FOUND
                 )
 
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -1,3 +1,70 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+from django.urls import resolve
+
+from tableStorage.engines import WriteBatch, get_storage_engine
+from tableStorage.tables import append_rows
+
+
+class TableViewTests(SimpleTestCase):
+    def setUp(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(STORAGE_ENGINE="local", STORAGE_LOCAL_PATH=root))
+        self.call("POST", "/database/folders/", {"database_name": "shop"})
+        for table_name in ("orders", "items"):
+            self.create(table_name, {"x": "integer"})
+        self.call("POST", "/table/table-data/", {"database_name": "shop", "table_name": "items", "data": [{"x": 1}]})
+
+    def call(self, method, url, data):
+        return self.client.generic(method, url, json.dumps(data), content_type="application/json")
+
+    def create(self, table_name, schema):
+        return self.call("POST", "/table/table/", {"database_name": "shop", "table_name": table_name, "schema": schema})
+
+    def rename(self, old_table_name, new_table_name):
+        return self.call("PUT", "/table/table/", {
+            "database_name": "shop", "old_table_name": old_table_name, "new_table_name": new_table_name,
+        })
+
+    def rows(self, table_name):
+        return self.call("GET", "/table/table-data/", {"database_name": "shop", "table_name": table_name}).json()
+
+    def test_schema_and_table_listings_are_async_views(self):
+        for url in ("/table/schema/", "/table/tables/"):
+            self.assertTrue(asyncio.iscoroutinefunction(resolve(url).func), url)
+        self.assertEqual(self.call("GET", "/table/tables/", {"database_name": "shop"}).json(),
+                         {"tables": ["items", "orders"]})
+
+    def test_create_never_replaces_a_table(self):
+        self.assertEqual(self.create("items", {"y": "string"}).status_code, 400)
+        self.assertEqual(len(self.rows("items")), 1)
+
+    def test_rename_never_replaces_a_table(self):
+        self.assertEqual(self.rename("orders", "items").status_code, 409)
+        self.assertEqual(self.rename("items", "items").status_code, 400)
+        self.assertEqual(len(self.rows("items")), 1)
+        self.assertEqual(self.rows("orders"), [])
+
+    def test_writes_made_meanwhile_are_not_lost(self):
+        # An insert lands between the reads of a rename or delete and its commit
+        commit = WriteBatch.commit
+
+        def insert_first(batch):
+            append_rows(get_storage_engine(), "shop", "items", [{"x": 2}])
+            commit(batch)
+
+        requests = [
+            ("PUT", "/table/table/", {"database_name": "shop", "old_table_name": "items", "new_table_name": "moved"}),
+            ("DELETE", "/table/tables/", {"database_name": "shop", "table_name": "items"}),
+            ("DELETE", "/database/folders/", {"database_name": "shop"}),
+        ]
+        for method, url, data in requests:
+            with mock.patch.object(WriteBatch, "commit", autospec=True, side_effect=insert_first):
+                self.assertEqual(self.call(method, url, data).status_code, 409, url)
+        self.assertEqual(sorted(row["x"] for row in self.rows("items")), [1, 2, 2, 2])
+        self.assertEqual(self.rename("items", "moved").status_code, 200)
+        self.assertEqual(sorted(row["x"] for row in self.rows("moved")), [1, 2, 2, 2])
@@ -1,10 +1,11 @@
 from django.urls import path
+from tableStorage.aio import async_view
 from .tableSchemaViews import TableSchema
 from .createTableViews import CreateTable
 from .views import Table
 
 urlpatterns = [
     path("table/", CreateTable.as_view(), name="table"),
-    path("schema/", TableSchema.as_view(), name="schema"),
-    path("tables/", Table.as_view(), name="schema")
+    path("schema/", async_view(TableSchema), name="schema"),
+    path("tables/", async_view(Table), name="schema")
 ]
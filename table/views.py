@@ -1,12 +1,8 @@
-import json
-import os
-import uuid
-from github import Github
 from rest_framework.response import Response
 from rest_framework import status, views
-
-GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-REPO_NAME = os.getenv("GITHUB_REPO")
+from tableStorage.engines import Conflict, NotFound, get_read_engine, get_storage_engine
+from tableStorage.governor import RateLimited, rate_limited_response
+from tableStorage.tables import table_blobs
 
 class Table(views.APIView):
 
@@ -21,37 +17,28 @@ class Table(views.APIView):
             )
 
         try:
-            g = Github(GITHUB_TOKEN)
-            repo = g.get_repo(REPO_NAME)
-
-            # List contents of the repository to check if the database folder exists
-            contents = repo.get_contents("")
-            folders = [content.path for content in contents if content.type == "dir"]
+            engine = get_read_engine()
 
             # Check if the database folder exists
-            if database_name not in folders:
+            if not engine.database_exists(database_name):
                 return Response({"error": "Database does not exist"}, status=status.HTTP_400_BAD_REQUEST)
 
-            # Define path to the database folder
-            database_path = f"{database_name}/Tables"
-            tables = []
-
-            # List contents of the database folder to get all table files
+            # List the table files of the database folder (ignoring subfolders)
             try:
-                table_files = repo.get_contents(database_path)
-                for table in table_files:
-                    # Only add files that are tables (ignoring subfolders)
-                    if table.type == "file" and table.name != ".gitkeep":
-                        tables.append(table.name.split('.')[0])
+                tables = engine.list_tables(database_name)
 
                 if not tables:
                     return Response({"tables": tables}, status=status.HTTP_200_OK)
 
                 return Response({"tables": tables}, status=status.HTTP_200_OK)
 
+            except RateLimited as e:
+                return rate_limited_response(e)
             except:
                 return Response({"error": "Database folder does not contain any tables"}, status=status.HTTP_404_NOT_FOUND)
 
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -67,29 +54,38 @@ class Table(views.APIView):
             )
 
         try:
-            # Initialize GitHub API client
-            g = Github(GITHUB_TOKEN)
-            repo = g.get_repo(REPO_NAME)
+            # Initialize the storage engine
+            engine = get_storage_engine()
 
             # Define paths for schema and table files
             schema_path = f"{database_name}/Schema/{table_name}.json"
             table_path = f"{database_name}/Tables/{table_name}.json"
 
-            # Check if the schema file exists and delete it
+            # Check if the schema file exists
             try:
-                schema_file = repo.get_contents(schema_path)
-                repo.delete_file(schema_path, f"Deleted schema for table {table_name}", schema_file.sha)
-            except:
+                schema_file = engine.read(schema_path)
+            except NotFound:
                 return Response({"error": f"Schema file for table {table_name} not found"}, status=status.HTTP_404_NOT_FOUND)
 
-            # Check if the table file exists and delete it
+            # Check if the table file exists
             try:
-                table_file = repo.get_contents(table_path)
-                repo.delete_file(table_path, f"Deleted table data for {table_name}", table_file.sha)
-            except:
+                blobs = table_blobs(engine, table_path)
+            except NotFound:
                 return Response({"error": f"Table file for {table_name} not found"}, status=status.HTTP_404_NOT_FOUND)
 
+            # Delete the schema and all table files in one commit, unless
+            # any of them changed since they were read
+            with engine.batch(f"Deleted table {table_name} and its schema") as batch:
+                batch.delete(schema_path, schema_file.sha)
+                for path, sha in blobs.items():
+                    batch.delete(path, sha)
+
             return Response({"message": f"Table {table_name} and its schema deleted successfully!"}, status=status.HTTP_200_OK)
 
+        except Conflict:
+            return Response({"error": "The repository kept changing while applying this request, please retry"},
+                            status=status.HTTP_409_CONFLICT)
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
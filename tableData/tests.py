@@ -1,3 +1,64 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+from django.urls import resolve
+
+from tableStorage.aio import sync_view_stats
+
+
+class TableDataViewTests(SimpleTestCase):
+    def setUp(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(STORAGE_ENGINE="local", STORAGE_LOCAL_PATH=root))
+        self.table = {"database_name": "shop", "table_name": "orders"}
+        self.call("POST", "/database/folders/", {"database_name": "shop"})
+        self.call("POST", "/table/table/", {**self.table, "schema": {"x": "integer"}})
+
+    def call(self, method, url, data):
+        return self.client.generic(method, url, json.dumps(data), content_type="application/json")
+
+    async def async_call(self, method, url, data):
+        return await self.async_client.generic(method, url, json.dumps(data), content_type="application/json")
+
+    def test_stream_is_a_boolean(self):
+        self.call("POST", "/table/table-data/", {**self.table, "data": [{"x": 1}]})
+        answers = [(True, True), ("true", True), ("1", True), (False, False), ("false", False), ("0", False)]
+        for stream, streamed in answers:
+            response = self.call("GET", "/table/table-data/", {**self.table, "stream": stream})
+            self.assertEqual(response.streaming, streamed, stream)
+            body = b"".join(response.streaming_content) if streamed else response.content
+            self.assertEqual([row["x"] for row in json.loads(body)], [1])
+        self.assertEqual(self.call("GET", "/table/table-data/?stream=false", self.table).streaming, False)
+        self.assertEqual(self.call("GET", "/table/table-data/", {**self.table, "stream": "maybe"}).status_code, 400)
+
+    def test_reads_answer_the_query(self):
+        rows = [{"x": x} for x in (3, 1, 2, 5)]
+        self.call("POST", "/table/table-data/", {**self.table, "data": rows})
+        query = {"filter": {"x": {"gt": 1}}, "sort": ["-x"], "fields": ["x"], "limit": 2}
+        response = self.call("GET", "/table/table-data/", {**self.table, **query})
+        self.assertEqual(response.json(), [{"x": 5}, {"x": 3}])
+        query = {"filter": {"x": {"in": [1, 2]}}, "stream": True}
+        streamed = self.call("GET", "/table/table-data/", {**self.table, **query})
+        self.assertEqual(sorted(row["x"] for row in json.loads(b"".join(streamed.streaming_content))), [1, 2])
+        for malformed in ({"filter": [1]}, {"filter": {"x": {"in": 1}}}, {"sort": [1]}, {"limit": -1}):
+            response = self.call("GET", "/table/table-data/", {**self.table, **malformed})
+            self.assertEqual(response.status_code, 400, malformed)
+
+    def test_table_data_is_an_async_view(self):
+        self.assertTrue(asyncio.iscoroutinefunction(resolve("/table/table-data/").func))
+
+    async def test_rows_are_written_and_streamed_a_chunk_at_a_time(self):
+        response = await self.async_call("POST", "/table/table-data/", {**self.table, "data": [{"id": "a", "x": 1}]})
+        self.assertEqual(response.status_code, 201)
+        response = await self.async_call("POST", "/table/table-data/", {**self.table, "data": [{"x": "y"}]})
+        self.assertEqual(response.status_code, 400)
+
+        response = await self.async_call("GET", "/table/table-data/", {**self.table, "stream": "true"})
+        self.assertTrue(response.is_async)  # read in threads, one chunk at a time
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(json.loads(body), [{"id": "a", "x": 1}])
+        response = await self.async_call("GET", "/table/table-data/", {**self.table, "stream": "false"})
+        self.assertEqual(json.loads(response.content), [{"id": "a", "x": 1}])
+        self.assertEqual(sync_view_stats.stats()["in_flight"], 0)
@@ -1,5 +1,8 @@
 from django.urls import path
-from .views import TableData
+from tableStorage.aio import async_view
+from .views import TableData, TableExport, TableImport
 urlpatterns = [
-    path("table-data/", TableData.as_view(), name="table-data"),
+    path("table-data/", async_view(TableData), name="table-data"),
+    path("table-data/import/", TableImport.as_view(), name="table-import"),
+    path("table-data/export/", TableExport.as_view(), name="table-export"),
 ]
@@ -1,12 +1,23 @@
 import json
-import os
-import uuid
-from github import Github
+
+from django.http import StreamingHttpResponse
 from rest_framework.response import Response
 from rest_framework import status, views
-
-GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-REPO_NAME = os.getenv("GITHUB_REPO")
+from tableStorage.engines import Conflict, NotFound, get_read_engine, get_storage_engine
+from tableStorage.exports import EXPORT_FORMATS, export_table
+from tableStorage.governor import RateLimited, rate_limited_response
+from tableStorage.groupcommit import get_group_committer
+from tableStorage.imports import BulkImportError, InvalidRows, get_import_tracker, import_format
+from tableStorage.query import Query
+from tableStorage.schemas import get_row_validator
+from tableStorage.streaming import json_array, stream_requested
+from tableStorage.tables import (
+    RowsNotFound, append_rows, assign_ids, clear_rows, delete_rows, schema_path, table_path, update_row,
+)
+from tableStorage.wal import get_write_log, load_table
+
+CONFLICT_ERROR = "The table kept changing while applying this request, please retry"
+SCHEMA_ERROR = "Data does not match the table schema"
 
 class TableData(views.APIView):
 
@@ -23,40 +34,42 @@ class TableData(views.APIView):
                 )
 
             try:
-                g = Github(GITHUB_TOKEN)
-                repo = g.get_repo(REPO_NAME)
-
-                table_path = f"{database_name}/Tables/{table_name}.json"
-                try:
-                    table_file = repo.get_contents(table_path)
-                    existing_data = json.loads(table_file.decoded_content.decode("utf-8"))
-                    if not isinstance(existing_data, list):
-                        existing_data = [existing_data]
+                engine = get_storage_engine()
 
+                rows = new_data if isinstance(new_data, list) else [new_data]
 
-                except:
-                    existing_data = []
+                # Check every row against the table schema before writing any
+                validator = get_row_validator(engine, schema_path(database_name, table_name))
+                invalid_rows = validator.errors(rows) if validator is not None else []
+                if invalid_rows:
+                    return Response({"error": SCHEMA_ERROR, "rows": invalid_rows}, status=status.HTTP_400_BAD_REQUEST)
 
                 # Assign unique ID to each entry if not present
-                if isinstance(new_data, list):
-                    for entry in new_data:
-                        if "id" not in entry:
-                            entry["id"] = str(uuid.uuid4())
-                    existing_data.extend(new_data)
+                ids = assign_ids(rows)
+
+                # With the write-ahead log on, answer once the rows are logged
+                log = get_write_log()
+                if log is not None:
+                    sequence = log.append(table_path(database_name, table_name), "insert", {"rows": rows})
+                    return Response(
+                        {"message": "Data added successfully!", "ids": ids, "sequence": sequence},
+                        status=status.HTTP_202_ACCEPTED
+                    )
+
+                # Update GitHub with new table data, together with other
+                # inserts into the same table when group commit is on
+                committer = get_group_committer()
+                if committer is not None:
+                    committer.submit(engine, database_name, table_name, rows)
                 else:
-                    if "id" not in new_data:
-                        new_data["id"] = str(uuid.uuid4())
-                    existing_data.append(new_data)
-
-                # Update GitHub with new table data
-                updated_content = json.dumps(existing_data, indent=4)
-                if 'table_file' in locals():
-                    repo.update_file(table_path, "Updated table with new data", updated_content, table_file.sha)
-                else:
-                    repo.create_file(table_path, "Created new table", updated_content)
+                    append_rows(engine, database_name, table_name, rows)
 
-                return Response({"message": "Data added successfully!"}, status=status.HTTP_201_CREATED)
+                return Response({"message": "Data added successfully!", "ids": ids}, status=status.HTTP_201_CREATED)
 
+            except Conflict:
+                return Response({"error": CONFLICT_ERROR}, status=status.HTTP_409_CONFLICT)
+            except RateLimited as e:
+                return rate_limited_response(e)
             except Exception as e:
                 return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -65,6 +78,8 @@ class TableData(views.APIView):
         database_name = request.data.get("database_name")  # Use query params for GET requests
         table_name = request.data.get("table_name")  # Use query params for GET requests
         object_id = request.data.get("id")  # The ID of the object to retrieve, if provided
+        # Send rows as they are read
+        stream = request.data["stream"] if "stream" in request.data else request.query_params.get("stream")
 
         if not database_name or not table_name:
             return Response(
@@ -72,31 +87,43 @@ class TableData(views.APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        # Optional "filter", "fields", "sort" and "limit", see tableStorage.query
         try:
-            g = Github(GITHUB_TOKEN)
-            repo = g.get_repo(REPO_NAME)
-            table_path = f"{database_name}/Tables/{table_name}.json"
+            query = Query.from_request(request.data)
+            stream = stream_requested(stream)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            engine = get_read_engine()
 
             try:
-                # Try to retrieve the file from GitHub
-                file = repo.get_contents(table_path)
-                existing_data = json.loads(file.decoded_content.decode("utf-8"))
+                # Try to retrieve the file from GitHub, with the writes still in the log
+                table = load_table(engine, table_path(database_name, table_name))
 
                 # If an ID is provided, filter the data to return the specific object
                 if object_id:
                     # Find the object with the matching ID
-                    filtered_data = next((item for item in existing_data if item.get("id") == object_id), None)
+                    filtered_data = table.find(object_id)
                     if filtered_data is not None:
-                        return Response(filtered_data, status=status.HTTP_200_OK)
+                        return Response(query.project(filtered_data), status=status.HTTP_200_OK)
                     else:
                         return Response({"error": "Object not found"}, status=status.HTTP_404_NOT_FOUND)
                 
-                # If no ID is provided, return all data
-                return Response(existing_data, status=status.HTTP_200_OK)
-
+                # If no ID is provided, return all data answering the query
+                if stream:
+                    return StreamingHttpResponse(json_array(query.iter(table)), content_type="application/json")
+                return Response(query.run(table), status=status.HTTP_200_OK)
+
+            except Conflict:
+                return Response({"error": CONFLICT_ERROR}, status=status.HTTP_409_CONFLICT)
+            except RateLimited as e:
+                return rate_limited_response(e)
             except Exception as e:
                 return Response({"error": "Table not found or invalid data format", "details": str(e)}, status=status.HTTP_404_NOT_FOUND)
 
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -109,48 +136,46 @@ class TableData(views.APIView):
         if not database_name or not table_name:
             return Response({"error": "Database name and table name are required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        github_token = os.getenv("GITHUB_TOKEN")
-        repo_name = os.getenv("GITHUB_REPO")
-
         try:
-            g = Github(github_token)
-            repo = g.get_repo(repo_name)
-            file_path = f"{database_name}/Tables/{table_name}.json"
+            engine = get_storage_engine()
+            file_path = table_path(database_name, table_name)
 
             try:
-                # Retrieve the file contents from the GitHub repository
-                file = repo.get_contents(file_path)
-
-                # Load existing data from the JSON file
-                existing_data = json.loads(file.decoded_content.decode("utf-8"))
-
-                # Ensure the existing data is a list
-                if not isinstance(existing_data, list):
-                    existing_data = [existing_data]
+                log = get_write_log()
+                if log is not None:
+                    if obj_ids:
+                        sequence = log.append(file_path, "delete", {"ids": obj_ids})
+                        return Response(
+                            {"message": "Objects deleted successfully!", "sequence": sequence},
+                            status=status.HTTP_202_ACCEPTED
+                        )
+                    sequence = log.append(file_path, "clear", {})
+                    return Response(
+                        {"message": "No IDs provided. All content deleted.", "sequence": sequence},
+                        status=status.HTTP_202_ACCEPTED
+                    )
 
                 if obj_ids:
                     # If IDs are provided, try to delete those objects
-                    updated_data = [obj for obj in existing_data if obj.get("id") not in obj_ids]
-
-                    if len(updated_data) == len(existing_data):
-                        # If no objects were deleted, return an error message
-                        return Response({"error": "Objects not found"}, status=status.HTTP_404_NOT_FOUND)
-                    else:
-                        # If some objects were deleted, update the file
-                        updated_content = json.dumps(updated_data, indent=4)
-                        repo.update_file(file_path, "Deleted objects from the JSON file", updated_content, file.sha)
-                        return Response({"message": "Objects deleted successfully!"}, status=status.HTTP_200_OK)
-
-                else:
-                    # If no IDs are provided, delete all content
-                    updated_data = []
-                    updated_content = json.dumps(updated_data, indent=4)
-                    repo.update_file(file_path, "Deleted all content from the JSON file", updated_content, file.sha)
-                    return Response({"message": "No IDs provided. All content deleted."}, status=status.HTTP_200_OK)
-
+                    delete_rows(engine, file_path, obj_ids)
+                    return Response({"message": "Objects deleted successfully!"}, status=status.HTTP_200_OK)
+
+                # If no IDs are provided, delete all content
+                clear_rows(engine, file_path)
+                return Response({"message": "No IDs provided. All content deleted."}, status=status.HTTP_200_OK)
+
+            except RowsNotFound:
+                # If no objects were deleted, return an error message
+                return Response({"error": "Objects not found"}, status=status.HTTP_404_NOT_FOUND)
+            except Conflict:
+                return Response({"error": CONFLICT_ERROR}, status=status.HTTP_409_CONFLICT)
+            except RateLimited as e:
+                return rate_limited_response(e)
             except Exception as e:
                 return Response({"error": "File not found or error with file operations."}, status=status.HTTP_404_NOT_FOUND)
 
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -158,42 +183,161 @@ class TableData(views.APIView):
     
     def put(self, request, *args, **kwargs):
         """Update a specific object by ID in the JSON file"""
-        file_name = request.data.get("file_name")
+        database_name = request.data.get("database_name")
+        table_name = request.data.get("table_name")
+        file_name = request.data.get("file_name")  # Older clients pass the file path instead
         obj_id = request.data.get("id")
         update_data = request.data.get("data")
 
-        if not file_name or not obj_id or not update_data:
-            return Response({"error": "File name, object ID, and update data are required"}, status=status.HTTP_400_BAD_REQUEST)
+        if not (database_name and table_name or file_name) or not obj_id or not update_data:
+            return Response({"error": "Database name, table name, object ID, and update data are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            engine = get_storage_engine()
+            if database_name and table_name:
+                file_path = table_path(database_name, table_name)
+                schema_file_path = schema_path(database_name, table_name)
+            else:
+                file_path = f"{file_name}.json"
+                schema_file_path = file_path.replace("/Tables/", "/Schema/", 1)
+
+            # The fields being changed have to match the table schema
+            validator = get_row_validator(engine, schema_file_path)
+            errors = validator.row_errors(update_data) if validator is not None else []
+            if errors:
+                return Response({"error": SCHEMA_ERROR, "errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+
+            try:
+                log = get_write_log()
+                if log is not None:
+                    sequence = log.append(file_path, "update", {"id": obj_id, "data": update_data})
+                    return Response(
+                        {"message": "Object updated successfully!", "sequence": sequence},
+                        status=status.HTTP_202_ACCEPTED
+                    )
+
+                update_row(engine, file_path, obj_id, update_data)
+                return Response({"message": "Object updated successfully!"}, status=status.HTTP_200_OK)
+
+            except RowsNotFound:
+                return Response({"error": "Object not found"}, status=status.HTTP_404_NOT_FOUND)
+            except Conflict:
+                return Response({"error": CONFLICT_ERROR}, status=status.HTTP_409_CONFLICT)
+            except RateLimited as e:
+                return rate_limited_response(e)
+            except:
+                return Response({"error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        except RateLimited as e:
+            return rate_limited_response(e)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class TableImport(views.APIView):
+
+    def post(self, request, *args, **kwargs):
+        """Import the rows of a CSV or NDJSON file sent as the request body"""
+        # The body is the file, so the table is given in the query string
+        database_name = request.query_params.get("database_name")
+        table_name = request.query_params.get("table_name")
+        import_id = request.query_params.get("import_id")  # Optional, to follow the progress meanwhile
+        upload_format = import_format(request.content_type)
+
+        if not database_name or not table_name:
+            return Response({"error": "Database name and table name are required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        github_token = os.getenv("GITHUB_TOKEN")
-        repo_name = os.getenv("GITHUB_REPO")
+        if upload_format is None:
+            return Response(
+                {"error": "Send the rows as text/csv or application/x-ndjson"},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+            )
 
         try:
-            g = Github(github_token)
-            repo = g.get_repo(repo_name)
-            file_path = f"{file_name}.json"
+            engine = get_storage_engine()
+
+            validator = get_row_validator(engine, schema_path(database_name, table_name))
+            if validator is None:
+                return Response({"error": "Table does not exist"}, status=status.HTTP_404_NOT_FOUND)
 
             try:
-                file = repo.get_contents(file_path)
-                existing_data = json.loads(file.decoded_content.decode("utf-8"))
+                bulk_import = get_import_tracker().start(database_name, table_name, upload_format, import_id)
+            except BulkImportError as e:
+                return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
 
-                if not isinstance(existing_data, list):
-                    existing_data = [existing_data]
+            try:
+                bulk_import.run(engine, validator, request.stream or [])
+                return Response(bulk_import.status(), status=status.HTTP_201_CREATED)
 
-                for obj in existing_data:
-                    if obj.get("id") == obj_id:
-                        obj.update(update_data)  # Update only the provided fields
-                        break
-                else:
-                    return Response({"error": "Object not found"}, status=status.HTTP_404_NOT_FOUND)
+            except InvalidRows as e:
+                return Response(
+                    {"error": SCHEMA_ERROR, "import_id": bulk_import.id, "invalid_rows": e.count, "rows": e.rows},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            except BulkImportError as e:
+                return Response({"error": str(e), "import_id": bulk_import.id}, status=status.HTTP_400_BAD_REQUEST)
+            except Conflict:
+                return Response({"error": CONFLICT_ERROR, **bulk_import.status()}, status=status.HTTP_409_CONFLICT)
+            except RateLimited as e:
+                # The chunks written before stay, as the progress tells
+                return Response(
+                    {"error": str(e), **bulk_import.status()},
+                    status=status.HTTP_429_TOO_MANY_REQUESTS,
+                    headers={"Retry-After": str(e.retry_after)},
+                )
 
-                updated_content = json.dumps(existing_data, indent=4)
-                repo.update_file(file_path, "Updated an object in the JSON file", updated_content, file.sha)
+        except RateLimited as e:
+            return rate_limited_response(e)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-                return Response({"message": "Object updated successfully!"}, status=status.HTTP_200_OK)
+    def get(self, request, *args, **kwargs):
+        """Report the progress of an import"""
+        import_id = request.query_params.get("import_id") or request.data.get("import_id")
 
-            except:
-                return Response({"error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+        if not import_id:
+            return Response({"error": "Import ID is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        bulk_import = get_import_tracker().get(import_id)
+        if bulk_import is None:
+            return Response({"error": "Import not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(bulk_import.status(), status=status.HTTP_200_OK)
+
+
+class TableExport(views.APIView):
+
+    def get(self, request, *args, **kwargs):
+        """Stream every row of a table as NDJSON or CSV"""
+        database_name = request.query_params.get("database_name") or request.data.get("database_name")
+        table_name = request.query_params.get("table_name") or request.data.get("table_name")
+        file_format = request.query_params.get("file_format") or request.data.get("file_format") or "ndjson"
+
+        if not database_name or not table_name:
+            return Response({"error": "Database name and table name are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if file_format not in EXPORT_FORMATS:
+            return Response(
+                {"error": f"File format should be one of: {', '.join(EXPORT_FORMATS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            engine = get_storage_engine()
+
+            try:
+                schema_file = engine.read(schema_path(database_name, table_name))
+                table = load_table(engine, table_path(database_name, table_name), create=True)
+            except NotFound:
+                return Response({"error": "Table does not exist"}, status=status.HTTP_404_NOT_FOUND)
+
+            schema = json.loads(schema_file.decoded_content.decode("utf-8"))
+            response = StreamingHttpResponse(
+                export_table(table, schema, file_format), content_type=EXPORT_FORMATS[file_format]
+            )
+            response["Content-Disposition"] = f'attachment; filename="{table_name}.{file_format}"'
+            return response
 
+        except RateLimited as e:
+            return rate_limited_response(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
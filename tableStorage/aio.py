@@ -0,0 +1,91 @@
+"""
+Async views of the hot table endpoints.
+
+The storage layer talks to GitHub through PyGithub, which blocks, so these
+views are the sync DRF views run in a thread with asgiref's `sync_to_async`
+(not thread sensitive, so requests do not queue up behind one another). On
+the ASGI entry point the event loop stays free while storage is read, but
+every request waiting on storage still holds a thread of the loop's default
+executor: that pool, not the event loop, bounds the requests a worker serves
+at once. On the WSGI entry point Django runs the same views through
+`async_to_sync`, so both serve the same routes with the same code.
+"""
+import json
+import threading
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+
+_DONE = object()
+
+
+class SyncViewStats:
+    """How many sync views async views are running in threads."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def started(self):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finished(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": self.in_flight, "max_in_flight": self.max_in_flight, "calls": self.calls}
+
+
+sync_view_stats = SyncViewStats()
+
+
+async def _iterate(iterable):
+    # A sync iterator is otherwise read whole before the ASGI handler sends
+    # the first chunk; this reads one chunk at a time, in a thread.
+    iterator = iter(iterable)
+    read = sync_to_async(next, thread_sensitive=False)
+    while True:
+        item = await read(iterator, _DONE)
+        if item is _DONE:
+            return
+        yield item
+
+
+def async_view(view_class):
+    """Return an async view serving the sync DRF `view_class` in a thread."""
+    view = view_class.as_view()
+    run = sync_to_async(view, thread_sensitive=False)
+
+    async def serve(request, *args, **kwargs):
+        sync_view_stats.started()
+        try:
+            response = await run(request, *args, **kwargs)
+        finally:
+            sync_view_stats.finished()
+        if response.streaming and isinstance(request, ASGIRequest):
+            response.streaming_content = _iterate(response.streaming_content)
+        return response
+
+    serve = csrf_exempt(serve)
+    # So the API schema still finds the DRF view behind it
+    serve.cls = view.cls
+    serve.initkwargs = view.initkwargs
+    return serve
+
+
+def json_response(data, status):
+    """A JSON response rendered the way DRF's JSONRenderer renders it."""
+    return HttpResponse(
+        json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+        content_type="application/json",
+        status=status,
+    )
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class TablestorageConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tableStorage'
+
+    def ready(self):
+        # The local clone makes its first sync in the background from now
+        # on, rather than inside the first request reading from it
+        from .replica import get_replica
+        get_replica()
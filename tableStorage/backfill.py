@@ -0,0 +1,73 @@
+"""
+Background builds of secondary indexes.
+
+Declaring an index on a table that already has rows only changes its schema;
+the index itself is built here, in a worker thread, by a table transaction
+that reads every segment and records the index in the manifest once it is
+complete. Until then reads filter without it. Builds of the same table run
+one at a time, each from the schema as it is when the build starts.
+"""
+import json
+import threading
+import time
+
+from .governor import bulk
+from .indexes import declared_indexes
+from .tables import schema_path, table_path, transact
+
+
+class IndexBackfill:
+    def __init__(self):
+        self._builds = {}  # (database name, table name) -> status
+        self._table_locks = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, engine, database_name, table_name):
+        """Bring the indexes of the table in line with its schema, in the background."""
+        key = (database_name, table_name)
+        with self._lock:
+            self._builds[key] = {"state": "queued", "queued_at": time.time()}
+            table_lock = self._table_locks.setdefault(key, threading.Lock())
+        thread = threading.Thread(target=self._run, args=(engine, key, table_lock), daemon=True)
+        thread.start()
+        return thread
+
+    def _set(self, key, **status):
+        with self._lock:
+            self._builds[key].update(status)
+
+    def _run(self, engine, key, table_lock):
+        database_name, table_name = key
+        with table_lock, bulk():
+            started = time.monotonic()
+            self._set(key, state="running")
+            try:
+                schema_file = engine.read(schema_path(database_name, table_name))
+                declarations = declared_indexes(json.loads(schema_file.decoded_content.decode("utf-8")))
+                transact(
+                    engine, table_path(database_name, table_name),
+                    lambda table: table.set_indexes(declarations),
+                    f"Built indexes of table {table_name}",
+                )
+            except Exception as e:
+                self._set(key, state="failed", error=str(e), seconds=time.monotonic() - started)
+            else:
+                self._set(key, state="done", indexes=sorted(declarations), seconds=time.monotonic() - started)
+
+    def stats(self):
+        with self._lock:
+            return {f"{database_name}/{table_name}": dict(status) for (database_name, table_name), status in self._builds.items()}
+
+
+_backfill = None
+_backfill_lock = threading.Lock()
+
+
+def get_index_backfill():
+    """Return the process wide `IndexBackfill`."""
+    global _backfill
+    if _backfill is None:
+        with _backfill_lock:
+            if _backfill is None:
+                _backfill = IndexBackfill()
+    return _backfill
@@ -0,0 +1,180 @@
+"""
+In-process caches of decoded file contents.
+
+Entries are kept per path together with the git blob SHA and the ETag GitHub
+sent for them. An entry younger than `STORAGE_CACHE_TTL` seconds is served
+without any request; an older one is revalidated with `If-None-Match`, which
+costs a 304 (not counted against the rate limit) when the file did not change.
+The cache is bounded by the total size of the cached contents and evicts the
+least recently used entries first.
+
+`ObjectCache` holds what was read at a fixed commit (see `history`): blob
+contents and commit trees, keyed by their SHA. Those never change, so its
+entries are served without ever being revalidated and only leave it when it
+is full, least recently used first.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class CacheEntry:
+    __slots__ = ("path", "sha", "etag", "content", "checked_at")
+
+    def __init__(self, path, sha, content, etag=None):
+        self.path = path
+        self.sha = sha
+        self.etag = etag
+        self.content = content
+        self.checked_at = time.monotonic()
+
+
+class BlobCache:
+    def __init__(self, max_bytes, ttl=0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, sha=None):
+        """Return the entry for `path` (only if it has blob `sha`, when given)."""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or (sha is not None and entry.sha != sha):
+                return None
+            self._entries.move_to_end(path)
+            return entry
+
+    def is_fresh(self, entry):
+        return time.monotonic() - entry.checked_at < self.ttl
+
+    def hit(self, entry, revalidated=False):
+        """Record that `entry` was served, after a 304 when `revalidated`."""
+        with self._lock:
+            self.hits += 1
+            if revalidated:
+                self.revalidations += 1
+                entry.checked_at = time.monotonic()
+
+    def put(self, path, sha, content, etag=None, miss=True):
+        """Store `content`; `miss` is False when the API itself wrote it."""
+        entry = CacheEntry(path, sha, content, etag)
+        with self._lock:
+            if miss:
+                self.misses += 1
+            self._discard(path)
+            if len(content) > self.max_bytes:
+                return entry
+            self._entries[path] = entry
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.content)
+                self.evictions += 1
+        return entry
+
+    def discard(self, path):
+        with self._lock:
+            self._discard(path)
+
+    def _discard(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry.content)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+            }
+
+
+class ObjectCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the object stored under `key` (a SHA), None when it is not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            if key in self._entries or size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_object_cache = None
+
+
+def get_blob_cache():
+    """Return the process wide `BlobCache`, or None when it is disabled."""
+    global _cache
+    if not settings.STORAGE_CACHE_MAX_BYTES:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = BlobCache(settings.STORAGE_CACHE_MAX_BYTES, settings.STORAGE_CACHE_TTL)
+    return _cache
+
+
+def get_object_cache():
+    """Return the process wide `ObjectCache`, or None when it is disabled."""
+    global _object_cache
+    if not settings.STORAGE_OBJECT_CACHE_MAX_BYTES:
+        return None
+    if _object_cache is None:
+        with _cache_lock:
+            if _object_cache is None:
+                _object_cache = ObjectCache(settings.STORAGE_OBJECT_CACHE_MAX_BYTES)
+    return _object_cache
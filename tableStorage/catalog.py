@@ -0,0 +1,81 @@
+"""
+In-memory catalog of databases and their tables.
+
+Checking whether a database exists used to cost a listing of the repository
+root on every request. The catalog is loaded with a single walk of the whole
+tree, kept as a dict of database name to the set of its tables, and kept up
+to date by the storage engine whenever the API writes or deletes a file. It
+is reloaded after `STORAGE_CATALOG_TTL` seconds to pick up changes made
+outside the API.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+
+class Catalog:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._databases = None  # database name -> set of tables, None until loaded
+        self._loaded_at = 0
+        self._lock = threading.RLock()
+
+    def _ensure_loaded(self, engine):
+        if self._databases is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        databases = engine._scan_databases()
+        with self._lock:
+            self._databases = databases
+            self._loaded_at = time.monotonic()
+
+    def databases(self, engine):
+        with self._lock:
+            self._ensure_loaded(engine)
+            return set(self._databases)
+
+    def tables(self, engine, database_name):
+        with self._lock:
+            self._ensure_loaded(engine)
+            return set(self._databases.get(database_name, ()))
+
+    def track(self, path, deleted=False):
+        """Update the catalog after the API wrote (or deleted) `path`."""
+        parts = path.strip("/").split("/")
+        database_name = parts[0]
+        table_name = None
+        if len(parts) == 3 and parts[1] == "Tables" and parts[2] != ".gitkeep":
+            table_name = parts[2].split('.')[0]
+
+        with self._lock:
+            if self._databases is None:
+                return
+            tables = self._databases.get(database_name)
+            if not deleted:
+                tables = self._databases.setdefault(database_name, set())
+                if table_name:
+                    tables.add(table_name)
+            elif table_name:
+                if tables is not None:
+                    tables.discard(table_name)
+            elif len(parts) < 3 or parts[1] not in ("Tables", "Schema") or parts[2] == ".gitkeep":
+                # The database may be gone now; list it again on next use.
+                self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._databases = None
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """Return the process wide `Catalog`."""
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = Catalog(settings.STORAGE_CATALOG_TTL)
+    return _catalog
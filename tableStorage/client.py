@@ -0,0 +1,78 @@
+"""
+Process wide GitHub client.
+
+Building a `Github` object per request opens a new HTTP session and costs an
+extra `get_repo` round trip. Instead every worker process shares one client
+with a pooled keep-alive session, and each repository handle is resolved once.
+"""
+import threading
+
+from django.conf import settings
+from github import Auth, Github
+from urllib3.util.retry import Retry
+
+from .governor import get_governor
+
+_lock = threading.RLock()
+_client = None
+_repos = {}
+
+
+def retry_policy():
+    """The `Retry` of the shared client: idempotent requests only, a few times, backing off."""
+    return Retry(
+        total=settings.GITHUB_RETRIES,
+        backoff_factor=settings.GITHUB_RETRY_BACKOFF,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        raise_on_status=False,
+    )
+
+
+def get_github():
+    """Return the shared `Github` client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                auth = Auth.Token(settings.GITHUB_TOKEN) if settings.GITHUB_TOKEN else None
+                _client = Github(
+                    auth=auth,
+                    base_url=settings.GITHUB_API_URL,
+                    timeout=settings.GITHUB_TIMEOUT,
+                    pool_size=settings.GITHUB_POOL_SIZE,
+                    # Spacing between calls is a process wide decision now that
+                    # the client is shared, so it is opt-in through settings.
+                    seconds_between_requests=settings.GITHUB_SECONDS_BETWEEN_REQUESTS or None,
+                    seconds_between_writes=settings.GITHUB_SECONDS_BETWEEN_WRITES or None,
+                    # Server errors are retried here, rate limit answers are
+                    # left to the governor: PyGithub's default retry would
+                    # sleep through them (up to the quota reset) in the call.
+                    # Only reads are: a write answered with a 5xx may have
+                    # been applied, and sending it again could apply it twice.
+                    retry=retry_policy(),
+                )
+    return _client
+
+
+def get_repo(repo_name=None):
+    """Return the repository handle for `repo_name` (defaults to `GITHUB_REPO`)."""
+    repo_name = repo_name or settings.GITHUB_REPO
+    repo = _repos.get(repo_name)
+    if repo is None:
+        with _lock:
+            repo = _repos.get(repo_name)
+            if repo is None:
+                # Through the governor like every other call (see `governor`)
+                repo = _repos[repo_name] = get_governor().call(lambda: get_github().get_repo(repo_name))
+    return repo
+
+
+def reset():
+    """Drop the shared client and repository handles (e.g. after a fork or a settings change)."""
+    global _client
+    with _lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _repos.clear()
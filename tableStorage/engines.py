@@ -0,0 +1,1167 @@
+"""
+Storage engines for the database layout used by the API.
+
+Every database is a top level folder holding a `Tables/` and a `Schema/`
+folder, with one `<table>.json` file in each (plus the folder of row segments
+of each table, see `tables`). The views only talk to the
+`StorageEngine` interface below, so the same layout can live in the GitHub
+repository, in a plain local directory or in a local bare git repository.
+"""
+import base64
+import datetime
+import functools
+import hashlib
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+import requests
+from django.conf import settings
+from github import GithubException, InputGitTreeElement
+
+from . import client, metrics
+from .cache import get_blob_cache, get_object_cache
+from .catalog import get_catalog
+from .governor import get_governor
+from .replica import ReplicaError, get_replica
+
+
+class StorageError(Exception):
+    """Base class for every error raised by a storage engine."""
+
+
+class NotFound(StorageError):
+    """The requested file or folder does not exist."""
+
+
+class Conflict(StorageError):
+    """The file changed (or already exists) since it was last read."""
+
+
+def blob_sha(content):
+    """Return the git blob SHA of `content`, the same one GitHub reports."""
+    digest = hashlib.sha1(f"blob {len(content)}\0".encode("utf-8"))
+    # Fed separately: `content` may be a memory-mapped file
+    digest.update(content)
+    return digest.hexdigest()
+
+
+def _commit_entry(sha, message, author, date):
+    # One commit of a history, as the views return it; `date` is aware
+    return {
+        "sha": sha,
+        "message": message,
+        "author": author,
+        "date": date.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+    }
+
+
+def _to_bytes(content):
+    if isinstance(content, str):
+        return content.encode("utf-8")
+    return content
+
+
+class StoredFile:
+    """A file or folder entry, shaped like PyGithub's `ContentFile`."""
+
+    def __init__(self, path, type="file", sha=None, content=None):
+        self.path = path
+        self.name = path.rsplit("/", 1)[-1]
+        self.type = type
+        self.sha = sha
+        self.decoded_content = content
+
+    @property
+    def size(self):
+        return len(self.decoded_content or b"")
+
+    def __repr__(self):
+        return f"StoredFile(path={self.path!r}, type={self.type!r}, sha={self.sha!r})"
+
+
+class BlobRef:
+    """
+    New content of a path that is the blob `sha` `path` already holds, so a
+    commit moves or copies it without downloading and uploading it again.
+    """
+
+    def __init__(self, path, sha):
+        self.path = path
+        self.sha = sha
+
+    def __repr__(self):
+        return f"BlobRef(path={self.path!r}, sha={self.sha!r})"
+
+
+class WriteBatch:
+    """
+    Collects writes and deletes and applies them as a single commit.
+
+        with engine.batch("Created table orders") as batch:
+            batch.write("shop/Schema/orders.json", schema_json)
+            batch.write("shop/Tables/orders.json", "[]")
+
+    Nothing is written if the block raises, nor if a path passed to
+    `expect` no longer has the SHA given there (`Conflict`).
+    """
+
+    def __init__(self, engine, message):
+        self.engine = engine
+        self.message = message
+        self.changes = {}
+        self.expected = {}
+
+    def write(self, path, content):
+        self.changes[path] = content
+
+    def delete(self, path, sha=None):
+        """Delete `path`; with `sha`, only if it still has that blob."""
+        self.changes[path] = None
+        if sha is not None:
+            self.expect(path, sha)
+
+    def move(self, path, new_path, sha):
+        """Move `path`, which must still have blob `sha`, to `new_path` without reading it."""
+        self.changes[new_path] = BlobRef(path, sha)
+        self.delete(path, sha)
+
+    def expect(self, path, sha):
+        """Only commit if `path` still has blob `sha` (None: does not exist)."""
+        self.expected[path] = sha
+
+    def commit(self):
+        if self.changes:
+            self.engine.commit(self.message, self.changes, self.expected or None)
+        self.changes = {}
+        self.expected = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+
+
+def _measured(name, method):
+    # The engine operation `method`, measured as `name` (see `metrics`)
+    @functools.wraps(method)
+    def measured(self, *args, **kwargs):
+        if name == "commit":
+            changes = args[1] if len(args) > 1 else kwargs["changes"]
+            paths = list(changes)
+            path = paths[0] + (f" (+{len(paths) - 1})" if len(paths) > 1 else "") if paths else ""
+            written = sum(
+                len(_to_bytes(content)) for content in changes.values()
+                if content is not None and not isinstance(content, BlobRef)
+            )
+        else:
+            path = args[0] if args else kwargs["path"]
+            written = len(_to_bytes(args[2] if len(args) > 2 else kwargs["content"])) if name == "write" else 0
+        with metrics.operation(name, path) as operation:
+            result = method(self, *args, **kwargs)
+            if operation is not None:
+                operation.bytes_out = written
+                if name == "read":
+                    operation.bytes_in = result.size
+            return result
+
+    return measured
+
+
+class StorageEngine:
+    """
+    Interface shared by all storage engines.
+
+    The operations below are measured in every engine (see `metrics`).
+
+    Paths are relative to the storage root and always use `/`. `write` and
+    `delete` follow the PyGithub argument order (path, message, ...) and take
+    the SHA the caller last read; a mismatch raises `Conflict`.
+    """
+
+    catalog = None
+    replica = None
+
+    OPERATIONS = ("list", "walk", "read", "write", "delete", "commit")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls.OPERATIONS:
+            if name in cls.__dict__:
+                setattr(cls, name, _measured(name, cls.__dict__[name]))
+
+    def list(self, path):
+        """Return the `StoredFile` entries directly under folder `path`."""
+        raise NotImplementedError
+
+    def walk(self, path):
+        """Return every file and folder below folder `path`, at any depth."""
+        raise NotImplementedError
+
+    def read(self, path, sha=None):
+        """
+        Return the `StoredFile` at `path`, including its content.
+
+        `sha` is the blob SHA the caller expects, typically from a listing;
+        engines that cache contents can then skip asking whether it changed.
+        """
+        raise NotImplementedError
+
+    def write(self, path, message, content, sha=None):
+        """Create `path` (sha is None) or replace it, and return the new SHA."""
+        raise NotImplementedError
+
+    def delete(self, path, message, sha=None):
+        """Delete the file at `path`."""
+        raise NotImplementedError
+
+    def commit(self, message, changes, expected=None):
+        """
+        Apply several changes at once.
+
+        `changes` maps a path to its new content, a `BlobRef`, or None to
+        delete it.
+        `expected` maps paths to the SHA they must still have (None: must not
+        exist); otherwise nothing is written and `Conflict` is raised.
+        Engines backed by git apply them as one commit and return its SHA.
+        """
+        raise NotImplementedError
+
+    def batch(self, message):
+        """Return a `WriteBatch` committing to this engine with `message`."""
+        return WriteBatch(self, message)
+
+    # History, for the engines backed by git (see `history`)
+
+    def resolve(self, ref=None, before=None):
+        """
+        Return the SHA of the commit `ref` names (a commit SHA, possibly
+        abbreviated, or a branch; by default the engine's branch), or with
+        `before` (an aware datetime) of the last commit made on it by then.
+        Raises `NotFound` when there is none.
+        """
+        raise StorageError("This storage engine keeps no history")
+
+    def history(self, paths, ref=None, limit=30):
+        """
+        Return the newest `limit` commits of `ref` changing any of `paths`
+        (files or folders), newest first, as dicts with "sha", "message",
+        "author" and "date".
+        """
+        raise StorageError("This storage engine keeps no history")
+
+    def tree(self, commit):
+        """Return every file (with its blob SHA) and folder of the tree at `commit`."""
+        raise StorageError("This storage engine keeps no history")
+
+    def blob(self, sha):
+        """Return the content of the git blob `sha`."""
+        raise StorageError("This storage engine keeps no history")
+
+    def exists(self, path):
+        try:
+            self.read(path)
+        except NotFound:
+            return False
+        return True
+
+    def list_databases(self):
+        """Return the names of all databases (top level folders)."""
+        if self.catalog is not None:
+            return sorted(self.catalog.databases(self))
+        return self._list_databases()
+
+    def database_exists(self, database_name):
+        if self.catalog is not None:
+            return database_name in self.catalog.databases(self)
+        return database_name in self._list_databases()
+
+    def list_tables(self, database_name):
+        """Return the table names stored in `<database>/Tables`."""
+        if self.catalog is not None:
+            return sorted(self.catalog.tables(self, database_name))
+        return self._list_tables(database_name)
+
+    def _track(self, path, deleted=False):
+        if self.catalog is not None:
+            self.catalog.track(path, deleted)
+
+    def _reflect(self, changes):
+        # Committed changes ({path: content or None}) go to the local clone
+        # right away, so this worker reads its own writes (see `replica`)
+        if self.replica is not None:
+            try:
+                self.replica.apply(changes)
+            except ReplicaError:
+                pass  # the write is done; the clone catches up on its next sync
+
+    def _list_databases(self):
+        return [content.path for content in self.list("") if content.type == "dir"]
+
+    def _scan_databases(self):
+        """Return {database name: set of tables} from one walk of the whole tree."""
+        databases = {}
+        for content in self.walk(""):
+            parts = content.path.split("/")
+            if len(parts) == 1 and content.type == "dir":
+                databases.setdefault(parts[0], set())
+            elif len(parts) == 3 and parts[1] == "Tables" and content.type == "file" and parts[2] != ".gitkeep":
+                databases.setdefault(parts[0], set()).add(parts[2].split('.')[0])
+        return databases
+
+    def _list_tables(self, database_name):
+        return [
+            content.name.split('.')[0]
+            for content in self.list(f"{database_name}/Tables")
+            if content.type == "file" and content.name != ".gitkeep"
+        ]
+
+
+class GitHubStorageEngine(StorageEngine):
+    """
+    Stores the layout in a GitHub repository through the contents API.
+
+    Files over `GITHUB_CONTENTS_MAX_BYTES` do not fit the contents API: they
+    are written as blobs with the Git Data API, and read from the blobs API
+    or, from `GITHUB_RAW_DOWNLOAD_MIN_BYTES` on, downloaded raw.
+
+    Every call goes through the rate-limit `governor` (see `governor`), which
+    may fail it with `RateLimited`.
+    """
+
+    RAW_CHUNK_BYTES = 1024 * 1024
+    # Times a commit is rebuilt on a branch that moved while it was made,
+    # after a jittered pause of up to COMMIT_RETRY_BACKOFF * 2**attempt seconds
+    COMMIT_RETRIES = 8
+    COMMIT_RETRY_BACKOFF = 0.02
+
+    # Commits of this process to the same branch take turns, so they only
+    # race with other processes
+    _commit_locks = {}
+    _commit_locks_guard = threading.Lock()
+
+    def __init__(self, repo, branch=None, cache=None, catalog=None, governor=None, replica=None):
+        self.repo = repo
+        self.branch = branch
+        self.cache = cache
+        self.catalog = catalog
+        self.governor = governor
+        self.replica = replica
+
+    def _branch_kwargs(self, key):
+        return {key: self.branch} if self.branch else {}
+
+    def _api(self, function, write=False):
+        # Runs the GitHub call `function()` through the governor, which then
+        # takes the quota the response reported, and counts it.
+        started = time.perf_counter()
+        try:
+            if self.governor is None:
+                return function()
+            result = self.governor.call(function, write)
+            remaining, limit = self.repo._requester.rate_limiting
+            if limit >= 0:
+                self.governor.update(remaining, limit, self.repo._requester.rate_limiting_resettime)
+            return result
+        finally:
+            metrics.github_call(time.perf_counter() - started)
+
+    def _raise(self, path, error):
+        if error.status == 404:
+            raise NotFound(path) from error
+        if error.status in (409, 422):
+            raise Conflict(path) from error
+        raise StorageError(str(error)) from error
+
+    def _get_contents(self, path):
+        try:
+            return self._api(lambda: self.repo.get_contents(path, **self._branch_kwargs("ref")))
+        except GithubException as e:
+            self._raise(path, e)
+
+    def list(self, path):
+        try:
+            contents = self._get_contents(path)
+        except NotFound:
+            # GitHub answers 404 for the root of an empty repository.
+            if path.strip("/"):
+                raise
+            return []
+        if not isinstance(contents, list):
+            raise NotFound(path)
+        return [StoredFile(content.path, content.type, content.sha) for content in contents]
+
+    def walk(self, path):
+        path = path.strip("/")
+        if path:
+            # The parent listing carries the tree SHA of the folder.
+            parent, _, name = path.rpartition("/")
+            folder = next((entry for entry in self.list(parent) if entry.name == name), None)
+            if folder is None or folder.type != "dir":
+                raise NotFound(path)
+            return self._walk_tree(folder.sha, f"{path}/")
+        try:
+            # A branch name is accepted in place of the root tree SHA.
+            return self._walk_tree(self.branch or self.repo.default_branch, "")
+        except NotFound:
+            return []
+
+    def _walk_tree(self, tree_sha, prefix):
+        try:
+            tree = self._api(lambda: self.repo.get_git_tree(tree_sha, recursive=True))
+            if tree.truncated:
+                # Too large for one response: take this level only and walk
+                # every subtree on its own.
+                tree = self._api(lambda: self.repo.get_git_tree(tree_sha))
+                truncated = True
+            else:
+                truncated = False
+        except GithubException as e:
+            self._raise(prefix, e)
+        entries = []
+        for element in tree.tree:
+            is_dir = element.type == "tree"
+            entries.append(StoredFile(prefix + element.path, "dir" if is_dir else "file", element.sha))
+            if truncated and is_dir:
+                entries.extend(self._walk_tree(element.sha, f"{prefix}{element.path}/"))
+        return entries
+
+    def read(self, path, sha=None):
+        path = path.strip("/")
+        cached = self.cache.get(path) if self.cache else None
+        if cached is not None and (self.cache.is_fresh(cached) or cached.sha == sha):
+            self.cache.hit(cached)
+            metrics.note(cache="hit")
+            return StoredFile(path, "file", cached.sha, cached.content)
+
+        # Revalidate what we have; an unchanged file costs a 304 and no download.
+        headers = {"If-None-Match": cached.etag} if cached is not None and cached.etag else {}
+        requester = self.repo._requester
+
+        def get():
+            status, response_headers, output = requester.requestJson(
+                "GET",
+                f"{self.repo.url}/contents/{quote(path)}",
+                parameters=self._branch_kwargs("ref"),
+                headers=headers,
+            )
+            if status in (403, 429):
+                # Raised for the governor to see rate limit answers
+                raise requester.createException(status, response_headers, json.loads(output) if output else None)
+            return status, response_headers, output
+
+        try:
+            status, response_headers, output = self._api(get)
+        except GithubException as e:
+            self._raise(path, e)
+        if status == 304:
+            self.cache.hit(cached, revalidated=True)
+            metrics.note(cache="revalidated")
+            return StoredFile(path, "file", cached.sha, cached.content)
+        data = json.loads(output) if output else None
+        if status >= 400:
+            self._raise(path, self.repo._requester.createException(status, response_headers, data))
+        if isinstance(data, list) or data.get("type") != "file":
+            raise NotFound(path)
+
+        content = self._content(path, data)
+        if self.cache:
+            metrics.note(cache="miss")
+            self.cache.put(path, data["sha"], content, response_headers.get("etag"))
+        return StoredFile(path, "file", data["sha"], content)
+
+    def _content(self, path, data):
+        if data.get("encoding") != "none":
+            return base64.b64decode(data.get("content") or "")
+        # Too large to come inline; the response still has its size and SHA.
+        try:
+            if data.get("size", 0) >= settings.GITHUB_RAW_DOWNLOAD_MIN_BYTES:
+                return self._download(path)
+            return base64.b64decode(self._api(lambda: self.repo.get_git_blob(data["sha"])).content)
+        except GithubException as e:
+            self._raise(path, e)
+
+    def _download(self, path):
+        # Streamed to a temporary file first: the body is never held twice,
+        # and never as base64.
+        headers = {"Accept": "application/vnd.github.raw"}
+        if settings.GITHUB_TOKEN:
+            headers["Authorization"] = f"token {settings.GITHUB_TOKEN}"
+
+        def get():
+            response = requests.get(
+                f"{self.repo.url}/contents/{quote(path)}",
+                params=self._branch_kwargs("ref"), headers=headers,
+                stream=True, timeout=settings.GITHUB_TIMEOUT,
+            )
+            if self.governor is not None:
+                self.governor.observe(response.headers)
+            if response.status_code in (403, 429):
+                response.close()
+                raise GithubException(response.status_code, None, dict(response.headers))
+            return response
+
+        try:
+            response = self._api(get)
+        except requests.RequestException as e:
+            raise StorageError(str(e)) from e
+        with response, tempfile.TemporaryFile() as tmp_file:
+            if response.status_code == 404:
+                raise NotFound(path)
+            if response.status_code >= 400:
+                raise StorageError(f"Download of '{path}' failed with status {response.status_code}")
+            for chunk in response.iter_content(self.RAW_CHUNK_BYTES):
+                tmp_file.write(chunk)
+            tmp_file.seek(0)
+            return tmp_file.read()
+
+    def write(self, path, message, content, sha=None):
+        if len(_to_bytes(content)) > settings.GITHUB_CONTENTS_MAX_BYTES:
+            # A commit with the file as a blob, as long as it still has `sha`.
+            self.commit(message, {path: content}, expected={path: sha})
+            return blob_sha(_to_bytes(content))
+        try:
+            if sha is None:
+                result = self._api(
+                    lambda: self.repo.create_file(path, message, content, **self._branch_kwargs("branch")), write=True
+                )
+            else:
+                result = self._api(
+                    lambda: self.repo.update_file(path, message, content, sha, **self._branch_kwargs("branch")),
+                    write=True,
+                )
+        except GithubException as e:
+            if self.cache:
+                self.cache.discard(path)
+            if sha is not None and e.status == 404:
+                # The file we read was deleted meanwhile.
+                raise Conflict(path) from e
+            self._raise(path, e)
+        new_sha = result["content"].sha
+        if self.cache:
+            self.cache.put(path.strip("/"), new_sha, _to_bytes(content), miss=False)
+        self._track(path)
+        self._reflect({path: content})
+        return new_sha
+
+    def delete(self, path, message, sha=None):
+        if sha is None:
+            sha = self.read(path).sha
+        try:
+            self._api(lambda: self.repo.delete_file(path, message, sha, **self._branch_kwargs("branch")), write=True)
+        except GithubException as e:
+            self._raise(path, e)
+        finally:
+            if self.cache:
+                self.cache.discard(path.strip("/"))
+        self._track(path, deleted=True)
+        self._reflect({path: None})
+
+    def _check_expected(self, head, expected, trees):
+        # Against the tree of the commit the new one builds on, one level per
+        # folder on the way to each path; the ref update below fails if the
+        # branch moves past it. Listings are kept by tree SHA in `trees`, so
+        # a retry only lists the folders that changed meanwhile.
+        def entries(tree_sha):
+            if tree_sha not in trees:
+                tree = self._api(lambda: self.repo.get_git_tree(tree_sha))
+                trees[tree_sha] = {element.path: (element.type, element.sha) for element in tree.tree}
+            return trees[tree_sha]
+
+        for path, sha in expected.items():
+            entry = ("tree", head.tree.sha)
+            for name in path.strip("/").split("/"):
+                entry = entries(entry[1]).get(name) if entry[0] == "tree" else None
+                if entry is None:
+                    break
+            if (entry[1] if entry is not None and entry[0] == "blob" else None) != sha:
+                raise Conflict(path)
+
+    def commit(self, message, changes, expected=None):
+        # The contents API writes one commit per file; build a single tree
+        # and commit with the Git Data API instead and move the branch once.
+        # If anything fails before the ref update, the branch is untouched.
+        # When another commit moved the branch meanwhile the commit is built
+        # again on top of it; only a change to an `expected` path conflicts.
+        elements = None
+        trees = {}
+        key = (getattr(self.repo, "url", None), self.branch)
+        with self._commit_locks_guard:
+            commit_lock = self._commit_locks.setdefault(key, threading.Lock())
+        try:
+            for attempt in range(self.COMMIT_RETRIES + 1):
+                with commit_lock:
+                    ref = self._api(lambda: self.repo.get_git_ref(f"heads/{self.branch or self.repo.default_branch}"))
+                    head = self._api(lambda: self.repo.get_git_commit(ref.object.sha))
+                    if expected:
+                        self._check_expected(head, expected, trees)
+                    if elements is None:
+                        # Uploads large blobs, once and only when not conflicting
+                        elements = self._tree_elements(changes)
+                    tree = self._api(lambda: self.repo.create_git_tree(elements, base_tree=head.tree), write=True)
+                    commit = self._api(lambda: self.repo.create_git_commit(message, tree, [head]), write=True)
+                    try:
+                        # Not forced: fails if the branch moved since `head`
+                        self._api(lambda: ref.edit(commit.sha, force=False), write=True)
+                        break
+                    except GithubException as e:
+                        if e.status not in (409, 422) or attempt == self.COMMIT_RETRIES:
+                            raise
+                time.sleep(random.uniform(0, self.COMMIT_RETRY_BACKOFF * 2 ** attempt))
+        except GithubException as e:
+            self._raise(", ".join(changes), e)
+
+        for path, content in changes.items():
+            path = path.strip("/")
+            if self.cache:
+                if content is None or isinstance(content, BlobRef):
+                    self.cache.discard(path)
+                else:
+                    content = _to_bytes(content)
+                    self.cache.put(path, blob_sha(content), content, miss=False)
+            self._track(path, deleted=content is None)
+        self._reflect(changes)
+        return commit.sha
+
+    def _tree_elements(self, changes):
+        elements = []
+        for path, content in changes.items():
+            path = path.strip("/")
+            if content is None:
+                elements.append(InputGitTreeElement(path, "100644", "blob", sha=None))
+                continue
+            if isinstance(content, BlobRef):
+                elements.append(InputGitTreeElement(path, "100644", "blob", sha=content.sha))
+                continue
+            content = _to_bytes(content)
+            text = None
+            if len(content) <= settings.GITHUB_CONTENTS_MAX_BYTES:
+                try:
+                    text = content.decode("utf-8")
+                except UnicodeDecodeError:
+                    pass
+            if text is not None:
+                elements.append(InputGitTreeElement(path, "100644", "blob", content=text))
+            else:
+                # Binary and large files are uploaded as blobs of their own.
+                encoded = base64.b64encode(content).decode("ascii")
+                blob = self._api(lambda: self.repo.create_git_blob(encoded, "base64"), write=True)
+                elements.append(InputGitTreeElement(path, "100644", "blob", sha=blob.sha))
+        return elements
+
+    def _ref(self, ref):
+        return ref or self.branch or self.repo.default_branch
+
+    def resolve(self, ref=None, before=None):
+        ref = self._ref(ref)
+        try:
+            if before is None:
+                return self._api(lambda: self.repo.get_commit(ref)).sha
+            # Sent without its offset: in UTC
+            until = before.astimezone(datetime.timezone.utc)
+            commits = self._api(lambda: self.repo.get_commits(sha=ref, until=until).get_page(0))
+        except GithubException as e:
+            self._raise(ref, e)
+        if not commits:
+            raise NotFound(f"{ref} at {before.isoformat()}")
+        return commits[0].sha
+
+    def history(self, paths, ref=None, limit=30):
+        ref = self._ref(ref)
+        # The commits API filters on one path at a time
+        commits = {}
+        for path in paths:
+            listed = self.repo.get_commits(sha=ref, path=path.strip("/"))
+            page, found = 0, 0
+            while found < limit:
+                try:
+                    batch = self._api(lambda: listed.get_page(page))
+                except GithubException as e:
+                    self._raise(path, e)
+                if not batch:
+                    break
+                for commit in batch[:limit - found]:
+                    author = commit.commit.author
+                    commits[commit.sha] = _commit_entry(commit.sha, commit.commit.message, author.name, author.date)
+                found += len(batch)
+                page += 1
+        return sorted(commits.values(), key=lambda commit: commit["date"], reverse=True)[:limit]
+
+    def tree(self, commit):
+        # A commit SHA is accepted in place of its root tree SHA
+        return self._walk_tree(commit, "")
+
+    def blob(self, sha):
+        try:
+            return base64.b64decode(self._api(lambda: self.repo.get_git_blob(sha)).content)
+        except GithubException as e:
+            self._raise(sha, e)
+
+
+class LocalStorageEngine(StorageEngine):
+    """Stores the layout as plain files under a local directory."""
+
+    _locks = {}
+    _locks_guard = threading.Lock()
+    # SHA of each file by path, kept while its (inode, mtime, size) is the
+    # same: files are only ever replaced, never rewritten in place.
+    _shas = {}
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._locks_guard:
+            self.lock = self._locks.setdefault(str(self.root.resolve()), threading.RLock())
+
+    def _full_path(self, path):
+        full_path = (self.root / path.strip("/")).resolve()
+        if full_path != self.root.resolve() and self.root.resolve() not in full_path.parents:
+            raise StorageError(f"Path '{path}' is outside the storage root")
+        return full_path
+
+    def _relative(self, full_path):
+        return full_path.relative_to(self.root.resolve()).as_posix()
+
+    def _sha(self, full_path):
+        """The blob SHA of a file, hashing it only when it has changed."""
+        stat = full_path.stat()
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = self._shas.get(str(full_path))
+        if cached and cached[0] == key:
+            return cached[1]
+        sha = blob_sha(full_path.read_bytes())
+        self._shas[str(full_path)] = (key, sha)
+        return sha
+
+    def list(self, path):
+        folder = self._full_path(path)
+        if not folder.is_dir():
+            raise NotFound(path)
+        entries = []
+        for child in sorted(folder.iterdir()):
+            if child.name.startswith(".tmp-"):
+                continue
+            if child.is_dir():
+                entries.append(StoredFile(self._relative(child), "dir"))
+            else:
+                entries.append(StoredFile(self._relative(child), "file", self._sha(child)))
+        return entries
+
+    def walk(self, path):
+        folder = self._full_path(path)
+        if not folder.is_dir():
+            if path.strip("/"):
+                raise NotFound(path)
+            return []
+        entries = []
+        for dir_path, dir_names, file_names in os.walk(folder):
+            dir_names.sort()
+            for name in dir_names:
+                entries.append(StoredFile(self._relative(Path(dir_path) / name), "dir"))
+            for name in sorted(file_names):
+                if name.startswith(".tmp-"):
+                    continue
+                child = Path(dir_path) / name
+                entries.append(StoredFile(self._relative(child), "file", self._sha(child)))
+        return entries
+
+    def read(self, path, sha=None):
+        full_path = self._full_path(path)
+        if not full_path.is_file():
+            raise NotFound(path)
+        content = full_path.read_bytes()
+        return StoredFile(self._relative(full_path), "file", blob_sha(content), content)
+
+    def _check_sha(self, path, full_path, sha):
+        current = self._sha(full_path) if full_path.is_file() else None
+        if current != sha:
+            raise Conflict(path)
+
+    def _replace(self, full_path, content):
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=full_path.parent, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, full_path)
+
+    def _remove(self, full_path):
+        full_path.unlink()
+        self._shas.pop(str(full_path), None)
+        # Folders only exist while they hold files, as in git.
+        parent = full_path.parent
+        while parent != self.root.resolve() and not any(parent.iterdir()):
+            parent.rmdir()
+            parent = parent.parent
+
+    def write(self, path, message, content, sha=None):
+        content = _to_bytes(content)
+        full_path = self._full_path(path)
+        with self.lock:
+            self._check_sha(path, full_path, sha)
+            self._replace(full_path, content)
+        return blob_sha(content)
+
+    def delete(self, path, message, sha=None):
+        full_path = self._full_path(path)
+        with self.lock:
+            if not full_path.is_file():
+                raise NotFound(path)
+            if sha is not None:
+                self._check_sha(path, full_path, sha)
+            self._remove(full_path)
+
+    def commit(self, message, changes, expected=None):
+        with self.lock:
+            for path, sha in (expected or {}).items():
+                self._check_sha(path, self._full_path(path), sha)
+            changes = dict(changes)
+            for path, content in changes.items():
+                if isinstance(content, BlobRef):
+                    # Read before any of the changes deletes it
+                    source = self._full_path(content.path)
+                    self._check_sha(content.path, source, content.sha)
+                    changes[path] = source.read_bytes()
+            for path, content in changes.items():
+                full_path = self._full_path(path)
+                if content is None:
+                    if full_path.is_file():
+                        self._remove(full_path)
+                else:
+                    self._replace(full_path, _to_bytes(content))
+
+
+class GitStorageEngine(StorageEngine):
+    """
+    Stores the layout in a local bare git repository.
+
+    Every write is a real commit on `branch`, built with git plumbing commands
+    against a throwaway index and published with a compare-and-swap
+    `update-ref`, so concurrent writers cannot overwrite each other.
+    """
+
+    ZERO_SHA = "0" * 40
+    COMMIT_RETRIES = 8
+    COMMIT_RETRY_BACKOFF = 0.01
+
+    def __init__(self, root, branch="main", replica=None):
+        self.root = Path(root)
+        self.branch = branch
+        self.replica = replica
+        self.ref = f"refs/heads/{branch}"
+        if not (self.root / "HEAD").exists():
+            self.root.mkdir(parents=True, exist_ok=True)
+            subprocess.run(
+                ["git", "init", "--bare", "--quiet", f"--initial-branch={branch}", str(self.root)],
+                check=True, capture_output=True,
+            )
+
+    def _git(self, *args, input=None, env=None, check=True):
+        result = subprocess.run(
+            ["git", "--git-dir", str(self.root), *args],
+            input=input, capture_output=True,
+            env={**os.environ, **(env or {})},
+        )
+        if check and result.returncode != 0:
+            raise StorageError(result.stderr.decode("utf-8", "replace").strip())
+        return result
+
+    def _head(self):
+        result = self._git("rev-parse", "--verify", "--quiet", self.ref, check=False)
+        return result.stdout.decode().strip() or None
+
+    def _ls_tree(self, treeish, path, *options):
+        output = self._git("ls-tree", "-z", *options, treeish, "--", path, check=False).stdout.decode("utf-8")
+        entries = []
+        for line in filter(None, output.split("\0")):
+            meta, entry_path = line.split("\t", 1)
+            _, object_type, sha = meta.split()
+            entries.append(StoredFile(entry_path, "dir" if object_type == "tree" else "file", sha))
+        return entries
+
+    def list(self, path):
+        head = self._head()
+        path = path.strip("/")
+        if head is None:
+            if path:
+                raise NotFound(path)
+            return []
+        if not path:
+            return self._ls_tree(head, ".")
+        entries = self._ls_tree(head, f"{path}/")
+        if not entries:
+            raise NotFound(path)
+        return entries
+
+    def walk(self, path):
+        head = self._head()
+        path = path.strip("/")
+        if head is None:
+            if path:
+                raise NotFound(path)
+            return []
+        # -r recurses into subtrees, -t still reports the subtrees themselves,
+        # and the folders leading to `path` too
+        entries = self._ls_tree(head, f"{path}/" if path else ".", "-r", "-t")
+        if path and not entries:
+            raise NotFound(path)
+        return [entry for entry in entries if entry.path.startswith(f"{path}/") or not path]
+
+    def read(self, path, sha=None):
+        head = self._head()
+        path = path.strip("/")
+        entries = self._ls_tree(head, path) if head else []
+        if len(entries) != 1 or entries[0].type != "file":
+            raise NotFound(path)
+        sha = entries[0].sha
+        content = self._git("cat-file", "blob", sha).stdout
+        return StoredFile(path, "file", sha, content)
+
+    def _commit(self, message, changes, expected=None):
+        index_info = []
+        for path, content in changes.items():
+            if content is None:
+                # Mode 0 removes the path from the index.
+                index_info.append(f"0 {self.ZERO_SHA}\t{path.strip('/')}")
+                continue
+            if isinstance(content, BlobRef):
+                index_info.append(f"100644 {content.sha}\t{path.strip('/')}")
+                continue
+            sha = self._git("hash-object", "-w", "--stdin", input=_to_bytes(content)).stdout.decode().strip()
+            index_info.append(f"100644 {sha}\t{path.strip('/')}")
+        # A commit that lost the race to another one is built again on top
+        # of it; only a change to an `expected` path conflicts.
+        for attempt in range(self.COMMIT_RETRIES + 1):
+            head = self._head()
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                env = {
+                    "GIT_INDEX_FILE": os.path.join(tmp_dir, "index"),
+                    "GIT_AUTHOR_NAME": "storage", "GIT_AUTHOR_EMAIL": "storage@localhost",
+                    "GIT_COMMITTER_NAME": "storage", "GIT_COMMITTER_EMAIL": "storage@localhost",
+                }
+                if head:
+                    self._git("read-tree", head, env=env)
+                for path, sha in (expected or {}).items():
+                    current = self._ls_tree(head, path) if head else []
+                    if (current[0].sha if current else None) != sha:
+                        raise Conflict(path)
+                self._git("update-index", "--index-info", input="\n".join(index_info).encode("utf-8"), env=env)
+                tree = self._git("write-tree", env=env).stdout.decode().strip()
+                parents = ["-p", head] if head else []
+                commit = self._git("commit-tree", tree, *parents, "-m", message, env=env).stdout.decode().strip()
+            result = self._git("update-ref", self.ref, commit, head or self.ZERO_SHA, check=False)
+            if result.returncode == 0:
+                break
+            if attempt == self.COMMIT_RETRIES:
+                raise Conflict(self.ref)
+            time.sleep(random.uniform(0, self.COMMIT_RETRY_BACKOFF * 2 ** attempt))
+        self._reflect(changes)
+        return commit
+
+    def write(self, path, message, content, sha=None):
+        self._commit(message, {path: content}, expected={path: sha})
+        return blob_sha(_to_bytes(content))
+
+    def delete(self, path, message, sha=None):
+        if sha is None:
+            sha = self.read(path).sha
+        self._commit(message, {path: None}, expected={path: sha})
+
+    def commit(self, message, changes, expected=None):
+        return self._commit(message, changes, expected)
+
+    def resolve(self, ref=None, before=None):
+        ref = ref or self.ref
+        if ref.startswith("-"):
+            raise NotFound(ref)
+        commit = self._git("rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}", check=False).stdout.decode().strip()
+        if commit and before is not None:
+            commit = self._git("rev-list", "-1", f"--before={before.isoformat()}", commit).stdout.decode().strip()
+        if not commit:
+            raise NotFound(ref if before is None else f"{ref} at {before.isoformat()}")
+        return commit
+
+    def history(self, paths, ref=None, limit=30):
+        commit = self.resolve(ref)
+        output = self._git(
+            "log", f"--max-count={limit}", "--format=%H%x1f%an%x1f%aI%x1f%B%x1e", commit,
+            "--", *(path.strip("/") for path in paths),
+        ).stdout.decode("utf-8")
+        commits = []
+        for record in filter(None, (record.strip("\n") for record in output.split("\x1e"))):
+            sha, author, date, message = record.split("\x1f", 3)
+            commits.append(_commit_entry(sha, message.strip(), author, datetime.datetime.fromisoformat(date)))
+        return commits
+
+    def tree(self, commit):
+        if self._git("cat-file", "-e", f"{commit}^{{tree}}", check=False).returncode != 0:
+            raise NotFound(commit)
+        return self._ls_tree(commit, ".", "-r", "-t")
+
+    def blob(self, sha):
+        result = self._git("cat-file", "blob", sha, check=False)
+        if result.returncode != 0:
+            raise NotFound(sha)
+        return result.stdout
+
+
+class ReplicaStorageEngine(StorageEngine):
+    """
+    Serves reads from the working tree of the local clone kept by `replica`.
+
+    Read only: the views that write use `get_storage_engine`, whose engine
+    applies its changes to the clone. Listings come from the clone's index.
+    Every read is served from the tree the first one was (see `replica`), so
+    `get_read_engine` makes one for each request.
+    """
+
+    def __init__(self, clone):
+        self.clone = clone
+        self.at = None
+
+    def _snapshot(self):
+        if self.at is None:
+            self.at = self.clone.snapshot()
+        return self.at
+
+    def _entries(self, path, recursive):
+        path = path.strip("/")
+        prefix = f"{path}/" if path else ""
+        entries = {}
+        for file_path, sha in self.clone.files(path, self._snapshot()).items():
+            parts = file_path[len(prefix):].split("/")
+            for depth in range(1, len(parts) if recursive else min(len(parts), 2)):
+                folder = prefix + "/".join(parts[:depth])
+                entries.setdefault(folder, StoredFile(folder, "dir"))
+            if recursive or len(parts) == 1:
+                entries[file_path] = StoredFile(file_path, "file", sha)
+        if path and not entries:
+            raise NotFound(path)
+        return [entries[entry_path] for entry_path in sorted(entries)]
+
+    def list(self, path):
+        return self._entries(path, recursive=False)
+
+    def walk(self, path):
+        return self._entries(path, recursive=True)
+
+    def read(self, path, sha=None):
+        path = path.strip("/")
+        content = self.clone.read(path, self._snapshot())
+        if content is None:
+            raise NotFound(path)
+        return StoredFile(path, "file", blob_sha(content), content)
+
+    def write(self, path, message, content, sha=None):
+        raise StorageError("The local replica is read only")
+
+    def delete(self, path, message, sha=None):
+        raise StorageError("The local replica is read only")
+
+    def commit(self, message, changes, expected=None):
+        raise StorageError("The local replica is read only")
+
+
+class SnapshotStorageEngine(StorageEngine):
+    """
+    Serves reads of the tree at one commit of `source` (see `history`).
+
+    Read only. Nothing at a commit ever changes, so its tree and the blobs
+    read from it are kept in the `ObjectCache` under their SHA and served
+    from there without asking `source` again.
+    """
+
+    def __init__(self, source, commit, cache=None):
+        self.source = source
+        self.commit_sha = commit
+        self.cache = cache
+        self._files = None
+
+    def _tree(self):
+        if self._files is None:
+            entries = self.cache.get(f"tree:{self.commit_sha}") if self.cache else None
+            if entries is None:
+                entries = self.source.tree(self.commit_sha)
+                if self.cache:
+                    size = sum(len(entry.path) + 48 for entry in entries)
+                    self.cache.put(f"tree:{self.commit_sha}", entries, size)
+            self._files = {entry.path: entry for entry in entries}
+        return self._files
+
+    def _entries(self, path, recursive):
+        path = path.strip("/")
+        files = self._tree()
+        if path and (path not in files or files[path].type != "dir"):
+            raise NotFound(path)
+        prefix = f"{path}/" if path else ""
+        return [
+            entry for entry_path, entry in sorted(files.items())
+            if entry_path.startswith(prefix) and (recursive or "/" not in entry_path[len(prefix):])
+        ]
+
+    def list(self, path):
+        return self._entries(path, recursive=False)
+
+    def walk(self, path):
+        return self._entries(path, recursive=True)
+
+    def read(self, path, sha=None):
+        path = path.strip("/")
+        entry = self._tree().get(path)
+        if entry is None or entry.type != "file":
+            raise NotFound(path)
+        content = self.cache.get(entry.sha) if self.cache else None
+        if content is None:
+            content = self.source.blob(entry.sha)
+            if self.cache:
+                self.cache.put(entry.sha, content, len(content))
+        return StoredFile(path, "file", entry.sha, content)
+
+    def write(self, path, message, content, sha=None):
+        raise StorageError("A snapshot is read only")
+
+    def delete(self, path, message, sha=None):
+        raise StorageError("A snapshot is read only")
+
+    def commit(self, message, changes, expected=None):
+        raise StorageError("A snapshot is read only")
+
+
+def get_storage_engine():
+    """Return the storage engine selected by the `STORAGE_ENGINE` setting."""
+    engine = settings.STORAGE_ENGINE
+    if engine == "github":
+        return GitHubStorageEngine(
+            client.get_repo(), settings.GITHUB_BRANCH, get_blob_cache(), get_catalog(), get_governor(), get_replica()
+        )
+    if engine == "local":
+        return LocalStorageEngine(settings.STORAGE_LOCAL_PATH)
+    if engine == "git":
+        git_engine = GitStorageEngine(settings.STORAGE_LOCAL_PATH, settings.GITHUB_BRANCH or "main")
+        # Only now: the clone fetches from the repository created above
+        git_engine.replica = get_replica()
+        return git_engine
+    raise StorageError(f"Unknown storage engine '{engine}'")
+
+
+def get_read_engine():
+    """
+    Return the engine of the read-only views: the local clone when
+    `STORAGE_REPLICA_PATH` is set and it synced, otherwise `get_storage_engine()`.
+    """
+    replica = get_replica()
+    if replica is not None and replica.ready:
+        return ReplicaStorageEngine(replica)
+    return get_storage_engine()
+
+
+def get_snapshot_engine(commit):
+    """Return a read-only engine serving the tree at `commit` of `get_storage_engine()`."""
+    return SnapshotStorageEngine(get_storage_engine(), commit, get_object_cache())
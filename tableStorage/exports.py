@@ -0,0 +1,177 @@
+"""
+Streamed exports of tables and databases.
+
+A table is exported as NDJSON (one row per line) or CSV (an "id" column and
+one column per field, dotted for nested objects, with arrays and objects as
+JSON), the two formats bulk imports read. A database is exported as a tar or
+zip archive holding `<database>/Schema/<table>.json` and
+`<database>/Tables/<table>.ndjson` for each of its tables, which can be
+imported back table by table.
+
+The response is produced as the files are read: segments are fetched ahead
+by up to `STORAGE_EXPORT_WORKERS` threads and handed out in order, so memory
+holds those segments and one chunk of output, whatever the size of the
+export. A tar entry starts with its size, so each table of a tar archive is
+spooled to a temporary file first; zip entries are streamed directly.
+"""
+import csv
+import json
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from django.conf import settings
+
+from .engines import NotFound
+from .indexes import schema_fields
+from .streaming import chunked, prefetch
+from .tables import schema_path, table_path
+from .wal import load_table
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+ARCHIVE_FORMATS = {"tar": "application/x-tar", "zip": "application/zip"}
+
+SPOOL_READ_BYTES = 64 * 1024
+
+
+def _csv_columns(fields, prefix=""):
+    columns = []
+    for field, field_type in fields.items():
+        if isinstance(field_type, dict):
+            columns.extend(_csv_columns(field_type, f"{prefix}{field}."))
+        else:
+            columns.append(prefix + field)
+    return columns
+
+
+def _csv_cell(row, path):
+    value = row
+    for part in path:
+        if not isinstance(value, dict) or part not in value:
+            return ""
+        value = value[part]
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+    return value
+
+
+class _Echo:
+    # csv.writer target handing back each encoded line.
+    def write(self, value):
+        return value
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def csv_lines(rows, schema):
+    fields = schema_fields(schema)
+    columns = ([] if "id" in fields else ["id"]) + _csv_columns(fields)
+    paths = [column.split(".") for column in columns]
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([_csv_cell(row, path) for path in paths])
+
+
+def export_table(table, schema, file_format):
+    """Yield the rows of `table` as bytes chunks in `file_format` (see `EXPORT_FORMATS`)."""
+    rows = table.rows(workers=settings.STORAGE_EXPORT_WORKERS)
+    if file_format == "csv":
+        return chunked(csv_lines(rows, schema))
+    return chunked(ndjson_lines(rows))
+
+
+def _database_tables(engine, database_name):
+    def load(table_name):
+        try:
+            schema = engine.read(schema_path(database_name, table_name)).decoded_content
+        except NotFound:
+            schema = None
+        return table_name, schema, load_table(engine, table_path(database_name, table_name), create=True)
+
+    # The next tables are read while the current one is being sent.
+    return prefetch(engine.list_tables(database_name), load, settings.STORAGE_EXPORT_WORKERS)
+
+
+def _tar_entry(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def _tar(engine, database_name):
+    mtime = int(time.time())
+    written = 0
+    for table_name, schema, table in _database_tables(engine, database_name):
+        if schema is not None:
+            entry = _tar_entry(f"{database_name}/Schema/{table_name}.json", len(schema), mtime)
+            yield entry + schema + tarfile.NUL * (-len(schema) % tarfile.BLOCKSIZE)
+            written += len(entry) + len(schema) + -len(schema) % tarfile.BLOCKSIZE
+        with tempfile.TemporaryFile() as spool:
+            for chunk in export_table(table, None, "ndjson"):
+                spool.write(chunk)
+            size = spool.tell()
+            spool.seek(0)
+            entry = _tar_entry(f"{database_name}/Tables/{table_name}.ndjson", size, mtime)
+            yield entry
+            while True:
+                data = spool.read(SPOOL_READ_BYTES)
+                if not data:
+                    break
+                yield data
+            yield tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+            written += len(entry) + size + -size % tarfile.BLOCKSIZE
+    # Two empty blocks end the archive, which is padded to whole records.
+    written += 2 * tarfile.BLOCKSIZE
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE + -written % tarfile.RECORDSIZE)
+
+
+class _Sink:
+    # Unseekable file that zipfile writes to; its output is collected and
+    # handed out by `drain`.
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def _zip(engine, database_name):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for table_name, schema, table in _database_tables(engine, database_name):
+            if schema is not None:
+                archive.writestr(f"{database_name}/Schema/{table_name}.json", schema)
+                yield sink.drain()
+            with archive.open(f"{database_name}/Tables/{table_name}.ndjson", "w", force_zip64=True) as entry:
+                for chunk in export_table(table, None, "ndjson"):
+                    entry.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+def export_database(engine, database_name, archive_format):
+    """Yield an archive of every table of the database as bytes chunks (see `ARCHIVE_FORMATS`)."""
+    if archive_format == "zip":
+        return chunked(_zip(engine, database_name))
+    return chunked(_tar(engine, database_name))
@@ -0,0 +1,539 @@
+"""
+A local stand-in for the parts of the GitHub REST API the storage engine uses.
+
+`FakeGitHub` keeps one repository (`owner/repo`, branch `main`) in memory and
+serves, on a local port:
+
+- the repository itself (`GET /repos/owner/repo`);
+- the contents API: files (inline up to `contents_max_bytes`, raw with the
+  `application/vnd.github.raw` media type, ETags and 304s), folder listings
+  (cut at `contents_max_entries`, as GitHub's are at 1000), creates, updates
+  and deletes, at the branch or at any commit (`ref`);
+- the git data API: the branch ref (fast-forward updates only), commits,
+  trees (recursive, and truncated past `tree_max_entries`) and blobs;
+- the commits API: a commit by SHA (abbreviated too) or branch, and the
+  history of the branch or of a commit, filtered by `path` and `until`.
+
+Point `GITHUB_API_URL` at `url` and `GITHUB_REPO` at `REPO_NAME` and the
+GitHub engine runs against it unchanged. It is used by the tests and by the
+`benchmark` management command, which is why it can also slow down and fail:
+
+- `latency` seconds are waited before every answer;
+- a share `conflict_rate` of writes is answered with a 409, as if another
+  writer had moved the file or the branch first;
+- a share `rate_limit_rate` of calls is answered with a secondary rate limit
+  (a 403 or a 429, with `Retry-After: retry_after`);
+- every answer carries the `x-ratelimit-*` headers of a quota of `quota`
+  calls per `quota_window` seconds, and once it is used up calls get the
+  primary rate limit 403 until the window resets.
+"""
+import base64
+import datetime
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from .engines import blob_sha
+
+REPO_NAME = "owner/repo"
+BRANCH = "main"
+
+_REPO_PATH = f"/repos/{REPO_NAME}"
+
+
+def _tree_sha(entries):
+    canonical = json.dumps(sorted(entries.items()), separators=(",", ":"))
+    return hashlib.sha1(f"tree {canonical}".encode("utf-8")).hexdigest()
+
+
+class _Repository:
+    # Content addressed like git: blobs, trees ({name: (type, sha)}) and
+    # commits, plus the branch head.
+
+    def __init__(self):
+        self.blobs = {}
+        self.trees = {}
+        self.commits = {}
+        self.head = self.commit(self.tree({}), [], "Initial commit")
+        self.lock = threading.Lock()
+
+    def blob(self, content):
+        sha = blob_sha(content)
+        self.blobs[sha] = content
+        return sha
+
+    def tree(self, entries):
+        sha = _tree_sha(entries)
+        self.trees[sha] = entries
+        return sha
+
+    def commit(self, tree, parents, message):
+        date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        sha = hashlib.sha1(f"commit {tree} {' '.join(parents)} {message} {len(self.commits)}".encode()).hexdigest()
+        self.commits[sha] = {"tree": tree, "parents": parents, "message": message, "date": date}
+        return sha
+
+    def resolve(self, ref):
+        """The commit SHA `ref` (a branch name or a commit SHA) points to, None if unknown."""
+        if not ref or ref in (BRANCH, f"heads/{BRANCH}", f"refs/heads/{BRANCH}"):
+            return self.head
+        if ref in self.commits:
+            return ref
+        matches = [sha for sha in self.commits if sha.startswith(ref)] if len(ref) >= 4 else []
+        return matches[0] if len(matches) == 1 else None
+
+    def lookup(self, tree, path):
+        """(type, sha) of `path` in `tree`; the root is ("tree", tree)."""
+        entry = ("tree", tree)
+        for name in filter(None, path.split("/")):
+            if entry[0] != "tree":
+                return None
+            entry = self.trees[entry[1]].get(name)
+            if entry is None:
+                return None
+        return entry
+
+    def update(self, tree, changes):
+        """The tree `tree` with `changes` ({path: blob SHA, or None to delete}) applied."""
+        entries = dict(self.trees[tree])
+        nested = {}
+        for path, sha in changes.items():
+            name, _, rest = path.strip("/").partition("/")
+            if rest:
+                nested.setdefault(name, {})[rest] = sha
+            elif sha is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = ("blob", sha)
+        for name, subchanges in nested.items():
+            current = entries.get(name)
+            subtree = current[1] if current is not None and current[0] == "tree" else self.tree({})
+            subtree = self.update(subtree, subchanges)
+            if self.trees[subtree]:
+                entries[name] = ("tree", subtree)
+            else:
+                entries.pop(name, None)  # git has no empty folders
+        return self.tree(entries)
+
+    def walk(self, tree, prefix="", recursive=True):
+        for name, (kind, sha) in sorted(self.trees[tree].items()):
+            yield prefix + name, kind, sha
+            if kind == "tree" and recursive:
+                yield from self.walk(sha, f"{prefix}{name}/")
+
+    def is_ancestor(self, ancestor, commit):
+        pending, seen = [commit], set()
+        while pending:
+            sha = pending.pop()
+            if sha == ancestor:
+                return True
+            if sha not in seen:
+                seen.add(sha)
+                pending.extend(self.commits[sha]["parents"])
+        return False
+
+
+class _Reply(Exception):
+    # Raised by a handler to answer with `status` and the JSON `body`.
+    def __init__(self, status, body=None, headers=None):
+        super().__init__(status)
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def github(self):
+        return self.server.github
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _handle(self, verb):
+        url = urlparse(self.path)
+        self.query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        self.base = f"http://{self.headers['Host']}{_REPO_PATH}"
+        length = int(self.headers.get("Content-Length") or 0)
+        self.input = json.loads(self.rfile.read(length) or b"{}") if length else {}
+        try:
+            self.github._before(verb, self)
+            with self.github.repository.lock:
+                reply = self._route(verb, unquote(url.path))
+        except _Reply as e:
+            reply = e
+        if reply.status != 304:
+            self.github._quota_headers(reply.headers)
+        if isinstance(reply.body, bytes):
+            self._send(reply.status, reply.body, "application/octet-stream", reply.headers)
+        else:
+            body = json.dumps(reply.body).encode("utf-8") if reply.body is not None else b""
+            self._send(reply.status, body, "application/json; charset=utf-8", reply.headers)
+
+    def _send(self, status, body, content_type, headers):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, verb, path):
+        if path == _REPO_PATH and verb == "GET":
+            return _Reply(200, self._repo())
+        if path.startswith(f"{_REPO_PATH}/contents"):
+            return self._contents(verb, path[len(f"{_REPO_PATH}/contents"):].strip("/"))
+        if path.startswith(f"{_REPO_PATH}/commits") and verb == "GET":
+            return self._commits(path[len(f"{_REPO_PATH}/commits"):].strip("/"))
+        if not path.startswith(f"{_REPO_PATH}/git/"):
+            raise _Reply(404, {"message": "Not Found"})
+        kind, _, rest = path[len(f"{_REPO_PATH}/git/"):].partition("/")
+        if kind in ("ref", "refs"):
+            return self._ref(verb, rest)
+        handler = {
+            ("GET", "commits"): self._get_commit, ("POST", "commits"): self._create_commit,
+            ("GET", "trees"): self._get_tree, ("POST", "trees"): self._create_tree,
+            ("GET", "blobs"): self._get_blob, ("POST", "blobs"): self._create_blob,
+        }.get((verb, kind))
+        if handler is None:
+            raise _Reply(404, {"message": "Not Found"})
+        return handler(rest)
+
+    # Repository and contents API
+
+    def _repo(self):
+        owner, name = REPO_NAME.split("/")
+        return {
+            "id": 1, "name": name, "full_name": REPO_NAME, "owner": {"login": owner},
+            "url": self.base, "default_branch": BRANCH, "private": True,
+        }
+
+    def _content(self, path, sha, size, inline=True):
+        data = {
+            "type": "file", "name": path.rsplit("/", 1)[-1], "path": path, "sha": sha, "size": size,
+            "url": f"{self.base}/contents/{path}",
+        }
+        if inline:
+            content = self.github.repository.blobs[sha]
+            if size > self.github.contents_max_bytes:
+                data.update(encoding="none", content="")
+            else:
+                data.update(encoding="base64", content=base64.b64encode(content).decode("ascii"))
+        return data
+
+    def _contents(self, verb, path):
+        repository = self.github.repository
+        if verb == "GET":
+            commit = repository.resolve(self.query.get("ref"))
+            if commit is None:
+                raise _Reply(404, {"message": "No commit found for the ref"})
+            tree = repository.commits[commit]["tree"]
+            entry = repository.lookup(tree, path)
+            if entry is None or (not path and not repository.trees[tree]):
+                # GitHub answers 404 for the root of an empty repository too
+                raise _Reply(404, {"message": "Not Found"})
+            kind, sha = entry
+            if kind == "tree":
+                listing = []
+                for name, (entry_kind, entry_sha) in sorted(repository.trees[sha].items()):
+                    entry_path = f"{path}/{name}" if path else name
+                    if entry_kind == "tree":
+                        listing.append({"type": "dir", "name": name, "path": entry_path, "sha": entry_sha, "size": 0,
+                                        "url": f"{self.base}/contents/{entry_path}"})
+                    else:
+                        size = len(repository.blobs[entry_sha])
+                        listing.append(self._content(entry_path, entry_sha, size, inline=False))
+                return _Reply(200, listing[:self.github.contents_max_entries])
+            etag = f'"{sha}"'
+            if self.headers.get("If-None-Match") == etag:
+                return _Reply(304, None, {"ETag": etag})
+            content = repository.blobs[sha]
+            if "raw" in (self.headers.get("Accept") or ""):
+                return _Reply(200, content, {"ETag": etag})
+            return _Reply(200, self._content(path, sha, len(content)), {"ETag": etag})
+
+        if self.query.get("branch", self.input.get("branch", BRANCH)) != BRANCH:
+            raise _Reply(404, {"message": "Branch not found"})
+        self.github._maybe_conflict()
+        entry = repository.lookup(repository.commits[repository.head]["tree"], path)
+        current = entry[1] if entry is not None and entry[0] == "blob" else None
+        sha = self.input.get("sha")
+        if verb == "PUT":
+            if current is not None and sha != current:
+                if sha is None:
+                    raise _Reply(422, {"message": "Invalid request.\n\n\"sha\" wasn't supplied."})
+                raise _Reply(409, {"message": f"{path} does not match {sha}"})
+            if current is None and sha is not None:
+                raise _Reply(404, {"message": "Not Found"})
+            content = base64.b64decode(self.input.get("content", ""))
+            new_sha = repository.blob(content)
+            commit = self._commit_change(path, new_sha, self.input.get("message", ""))
+            return _Reply(201 if current is None else 200, {
+                "content": self._content(path, new_sha, len(content), inline=False),
+                "commit": self._commit(commit),
+            })
+        if verb == "DELETE":
+            if current is None:
+                raise _Reply(404, {"message": "Not Found"})
+            if sha != current:
+                raise _Reply(409, {"message": f"{path} does not match {sha}"})
+            commit = self._commit_change(path, None, self.input.get("message", ""))
+            return _Reply(200, {"content": None, "commit": self._commit(commit)})
+        raise _Reply(405, {"message": "Method Not Allowed"})
+
+    def _commit_change(self, path, sha, message):
+        repository = self.github.repository
+        tree = repository.update(repository.commits[repository.head]["tree"], {path: sha})
+        repository.head = repository.commit(tree, [repository.head], message)
+        return repository.head
+
+    # Commits API
+
+    def _rest_commit(self, sha):
+        commit = self._commit(sha)
+        return {
+            "sha": sha, "url": f"{self.base}/commits/{sha}", "author": None, "committer": None,
+            "commit": {key: commit[key] for key in ("url", "message", "author", "committer", "tree")},
+            "parents": commit["parents"],
+        }
+
+    def _commits(self, ref):
+        repository = self.github.repository
+        if ref:
+            commit = repository.resolve(ref)
+            if commit is None:
+                raise _Reply(422, {"message": f"No commit found for SHA: {ref}"})
+            return _Reply(200, self._rest_commit(commit))
+        commit = repository.resolve(self.query.get("sha"))
+        if commit is None:
+            raise _Reply(404, {"message": "Not Found"})
+        path = self.query.get("path", "").strip("/")
+        until = self.query.get("until")
+        listed = []
+        while commit is not None:
+            entry = repository.commits[commit]
+            parent = entry["parents"][0] if entry["parents"] else None
+            parent_tree = repository.commits[parent]["tree"] if parent else repository.tree({})
+            changed = not path or repository.lookup(entry["tree"], path) != repository.lookup(parent_tree, path)
+            if changed and (until is None or entry["date"] <= until):
+                listed.append(commit)
+            commit = parent
+        per_page = int(self.query.get("per_page", 30))
+        page = int(self.query.get("page", 1))
+        return _Reply(200, [self._rest_commit(sha) for sha in listed[(page - 1) * per_page:page * per_page]])
+
+    # Git data API
+
+    def _commit(self, sha):
+        commit = self.github.repository.commits[sha]
+        person = {"name": "Storage", "email": "storage@example.com", "date": commit["date"]}
+        return {
+            "sha": sha, "url": f"{self.base}/git/commits/{sha}", "message": commit["message"],
+            "author": person, "committer": person,
+            "tree": {"sha": commit["tree"], "url": f"{self.base}/git/trees/{commit['tree']}"},
+            "parents": [{"sha": parent, "url": f"{self.base}/git/commits/{parent}"} for parent in commit["parents"]],
+        }
+
+    def _ref(self, verb, name):
+        if name.removeprefix("refs/") != f"heads/{BRANCH}":
+            raise _Reply(404, {"message": "Not Found"})
+        repository = self.github.repository
+        if verb == "PATCH":
+            self.github._maybe_conflict()
+            new_head = self.input.get("sha")
+            if new_head not in repository.commits:
+                raise _Reply(422, {"message": "Object does not exist"})
+            if not self.input.get("force") and not repository.is_ancestor(repository.head, new_head):
+                raise _Reply(422, {"message": "Update is not a fast forward"})
+            repository.head = new_head
+        elif verb != "GET":
+            raise _Reply(405, {"message": "Method Not Allowed"})
+        return _Reply(200, {
+            "ref": f"refs/heads/{BRANCH}", "url": f"{self.base}/git/refs/heads/{BRANCH}",
+            "object": {"sha": repository.head, "type": "commit", "url": f"{self.base}/git/commits/{repository.head}"},
+        })
+
+    def _get_commit(self, sha):
+        if sha not in self.github.repository.commits:
+            raise _Reply(404, {"message": "Not Found"})
+        return _Reply(200, self._commit(sha))
+
+    def _create_commit(self, _):
+        repository = self.github.repository
+        tree = self.input.get("tree")
+        parents = self.input.get("parents", [])
+        if tree not in repository.trees or any(parent not in repository.commits for parent in parents):
+            raise _Reply(422, {"message": "Object does not exist"})
+        return _Reply(201, self._commit(repository.commit(tree, parents, self.input.get("message", ""))))
+
+    def _tree(self, sha, recursive):
+        repository = self.github.repository
+        entries = []
+        for path, kind, entry_sha in repository.walk(sha, recursive=recursive):
+            entry = {"path": path, "mode": "040000" if kind == "tree" else "100644", "type": kind, "sha": entry_sha,
+                     "url": f"{self.base}/git/{kind}s/{entry_sha}"}
+            if kind == "blob":
+                entry["size"] = len(repository.blobs[entry_sha])
+            entries.append(entry)
+        limit = self.github.tree_max_entries
+        truncated = recursive and limit is not None and len(entries) > limit
+        return {"sha": sha, "url": f"{self.base}/git/trees/{sha}", "tree": entries[:limit] if truncated else entries,
+                "truncated": truncated}
+
+    def _get_tree(self, sha):
+        repository = self.github.repository
+        commit = repository.resolve(sha)
+        if commit is not None:
+            sha = repository.commits[commit]["tree"]
+        if sha not in repository.trees:
+            raise _Reply(404, {"message": "Not Found"})
+        return _Reply(200, self._tree(sha, recursive=self.query.get("recursive") not in (None, "", "0", "false")))
+
+    def _create_tree(self, _):
+        repository = self.github.repository
+        base_tree = self.input.get("base_tree") or repository.tree({})
+        if base_tree not in repository.trees:
+            raise _Reply(422, {"message": "Invalid base_tree"})
+        changes = {}
+        for element in self.input.get("tree", []):
+            path = element["path"]
+            if "content" in element:
+                changes[path] = repository.blob(element["content"].encode("utf-8"))
+            elif element.get("sha") is None:
+                if repository.lookup(base_tree, path) is None:
+                    raise _Reply(422, {"message": f"Path '{path}' not in tree"})
+                changes[path] = None
+            elif element["sha"] not in repository.blobs:
+                raise _Reply(422, {"message": "Object does not exist"})
+            else:
+                changes[path] = element["sha"]
+        return _Reply(201, self._tree(repository.update(base_tree, changes), recursive=False))
+
+    def _get_blob(self, sha):
+        content = self.github.repository.blobs.get(sha)
+        if content is None:
+            raise _Reply(404, {"message": "Not Found"})
+        return _Reply(200, {
+            "sha": sha, "size": len(content), "url": f"{self.base}/git/blobs/{sha}",
+            "content": base64.b64encode(content).decode("ascii"), "encoding": "base64",
+        })
+
+    def _create_blob(self, _):
+        content = self.input.get("content", "")
+        if self.input.get("encoding") == "base64":
+            content = base64.b64decode(content)
+        else:
+            content = content.encode("utf-8")
+        sha = self.github.repository.blob(content)
+        return _Reply(201, {"sha": sha, "url": f"{self.base}/git/blobs/{sha}"})
+
+
+class FakeGitHub:
+    def __init__(self, latency=0.0, conflict_rate=0.0, rate_limit_rate=0.0, retry_after=1, quota=5000,
+                 quota_window=3600, contents_max_bytes=1024 * 1024, contents_max_entries=1000, tree_max_entries=None,
+                 seed=None):
+        self.latency = latency
+        self.conflict_rate = conflict_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.quota = quota
+        self.quota_window = quota_window
+        self.contents_max_bytes = contents_max_bytes
+        self.contents_max_entries = contents_max_entries
+        self.tree_max_entries = tree_max_entries
+        self.repository = _Repository()
+        self.calls = 0
+        self.conflicts = 0
+        self.rate_limited = 0
+        self._used = 0
+        self._window_reset = time.time() + quota_window
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve on a free local port, from a background thread."""
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.github = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "conflicts": self.conflicts, "rate_limited": self.rate_limited}
+
+    def _before(self, verb, handler):
+        # Latency, quota and injected rate limits, before the call is served
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            if handler.headers.get("If-None-Match") is None:
+                now = time.time()
+                if now >= self._window_reset:
+                    self._used = 0
+                    self._window_reset = now + self.quota_window
+                if self._used >= self.quota:
+                    self.rate_limited += 1
+                    raise _Reply(403, {"message": "API rate limit exceeded for user."})
+                self._used += 1
+            if self.rate_limit_rate and self._random.random() < self.rate_limit_rate:
+                self.rate_limited += 1
+                status = self._random.choice((403, 429))
+                raise _Reply(status, {"message": "You have exceeded a secondary rate limit."},
+                             {"Retry-After": str(self.retry_after)})
+
+    def _maybe_conflict(self):
+        with self._lock:
+            if self.conflict_rate and self._random.random() < self.conflict_rate:
+                self.conflicts += 1
+                raise _Reply(409, {"message": "Conflict: the branch was updated meanwhile"})
+
+    def _quota_headers(self, headers):
+        with self._lock:
+            headers.update({
+                "X-RateLimit-Limit": str(self.quota),
+                "X-RateLimit-Remaining": str(max(0, self.quota - self._used)),
+                "X-RateLimit-Reset": str(int(self._window_reset)),
+                "X-RateLimit-Resource": "core",
+            })
@@ -0,0 +1,252 @@
+"""
+Rate-limit governor for the GitHub API.
+
+Every call the GitHub engine makes goes through one process wide governor:
+
+- It takes a token from a bucket refilled at `GITHUB_RATE_PER_SECOND` (up to
+  `GITHUB_RATE_BURST`), so bursts are spread out before GitHub's secondary
+  limits see them. Waiting calls are served by priority: interactive reads
+  first, then writes, then bulk work (imports, index builds; see `bulk`).
+- It keeps the quota reported by the `x-ratelimit-*` headers. Once fewer than
+  `GITHUB_RATE_RESERVE` requests remain, only interactive reads go on until
+  the quota resets.
+- A 403 or 429 rate limit answer pauses every call, for the `Retry-After` the
+  response asked for, until the quota resets, or with jittered exponential
+  backoff, and the call is retried up to `GITHUB_RATE_RETRIES` times.
+- A call that would wait longer than `GITHUB_RATE_MAX_WAIT` seconds
+  (`GITHUB_RATE_BULK_MAX_WAIT` for bulk work) fails at once with
+  `RateLimited`, which the views answer with a 429 and a `Retry-After`.
+"""
+import contextvars
+import heapq
+import itertools
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from github import GithubException, RateLimitExceededException
+
+from . import metrics
+from .aio import json_response
+
+INTERACTIVE, WRITE, BULK = 0, 1, 2
+PRIORITY_NAMES = ("interactive", "write", "bulk")
+
+_bulk = contextvars.ContextVar("storage_bulk", default=False)
+
+
+class RateLimited(Exception):
+    """The GitHub rate limit does not allow the call within the time it may wait."""
+
+    def __init__(self, retry_after):
+        retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f"GitHub rate limit reached, retry in {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+@contextmanager
+def bulk():
+    """Run the storage calls made in the block at bulk priority."""
+    token = _bulk.set(True)
+    try:
+        yield
+    finally:
+        _bulk.reset(token)
+
+
+def _lower(headers):
+    return {name.lower(): value for name, value in (headers or {}).items()}
+
+
+def is_rate_limited(error):
+    """Whether the `GithubException` is a primary or secondary rate limit answer."""
+    if error.status == 429 or isinstance(error, RateLimitExceededException):
+        return True
+    headers = _lower(error.headers)
+    return error.status == 403 and ("retry-after" in headers or headers.get("x-ratelimit-remaining") == "0")
+
+
+class RateLimitGovernor:
+    def __init__(self, rate, burst, reserve, max_wait, bulk_max_wait, retries, backoff):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.bulk_max_wait = bulk_max_wait
+        self.retries = retries
+        self.backoff = backoff
+        # Quota as last reported by GitHub; reset_at is a Unix time
+        self.remaining = None
+        self.limit = None
+        self.reset_at = None
+        self.calls = [0, 0, 0]
+        self.wait_seconds = [0.0, 0.0, 0.0]
+        self.max_wait_seconds = [0.0, 0.0, 0.0]
+        self.rate_limited_responses = 0
+        self.retried = 0
+        self.shed = 0
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._queue = []  # heap of (priority, arrival)
+        self._arrivals = itertools.count()
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _delay(self, priority, ahead, now):
+        # Seconds before a call with `ahead` calls queued before it may go
+        delay = self._paused_until - now
+        if self.rate:
+            delay = max(delay, (ahead + 1 - self._tokens) / self.rate)
+        if self.remaining is not None and self.remaining <= (0 if priority == INTERACTIVE else self.reserve):
+            reset_in = self.reset_at - time.time()
+            if reset_in > 0:
+                delay = max(delay, reset_in + 1)
+        return delay
+
+    def acquire(self, priority):
+        """Wait until a call at `priority` may go; raise `RateLimited` if that takes too long."""
+        max_wait = self.bulk_max_wait if priority == BULK else self.max_wait
+        started = time.monotonic()
+        entry = (priority, next(self._arrivals))
+        with self._cond:
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    ahead = sum(1 for queued in self._queue if queued < entry)
+                    delay = self._delay(priority, ahead, now)
+                    if delay <= 0:
+                        if self.rate:
+                            self._tokens -= 1
+                        break
+                    if now - started + delay > max_wait:
+                        self.shed += 1
+                        raise RateLimited(delay)
+                    self._cond.wait(delay)
+            finally:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+            waited = time.monotonic() - started
+            self.calls[priority] += 1
+            self.wait_seconds[priority] += waited
+            self.max_wait_seconds[priority] = max(self.max_wait_seconds[priority], waited)
+
+    def update(self, remaining, limit, reset_at):
+        """Take the quota reported by a response."""
+        with self._cond:
+            if self.reset_at is None or reset_at > self.reset_at:
+                self.remaining, self.limit, self.reset_at = remaining, limit, reset_at
+            elif reset_at == self.reset_at:
+                # Responses of concurrent calls come back in any order
+                self.remaining = min(self.remaining, remaining)
+            self._cond.notify_all()
+
+    def observe(self, headers):
+        """Take the quota from the `x-ratelimit-*` headers of a response."""
+        headers = _lower(headers)
+        try:
+            remaining = int(headers["x-ratelimit-remaining"])
+            reset_at = int(headers["x-ratelimit-reset"])
+            limit = int(headers.get("x-ratelimit-limit", -1))
+        except (KeyError, TypeError, ValueError):
+            return
+        self.update(remaining, limit, reset_at)
+
+    def _back_off(self, priority, attempt, error):
+        headers = _lower(error.headers)
+        reset_at = headers.get("x-ratelimit-reset")
+        if "retry-after" in headers:
+            delay = float(headers["retry-after"])
+        elif headers.get("x-ratelimit-remaining") == "0" and reset_at:
+            # Primary limit: nothing goes through before the reset
+            delay = int(reset_at) - time.time() + 1
+        else:
+            # Secondary limit without a hint
+            delay = self.backoff * 2 ** attempt
+        # Jitter, so paused callers do not all come back at the same moment
+        delay = max(delay, 0) + random.uniform(0, self.backoff)
+        max_wait = self.bulk_max_wait if priority == BULK else self.max_wait
+        with self._cond:
+            self.rate_limited_responses += 1
+            if attempt >= self.retries or delay > max_wait:
+                self.shed += 1
+                raise RateLimited(delay) from error
+            self.retried += 1
+            metrics.github_retry()
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    def call(self, function, write=False):
+        """Return `function()` once the governor lets the call go, retrying it on rate limit answers."""
+        priority = BULK if _bulk.get() else WRITE if write else INTERACTIVE
+        for attempt in itertools.count():
+            self.acquire(priority)
+            try:
+                return function()
+            except GithubException as e:
+                self.observe(e.headers)
+                if not is_rate_limited(e):
+                    raise
+                self._back_off(priority, attempt, e)
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "remaining": self.remaining,
+                "limit": self.limit,
+                "reset_in": max(0, round(self.reset_at - time.time())) if self.reset_at is not None else None,
+                "tokens": round(self._tokens, 2) if self.rate else None,
+                "queued": {
+                    name: sum(1 for queued in self._queue if queued[0] == priority)
+                    for priority, name in enumerate(PRIORITY_NAMES)
+                },
+                "paused_for": round(max(0.0, self._paused_until - now), 3),
+                "calls": dict(zip(PRIORITY_NAMES, self.calls)),
+                "wait_seconds": {name: round(seconds, 3) for name, seconds in zip(PRIORITY_NAMES, self.wait_seconds)},
+                "max_wait_seconds": {
+                    name: round(seconds, 3) for name, seconds in zip(PRIORITY_NAMES, self.max_wait_seconds)
+                },
+                "rate_limited_responses": self.rate_limited_responses,
+                "retried": self.retried,
+                "shed": self.shed,
+            }
+
+
+def rate_limited_response(error):
+    """The 429 answered for a request `RateLimited` turned away."""
+    response = json_response({"error": str(error), "retry_after": error.retry_after}, 429)
+    response["Retry-After"] = str(error.retry_after)
+    return response
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_governor(create=True):
+    """Return the process wide `RateLimitGovernor` (None before first use unless `create`)."""
+    global _governor
+    if _governor is None and create:
+        with _governor_lock:
+            if _governor is None:
+                _governor = RateLimitGovernor(
+                    settings.GITHUB_RATE_PER_SECOND,
+                    settings.GITHUB_RATE_BURST,
+                    settings.GITHUB_RATE_RESERVE,
+                    settings.GITHUB_RATE_MAX_WAIT,
+                    settings.GITHUB_RATE_BULK_MAX_WAIT,
+                    settings.GITHUB_RATE_RETRIES,
+                    settings.GITHUB_RATE_BACKOFF,
+                )
+    return _governor
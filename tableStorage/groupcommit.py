@@ -0,0 +1,115 @@
+"""
+Group commit for inserts.
+
+With `TABLE_GROUP_COMMIT_WINDOW` set, rows inserted into the same table are
+buffered in the worker process and written together as one commit. The first
+insert for a table opens a batch and becomes its leader: it waits for the
+window to pass (or for `TABLE_GROUP_COMMIT_MAX_ROWS` rows to pile up), then
+writes the whole batch. Every caller returns only once that commit is done,
+and sees its error if it failed. The rows of each commit and the time each
+insert waited for it are served as histograms on `/metrics`.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .tables import append_rows
+
+
+class _PendingBatch:
+    def __init__(self):
+        self.rows = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitter:
+    def __init__(self, window, max_rows):
+        self.window = window
+        self.max_rows = max_rows
+        self.queue_depth = 0
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.largest_batch = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def submit(self, engine, database_name, table_name, rows):
+        """Queue `rows` (ids already assigned) and wait until they are committed."""
+        key = (database_name, table_name)
+        submitted = time.monotonic()
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = _PendingBatch()
+            batch.rows.extend(rows)
+            self.queue_depth += len(rows)
+            if len(batch.rows) >= self.max_rows:
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                # Close the batch; later inserts start a new one.
+                del self._batches[key]
+                self.queue_depth -= len(batch.rows)
+            self._flush(engine, database_name, table_name, batch)
+        else:
+            batch.done.wait()
+        metrics.group_commit_wait(time.monotonic() - submitted)
+
+        if batch.error is not None:
+            raise batch.error
+
+    def _flush(self, engine, database_name, table_name, batch):
+        started = time.monotonic()
+        try:
+            append_rows(engine, database_name, table_name, batch.rows)
+        except Exception as e:
+            batch.error = e
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.flushes += 1
+                self.rows_flushed += len(batch.rows)
+                self.largest_batch = max(self.largest_batch, len(batch.rows))
+                self.flush_seconds += elapsed
+                self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            metrics.group_commit(len(batch.rows))
+            batch.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "window_seconds": self.window,
+                "max_rows": self.max_rows,
+                "queue_depth": self.queue_depth,
+                "flushes": self.flushes,
+                "rows_flushed": self.rows_flushed,
+                "average_batch_size": self.rows_flushed / self.flushes if self.flushes else 0,
+                "largest_batch": self.largest_batch,
+                "average_flush_seconds": self.flush_seconds / self.flushes if self.flushes else 0,
+                "max_flush_seconds": self.max_flush_seconds,
+            }
+
+
+_committer = None
+_committer_lock = threading.Lock()
+
+
+def get_group_committer():
+    """Return the process wide `GroupCommitter`, or None when group commit is off."""
+    global _committer
+    if not settings.TABLE_GROUP_COMMIT_WINDOW:
+        return None
+    if _committer is None:
+        with _committer_lock:
+            if _committer is None:
+                _committer = GroupCommitter(settings.TABLE_GROUP_COMMIT_WINDOW, settings.TABLE_GROUP_COMMIT_MAX_ROWS)
+    return _committer
@@ -0,0 +1,61 @@
+"""
+Point-in-time reads of the data repository.
+
+Every write of the GitHub and git engines is a commit, so the repository
+already holds every earlier version of every table. A read names the version
+with a `commit` (a SHA, possibly abbreviated, or a branch) or with `at`, a
+timestamp (ISO 8601, or seconds since the epoch) resolved to the last commit
+made on the branch by then. It is then served by a `SnapshotStorageEngine`
+pinned to that commit: the tree and the blobs it reads are cached by SHA in
+the `ObjectCache` and never revalidated, so reading the same version again
+costs no request at all. The local engine keeps no history and answers
+every such read with a `StorageError`.
+"""
+import datetime
+import re
+
+from django.utils.dateparse import parse_datetime
+
+from .engines import get_snapshot_engine, get_storage_engine
+from .tables import schema_path, segment_folder, table_path
+
+FULL_SHA = re.compile(r"[0-9a-f]{40}")
+
+
+class HistoryError(Exception):
+    """A version asked for by a request is not valid."""
+
+
+def parse_time(value):
+    """Return `value` (ISO 8601 or seconds since the epoch) as an aware datetime, UTC unless it says otherwise."""
+    try:
+        return datetime.datetime.fromtimestamp(float(value), datetime.timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        pass
+    try:
+        moment = parse_datetime(str(value))
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise HistoryError(f"'{value}' is not a timestamp")
+    return moment if moment.tzinfo is not None else moment.replace(tzinfo=datetime.timezone.utc)
+
+
+def resolve(engine, commit=None, at=None):
+    """Return the full SHA of the commit named by `commit` and/or `at` (see the module docstring)."""
+    if at is None and commit and FULL_SHA.fullmatch(commit):
+        return commit  # nothing to ask: it is missing, reads of it are not found
+    return engine.resolve(commit or None, parse_time(at) if at is not None else None)
+
+
+def snapshot_engine(commit=None, at=None):
+    """Return (engine, commit SHA): a read-only engine over the version named by `commit` and/or `at`."""
+    sha = resolve(get_storage_engine(), commit, at)
+    return get_snapshot_engine(sha), sha
+
+
+def table_history(engine, database_name, table_name, commit=None, limit=30):
+    """Return the newest `limit` commits changing the rows or the schema of a table, newest first."""
+    path = table_path(database_name, table_name)
+    paths = [path, segment_folder(path), schema_path(database_name, table_name)]
+    return engine.history(paths, commit or None, limit)
@@ -0,0 +1,310 @@
+"""
+Bulk imports of CSV and NDJSON uploads.
+
+The upload is read line by line and never held in memory as a whole. A first
+pass parses the rows, checks them against the table schema in batches, gives
+them ids and spools them to a temporary file; if any row is bad nothing is
+written and the errors are reported by line. A second pass appends the rows
+in chunks of about `TABLE_IMPORT_CHUNK_BYTES`, one table transaction (so one
+commit) per chunk, at the bulk priority of the rate-limit governor. Should a chunk fail, the ones before it stay written and
+the progress tells how many rows made it.
+
+CSV columns are field names, dotted for nested objects ("customer.name").
+Cells are converted to the type the schema gives the field; arrays and
+objects are written as JSON, and empty cells leave the field out.
+
+Progress of running and recent imports is kept per import id.
+"""
+import csv
+import json
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .governor import bulk
+from .tables import assign_ids, table_path, transact
+
+# Content type of the upload -> import format
+IMPORT_FORMATS = {
+    "text/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+
+VALIDATION_BATCH_ROWS = 1000
+MAX_REPORTED_ERRORS = 100
+KEPT_IMPORTS = 100
+
+
+class BulkImportError(Exception):
+    """The upload cannot be imported."""
+
+
+class InvalidRows(BulkImportError):
+    """Rows of the upload do not match the table schema."""
+
+    def __init__(self, rows, count):
+        super().__init__(f"{count} rows do not match the table schema")
+        self.rows = rows  # [{"line": ..., "errors": [...]}], the first ones only
+        self.count = count
+
+
+def import_format(content_type):
+    """Return the import format for the `content_type` of an upload, None if unsupported."""
+    return IMPORT_FORMATS.get((content_type or "").split(";")[0].strip().lower())
+
+
+def _text_lines(lines):
+    for number, line in enumerate(lines):
+        try:
+            text = line.decode("utf-8")
+        except UnicodeDecodeError:
+            raise BulkImportError(f"Line {number + 1} is not valid UTF-8")
+        yield text.lstrip("\ufeff") if number == 0 else text
+
+
+def _ndjson_rows(lines):
+    # (line number, row or None, parse error)
+    for number, line in enumerate(_text_lines(lines), 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line), None
+        except ValueError as e:
+            yield number, None, f"Invalid JSON: {e}"
+
+
+def _column_type(fields, column):
+    field_type = fields
+    for part in column.split("."):
+        if not isinstance(field_type, dict) or part not in field_type:
+            return None
+        field_type = field_type[part]
+    return field_type
+
+
+def _converter(field_type):
+    if field_type == "integer":
+        def convert(cell):
+            try:
+                return int(cell)
+            except ValueError:
+                return cell  # Reported by the validator
+        return convert
+    if field_type == "boolean":
+        values = {"true": True, "false": False, "1": True, "0": False}
+        return lambda cell: values.get(cell.strip().lower(), cell)
+    if field_type == "string" or field_type is None:
+        return lambda cell: cell
+
+    def convert(cell):
+        try:
+            return json.loads(cell)
+        except ValueError:
+            return cell
+    return convert
+
+
+def _csv_rows(lines, fields):
+    reader = csv.reader(_text_lines(lines))
+    header = next(reader, None)
+    if not header:
+        return
+    columns = []
+    for column in header:
+        field_type = "string" if column == "id" and "id" not in fields else _column_type(fields, column)
+        columns.append((column.split("."), _converter(field_type)))
+    try:
+        for cells in reader:
+            if not any(cells):
+                continue
+            if len(cells) > len(columns):
+                yield reader.line_num, None, f"{len(cells)} cells for {len(columns)} columns"
+                continue
+            row = {}
+            for (path, convert), cell in zip(columns, cells):
+                if cell == "":
+                    continue
+                target = row
+                for part in path[:-1]:
+                    target = target.setdefault(part, {})
+                    if not isinstance(target, dict):
+                        break
+                else:
+                    target[path[-1]] = convert(cell)
+            yield reader.line_num, row, None
+    except csv.Error as e:
+        raise BulkImportError(f"Line {reader.line_num}: {e}")
+
+
+class BulkImport:
+    def __init__(self, import_id, database_name, table_name, import_format):
+        self.id = import_id
+        self.database_name = database_name
+        self.table_name = table_name
+        self.format = import_format
+        self.state = "validating"
+        self.rows_read = 0
+        self.rows_invalid = 0
+        self.rows_written = 0
+        self.commits = 0
+        self.error = None
+        self.started_at = time.time()
+        self.seconds = 0.0
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def status(self):
+        with self._lock:
+            return {
+                "import_id": self.id,
+                "database_name": self.database_name,
+                "table_name": self.table_name,
+                "format": self.format,
+                "state": self.state,
+                "rows_read": self.rows_read,
+                "rows_invalid": self.rows_invalid,
+                "rows_written": self.rows_written,
+                "commits": self.commits,
+                "error": self.error,
+                "started_at": self.started_at,
+                "seconds": self.seconds if self.state in ("done", "failed") else time.monotonic() - self._started,
+            }
+
+    def _set(self, **values):
+        with self._lock:
+            for name, value in values.items():
+                setattr(self, name, value)
+            if values.get("state") in ("done", "failed"):
+                self.seconds = time.monotonic() - self._started
+
+    def run(self, engine, validator, lines):
+        """Import the rows of the upload `lines` (bytes), checked by `validator`."""
+        try:
+            with tempfile.TemporaryFile() as spool:
+                self._validate(validator, lines, spool)
+                self._set(state="writing")
+                spool.seek(0)
+                with bulk():
+                    self._write(engine, spool)
+        except Exception as e:
+            self._set(state="failed", error=str(e))
+            raise
+        self._set(state="done")
+
+    def _validate(self, validator, lines, spool):
+        parse = _csv_rows(lines, validator.fields) if self.format == "csv" else _ndjson_rows(lines)
+        errors = []
+        invalid = 0
+        batch = []
+
+        def check(batch):
+            nonlocal invalid
+            rows = [row for _, row in batch]
+            bad = {error["index"]: error["errors"] for error in validator.errors(rows)}
+            good = [row for index, row in enumerate(rows) if index not in bad]
+            for index, row_errors in bad.items():
+                invalid += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({"line": batch[index][0], "errors": row_errors})
+            if not invalid:
+                assign_ids(good)
+                spool.writelines(json.dumps(row, separators=(",", ":")).encode("utf-8") + b"\n" for row in good)
+            with self._lock:
+                self.rows_read += len(batch)
+                self.rows_invalid = invalid
+
+        for line, row, parse_error in parse:
+            if parse_error is not None:
+                invalid += 1
+                with self._lock:
+                    self.rows_read += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({"line": line, "errors": [parse_error]})
+                continue
+            batch.append((line, row))
+            if len(batch) >= VALIDATION_BATCH_ROWS:
+                check(batch)
+                batch = []
+        if batch:
+            check(batch)
+        errors.sort(key=lambda error: error["line"])
+        self._set(rows_invalid=invalid)
+        if invalid:
+            raise InvalidRows(errors, invalid)
+        if not self.rows_read:
+            raise BulkImportError("The upload holds no rows")
+
+    def _write(self, engine, spool):
+        chunk_bytes = settings.TABLE_IMPORT_CHUNK_BYTES
+        path = table_path(self.database_name, self.table_name)
+        chunk = []
+        size = 0
+        for line in spool:
+            chunk.append(json.loads(line))
+            size += len(line)
+            if size >= chunk_bytes:
+                self._append(engine, path, chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            self._append(engine, path, chunk)
+
+    def _append(self, engine, path, rows):
+        transact(
+            engine, path, lambda table: table.append(rows),
+            f"Imported {len(rows)} rows into table {self.table_name}", create=True,
+        )
+        with self._lock:
+            self.rows_written += len(rows)
+            self.commits += 1
+
+
+class ImportTracker:
+    """Running imports and the last `KEPT_IMPORTS` finished ones, by import id."""
+
+    def __init__(self):
+        self._imports = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, database_name, table_name, import_format, import_id=None):
+        """Register a new import; raise `BulkImportError` if `import_id` is still running."""
+        import_id = import_id or str(uuid.uuid4())
+        with self._lock:
+            running = self._imports.get(import_id)
+            if running is not None and running.state in ("validating", "writing"):
+                raise BulkImportError(f"Import '{import_id}' is still running")
+            bulk_import = self._imports[import_id] = BulkImport(import_id, database_name, table_name, import_format)
+            self._imports.move_to_end(import_id)
+            finished = [key for key, value in self._imports.items() if value.state in ("done", "failed")]
+            for key in finished[:max(0, len(finished) - KEPT_IMPORTS)]:
+                del self._imports[key]
+        return bulk_import
+
+    def get(self, import_id):
+        with self._lock:
+            return self._imports.get(import_id)
+
+    def stats(self):
+        with self._lock:
+            imports = list(self._imports.values())
+        return [bulk_import.status() for bulk_import in imports]
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_import_tracker():
+    """Return the process wide `ImportTracker`."""
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = ImportTracker()
+    return _tracker
@@ -0,0 +1,116 @@
+"""
+Secondary indexes declared in table schemas.
+
+A schema may list indexes under the reserved "_indexes" key, next to its
+fields:
+
+    {
+        "customer": {"id": "string"},
+        "total": "integer",
+        "_indexes": [
+            {"field": "customer.id"},
+            {"field": "total", "type": "sorted"}
+        ]
+    }
+
+"hash" indexes (the default) answer equality lookups; "sorted" ones keep the
+smallest and largest value of each segment and answer ranges too. A field is
+a dotted path through nested objects and arrays of the schema. How the
+indexes are stored and kept up to date is up to `tables.Table`.
+"""
+import json
+
+INDEXES_KEY = "_indexes"
+INDEX_TYPES = ("hash", "sorted")
+
+
+def schema_fields(schema):
+    """Return the schema without its index declarations."""
+    return {field: field_type for field, field_type in schema.items() if field != INDEXES_KEY}
+
+
+def declared_indexes(schema):
+    """Return {field: index type} for the indexes declared in `schema`."""
+    return {
+        declaration["field"]: declaration.get("type", "hash")
+        for declaration in schema.get(INDEXES_KEY) or []
+    }
+
+
+def _resolve(fields, path):
+    field_type = fields
+    for part in path.split("."):
+        if isinstance(field_type, list) and len(field_type) == 1 and isinstance(field_type[0], dict):
+            field_type = field_type[0]  # Array of objects, index the items
+        if not isinstance(field_type, dict) or part not in field_type:
+            return None
+        field_type = field_type[part]
+    return field_type
+
+
+def validate_indexes(schema):
+    """Raise `ValueError` unless the index declarations of `schema` are valid."""
+    declarations = schema.get(INDEXES_KEY)
+    if declarations is None:
+        return
+    if not isinstance(declarations, list):
+        raise ValueError(f"'{INDEXES_KEY}' should be a list of indexes")
+    fields = schema_fields(schema)
+    seen = set()
+    for declaration in declarations:
+        if not isinstance(declaration, dict) or not isinstance(declaration.get("field"), str):
+            raise ValueError(f"Every index in '{INDEXES_KEY}' needs a \"field\"")
+        field = declaration["field"]
+        if "/" in field or _resolve(fields, field) is None:
+            raise ValueError(f"Index field '{field}' is not in the schema")
+        if declaration.get("type", "hash") not in INDEX_TYPES:
+            raise ValueError(f"Invalid index type '{declaration['type']}' for field '{field}'")
+        if field in seen:
+            raise ValueError(f"Field '{field}' is indexed twice")
+        seen.add(field)
+
+
+def field_values(row, field):
+    """Return the values at dotted path `field` of `row`, looking into arrays."""
+    values = [row]
+    for part in field.split("."):
+        found = []
+        for value in values:
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, dict) and part in item:
+                    found.append(item[part])
+        values = found
+    # An array field stands for each of its items.
+    return [item for value in values for item in (value if isinstance(value, list) else [value])]
+
+
+def value_key(value):
+    """Return the key `value` is stored under in a hash index."""
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+def value_range(values):
+    """Return [smallest, largest] of `values`, or None if they do not compare."""
+    try:
+        return [min(values), max(values)]
+    except TypeError:
+        return None
+
+
+def range_may_match(value_range, op, value):
+    """Whether a segment whose values span `value_range` may satisfy `op value`."""
+    if value_range is None:
+        return True
+    low, high = value_range
+    try:
+        if op == "eq":
+            return low <= value <= high
+        if op == "in":
+            return any(low <= item <= high for item in value)
+        if op == "lt":
+            return low < value
+        if op == "gt":
+            return high > value
+    except TypeError:
+        return True
+    return True
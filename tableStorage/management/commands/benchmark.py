@@ -0,0 +1,319 @@
+"""
+Benchmark of the API endpoints against a local fake GitHub server.
+
+    python manage.py benchmark --sizes 10,1000,100000 --concurrency 1,8 --output before.json
+    python manage.py benchmark --sizes 10,1000,100000 --concurrency 1,8 --compare before.json
+
+For each table size a table of that many rows is loaded (with a bulk import,
+not timed), then every endpoint is driven `--requests` times at each
+concurrency: database create and delete, table create, rename and delete,
+schema update, and row insert, read by id, query, update and delete. The
+requests go through the Django test client, in process; the storage calls go
+over HTTP to `FakeGitHub` (see `fakegithub`), which can add latency, 409
+conflicts and rate limit answers. `--engine local` or `git` measures those
+engines instead.
+
+The results are written as JSON, one entry per operation, table size and
+concurrency with latency percentiles, throughput, statuses and the GitHub
+calls each request took. `--compare` matches them against an earlier run and
+fails if a median latency grew by more than `--threshold`.
+"""
+import datetime
+import json
+import logging
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import override_settings
+
+from tableStorage import client
+from tableStorage.engines import get_storage_engine
+from tableStorage.fakegithub import REPO_NAME, FakeGitHub
+from tableStorage.imports import get_import_tracker
+from tableStorage.schemas import get_row_validator
+from tableStorage.tables import schema_path
+
+DATABASE = "bench"
+SCHEMA = {"name": "string", "qty": "integer", "tags": ["string"]}
+RESULTS_VERSION = 1
+
+
+def _int_list(value):
+    try:
+        return [int(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        raise CommandError(f"Expected a comma separated list of numbers, got '{value}'")
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Benchmark the API endpoints against a local fake GitHub server and write the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=_int_list, default=[10, 1000, 100000, 1000000],
+                            help="Table sizes in rows (default: 10,1000,100000,1000000)")
+        parser.add_argument("--concurrency", type=_int_list, default=[1, 4, 16],
+                            help="Concurrent clients (default: 1,4,16)")
+        parser.add_argument("--requests", type=int, default=20, help="Requests per endpoint and case (default: 20)")
+        parser.add_argument("--engine", choices=["fake", "local", "git"], default="fake",
+                            help="Storage behind the API: the fake GitHub server (default) or a local engine")
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake server waits per call")
+        parser.add_argument("--conflict-rate", type=float, default=0.0,
+                            help="Share of writes the fake server answers with a 409")
+        parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                            help="Share of calls the fake server answers with a rate limit")
+        parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of the injected rate limits")
+        parser.add_argument("--quota", type=int, default=10 ** 9, help="Calls per hour of the fake server")
+        parser.add_argument("--github-rate", type=float, default=0,
+                            help="GITHUB_RATE_PER_SECOND of the governor (default: 0, no spreading of bursts)")
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the injected faults and request data")
+        parser.add_argument("--output", default="-", help="File the JSON results go to (default: stdout)")
+        parser.add_argument("--compare", help="Results of an earlier run to compare with")
+        parser.add_argument("--threshold", type=float, default=0.1,
+                            help="Median latency growth reported as a regression (default: 0.1)")
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.random = random.Random(options["seed"])
+        self._local = threading.local()
+        # Failed requests (conflicts, rate limits) are counted in the results, not logged
+        logging.getLogger("django.request").setLevel(logging.CRITICAL)
+
+        fake = None
+        with tempfile.TemporaryDirectory() as storage_root:
+            overrides = {"ALLOWED_HOSTS": ["testserver"]}
+            if options["engine"] == "fake":
+                fake = FakeGitHub(
+                    latency=options["latency"], conflict_rate=options["conflict_rate"],
+                    rate_limit_rate=options["rate_limit_rate"], retry_after=options["retry_after"],
+                    quota=options["quota"], seed=options["seed"],
+                ).start()
+                overrides.update(STORAGE_ENGINE="github", GITHUB_API_URL=fake.url, GITHUB_REPO=REPO_NAME,
+                                 GITHUB_TOKEN="benchmark", GITHUB_BRANCH=None,
+                                 GITHUB_RATE_PER_SECOND=options["github_rate"])
+            else:
+                overrides.update(STORAGE_ENGINE=options["engine"], STORAGE_LOCAL_PATH=f"{storage_root}/storage")
+            self.fake = fake
+            try:
+                with override_settings(**overrides):
+                    client.reset()
+                    results = self._run()
+            finally:
+                client.reset()
+                if fake is not None:
+                    fake.stop()
+
+        output = json.dumps(results, indent=2)
+        if options["output"] == "-":
+            self.stdout.write(output)
+        else:
+            with open(options["output"], "w", encoding="utf-8") as output_file:
+                output_file.write(output + "\n")
+            self.stderr.write(f"Results written to {options['output']}")
+        if options["compare"]:
+            self._compare(results)
+
+    def _run(self):
+        options = self.options
+        results = {
+            "version": RESULTS_VERSION,
+            "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "options": {name: options[name] for name in (
+                "sizes", "concurrency", "requests", "engine", "latency", "conflict_rate", "rate_limit_rate",
+                "retry_after", "quota", "github_rate", "seed",
+            )},
+            "seeding": [],
+            "results": [],
+        }
+        self._request("POST", "/database/folders/", {"database_name": DATABASE})
+        for size in options["sizes"]:
+            results["seeding"].append(self._seed(size))
+            for concurrency in options["concurrency"]:
+                results["results"].extend(self._cases(size, concurrency))
+        return results
+
+    def _client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = Client()
+        return self._local.client
+
+    def _request(self, method, url, data):
+        response = self._client().generic(method, url, json.dumps(data), content_type="application/json")
+        return response.status_code, (response.json() if response.get("Content-Type") == "application/json" else None)
+
+    def _calls(self):
+        return self.fake.stats() if self.fake is not None else None
+
+    def _seed(self, size):
+        table_name = f"rows_{size}"
+        self.stderr.write(f"Loading {size} rows into {DATABASE}/{table_name}")
+        status_code, body = self._request(
+            "POST", "/table/table/", {"database_name": DATABASE, "table_name": table_name, "schema": SCHEMA}
+        )
+        if status_code != 201:
+            raise CommandError(f"Could not create table {table_name}: {body}")
+        calls = self._calls()
+        started = time.perf_counter()
+        engine = get_storage_engine()
+        validator = get_row_validator(engine, schema_path(DATABASE, table_name))
+        bulk_import = get_import_tracker().start(DATABASE, table_name, "ndjson")
+        lines = (
+            json.dumps({"id": f"r{i}", "name": f"row {i}", "qty": i, "tags": ["a", "b"]}).encode("utf-8") + b"\n"
+            for i in range(size)
+        )
+        bulk_import.run(engine, validator, lines)
+        seconds = time.perf_counter() - started
+        return {
+            "rows": size,
+            "seconds": round(seconds, 3),
+            "commits": bulk_import.commits,
+            "github_calls": self._calls()["calls"] - calls["calls"] if calls else None,
+        }
+
+    def _cases(self, size, concurrency):
+        # Each operation works on what the ones before it created
+        count = self.options["requests"]
+        table = f"rows_{size}"
+        prefix = f"{size}_{concurrency}"
+        inserted = []
+        inserted_lock = threading.Lock()
+
+        def insert(i):
+            status_code, body = self._request("POST", "/table/table-data/", {
+                "database_name": DATABASE, "table_name": table, "data": {"name": f"new {i}", "qty": i},
+            })
+            if status_code == 201:
+                with inserted_lock:
+                    inserted.extend(body["ids"])
+            return status_code
+
+        ids = [f"r{self.random.randrange(size)}" for _ in range(count)] if size else []
+        cases = [
+            ("database.create", lambda i: self._request(
+                "POST", "/database/folders/", {"database_name": f"{DATABASE}_{prefix}_{i}"})[0]),
+            ("table.create", lambda i: self._request("POST", "/table/table/", {
+                "database_name": DATABASE, "table_name": f"t_{prefix}_{i}", "schema": SCHEMA})[0]),
+            ("schema.update", lambda i: self._request("POST", "/table/schema/", {
+                "database_name": DATABASE, "table_name": f"t_{prefix}_{i}",
+                "schema": {**SCHEMA, "note": "string"}})[0]),
+            ("table.rename", lambda i: self._request("PUT", "/table/table/", {
+                "database_name": DATABASE, "old_table_name": f"t_{prefix}_{i}",
+                "new_table_name": f"r_{prefix}_{i}"})[0]),
+            ("data.insert", insert),
+            ("data.read", lambda i: self._request("GET", "/table/table-data/", {
+                "database_name": DATABASE, "table_name": table, "id": ids[i % len(ids)]})[0]),
+            ("data.query", lambda i: self._request("GET", "/table/table-data/", {
+                "database_name": DATABASE, "table_name": table, "filter": {"qty": {"gt": size // 2}},
+                "limit": 10})[0]),
+            ("data.update", lambda i: self._request("PUT", "/table/table-data/", {
+                "database_name": DATABASE, "table_name": table, "id": ids[i % len(ids)],
+                "data": {"name": f"updated {i}", "qty": i}})[0]),
+            ("data.delete", lambda i: self._request("DELETE", "/table/table-data/", {
+                "database_name": DATABASE, "table_name": table, "ids": inserted[i:i + 1]})[0]
+                if i < len(inserted) else 404),
+            ("table.delete", lambda i: self._request("DELETE", "/table/tables/", {
+                "database_name": DATABASE, "table_name": f"r_{prefix}_{i}"})[0]),
+            ("database.delete", lambda i: self._request(
+                "DELETE", "/database/folders/", {"database_name": f"{DATABASE}_{prefix}_{i}"})[0]),
+        ]
+        results = []
+        for operation, request in cases:
+            if not ids and operation in ("data.read", "data.update"):
+                continue
+            results.append(self._measure(operation, request, size, concurrency, count))
+            result = results[-1]
+            self.stderr.write(
+                f"{operation:16} rows={size:<8} concurrency={concurrency:<3} "
+                f"p50={result['latency_ms']['p50']:.1f}ms p99={result['latency_ms']['p99']:.1f}ms "
+                f"errors={result['errors']}"
+            )
+        return results
+
+    def _measure(self, operation, request, size, concurrency, count):
+        calls = self._calls()
+        latencies = [None] * count
+        statuses = Counter()
+
+        def timed(i):
+            started = time.perf_counter()
+            try:
+                status_code = request(i)
+            except Exception as e:
+                status_code = type(e).__name__
+            latencies[i] = time.perf_counter() - started
+            return status_code
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            for status_code in executor.map(timed, range(count)):
+                statuses[str(status_code)] += 1
+        seconds = time.perf_counter() - started
+        after = self._calls()
+        ordered = sorted(latencies)
+        return {
+            "operation": operation,
+            "rows": size,
+            "concurrency": concurrency,
+            "requests": count,
+            "errors": sum(number for status_code, number in statuses.items()
+                          if not status_code.isdigit() or int(status_code) >= 400),
+            "statuses": dict(statuses),
+            "seconds": round(seconds, 4),
+            "throughput": round(count / seconds, 2) if seconds else None,
+            "latency_ms": {
+                "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+                "p50": round(_percentile(ordered, 0.5) * 1000, 2),
+                "p90": round(_percentile(ordered, 0.9) * 1000, 2),
+                "p99": round(_percentile(ordered, 0.99) * 1000, 2),
+                "max": round(ordered[-1] * 1000, 2),
+            },
+            "github_calls_per_request": round((after["calls"] - calls["calls"]) / count, 2) if calls else None,
+            "conflicts": after["conflicts"] - calls["conflicts"] if calls else None,
+            "rate_limited": after["rate_limited"] - calls["rate_limited"] if calls else None,
+        }
+
+    def _compare(self, results):
+        with open(self.options["compare"], encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        before = {(case["operation"], case["rows"], case["concurrency"]): case for case in baseline["results"]}
+        regressions = 0
+        self.stderr.write(f"Compared with {baseline.get('commit') or self.options['compare']}:")
+        for case in results["results"]:
+            old = before.get((case["operation"], case["rows"], case["concurrency"]))
+            if old is None or not old["latency_ms"]["p50"]:
+                continue
+            change = case["latency_ms"]["p50"] / old["latency_ms"]["p50"] - 1
+            regressed = change > self.options["threshold"]
+            regressions += regressed
+            self.stderr.write(
+                f"{'REGRESSED ' if regressed else ''}{case['operation']} rows={case['rows']} "
+                f"concurrency={case['concurrency']}: p50 {old['latency_ms']['p50']:.1f}ms -> "
+                f"{case['latency_ms']['p50']:.1f}ms ({change:+.0%})"
+            )
+        if regressions:
+            raise CommandError(f"{regressions} cases are slower than in {self.options['compare']}")
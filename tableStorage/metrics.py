@@ -0,0 +1,344 @@
+"""
+Instrumentation of storage operations and the requests that make them.
+
+Every engine operation (list, walk, read, write, delete, commit) is measured
+as a whole: latency, bytes read and written, the cache result and the GitHub
+calls and rate-limit retries it took. An operation started from within
+another one (a delete reading the file first) is part of the outer one. Each
+operation is logged at DEBUG level on the `tableStorage.metrics` logger.
+
+`StorageMetricsMiddleware` adds up the operations of each request into a
+`Server-Timing` header (one entry per operation name, one for the GitHub calls
+and the total) and records the request per endpoint, so that the slowest and
+most expensive endpoints stand out. Everything is served in the Prometheus
+text format by `render()` (the `/metrics` endpoint).
+"""
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CALLS_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+ROWS_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+_operation = contextvars.ContextVar("storage_operation", default=None)
+_request = contextvars.ContextVar("storage_request", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _label_text(self, labels, extra=()):
+        pairs = list(zip(self.labels, labels)) + list(extra)
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{self._label_text(labels)} {_number(value)}"
+
+
+class Histogram(Counter):
+    def __init__(self, name, help, labels, buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, labels, value):
+        series = self._values.get(labels)
+        if series is None:
+            # Counts per bucket (not cumulative), then sum and count
+            series = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket{self._label_text(labels, [('le', _number(bound))])} {cumulative}"
+            yield f"{self.name}_bucket{self._label_text(labels, [('le', '+Inf')])} {series[-1]}"
+            yield f"{self.name}_sum{self._label_text(labels)} {_number(series[-2])}"
+            yield f"{self.name}_count{self._label_text(labels)} {series[-1]}"
+
+
+_lock = threading.Lock()
+operation_seconds = Histogram(
+    "storage_operation_seconds", "Latency of storage operations.", ("operation",)
+)
+operation_bytes = Counter(
+    "storage_operation_bytes_total", "Bytes read (in) and written (out) by storage operations.",
+    ("operation", "direction"),
+)
+operation_errors = Counter(
+    "storage_operation_errors_total", "Storage operations that raised.", ("operation", "error")
+)
+cache_results = Counter("storage_cache_results_total", "Reads by cache result.", ("result",))
+github_calls = Counter("storage_github_calls_total", "GitHub API calls by storage operation.", ("operation",))
+github_retries = Counter(
+    "storage_github_retries_total", "GitHub calls retried after a rate limit answer.", ("operation",)
+)
+request_seconds = Histogram(
+    "http_request_duration_seconds", "Latency of requests per endpoint.", ("endpoint", "method")
+)
+request_storage_seconds = Histogram(
+    "http_request_storage_seconds", "Time requests spent in storage operations, per endpoint.",
+    ("endpoint", "method"),
+)
+request_github_calls = Histogram(
+    "http_request_github_calls", "GitHub API calls made per request, per endpoint.",
+    ("endpoint", "method"), CALLS_BUCKETS,
+)
+requests_total = Counter("http_requests_total", "Requests per endpoint and status.", ("endpoint", "method", "status"))
+group_commit_rows = Histogram(
+    "storage_group_commit_rows", "Rows written per group commit.", (), ROWS_BUCKETS
+)
+group_commit_wait_seconds = Histogram(
+    "storage_group_commit_wait_seconds", "Time inserts waited for the group commit holding their rows.", ()
+)
+
+METRICS = (
+    operation_seconds, operation_bytes, operation_errors, cache_results, github_calls, github_retries,
+    request_seconds, request_storage_seconds, request_github_calls, requests_total,
+    group_commit_rows, group_commit_wait_seconds,
+)
+
+
+class Operation:
+    __slots__ = ("name", "path", "bytes_in", "bytes_out", "cache", "calls", "call_seconds", "retries")
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cache = None
+        self.calls = 0
+        self.call_seconds = 0.0
+        self.retries = 0
+
+
+class RequestTimings:
+    """Totals of the storage operations of one request."""
+
+    def __init__(self):
+        self.operations = {}  # name -> [count, seconds]
+        self.seconds = 0.0
+        self.calls = 0
+        self.call_seconds = 0.0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def add(self, operation, seconds):
+        with self._lock:
+            totals = self.operations.setdefault(operation.name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            self.seconds += seconds
+            self.calls += operation.calls
+            self.call_seconds += operation.call_seconds
+            self.retries += operation.retries
+
+    def server_timing(self, total_seconds):
+        with self._lock:
+            entries = [
+                f'{name};dur={seconds * 1000:.1f};desc="{count} op{"s" if count != 1 else ""}"'
+                for name, (count, seconds) in self.operations.items()
+            ]
+            if self.calls:
+                retries = f", {self.retries} retried" if self.retries else ""
+                entries.append(f'github;dur={self.call_seconds * 1000:.1f};desc="{self.calls} calls{retries}"')
+            entries.append(f"storage;dur={self.seconds * 1000:.1f}")
+        entries.append(f"total;dur={total_seconds * 1000:.1f}")
+        return ", ".join(entries)
+
+
+@contextmanager
+def operation(name, path):
+    """
+    Measure the storage operation `name` on `path` run in the block, yielding
+    its `Operation` (None when it is part of an outer one).
+    """
+    if _operation.get() is not None:
+        # Part of the operation already being measured
+        yield None
+        return
+    current = Operation(name, path)
+    token = _operation.set(current)
+    started = time.perf_counter()
+    error = None
+    try:
+        yield current
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        _operation.reset(token)
+        _record(current, seconds, error)
+
+
+def _record(current, seconds, error):
+    with _lock:
+        operation_seconds.observe((current.name,), seconds)
+        if current.bytes_in:
+            operation_bytes.inc((current.name, "in"), current.bytes_in)
+        if current.bytes_out:
+            operation_bytes.inc((current.name, "out"), current.bytes_out)
+        if error is not None:
+            operation_errors.inc((current.name, error))
+        if current.cache is not None:
+            cache_results.inc((current.cache,))
+        if current.calls:
+            github_calls.inc((current.name,), current.calls)
+        if current.retries:
+            github_retries.inc((current.name,), current.retries)
+    timings = _request.get()
+    if timings is not None:
+        timings.add(current, seconds)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "%s %s %.1f ms in=%d out=%d cache=%s calls=%d retries=%d%s",
+            current.name, current.path, seconds * 1000, current.bytes_in, current.bytes_out,
+            current.cache or "-", current.calls, current.retries, f" error={error}" if error else "",
+        )
+
+
+def note(**values):
+    """Set `values` (bytes_in, bytes_out, cache) on the operation being measured, if any."""
+    current = _operation.get()
+    if current is not None:
+        for name, value in values.items():
+            setattr(current, name, value)
+
+
+def github_call(seconds):
+    """Count a GitHub API call (with the time it waited for the governor) of the current operation."""
+    current = _operation.get()
+    if current is None:
+        with _lock:
+            github_calls.inc(("none",))
+        return
+    current.calls += 1
+    current.call_seconds += seconds
+
+
+def github_retry():
+    """Count a GitHub call retried after a rate limit answer."""
+    current = _operation.get()
+    if current is None:
+        with _lock:
+            github_retries.inc(("none",))
+        return
+    current.retries += 1
+
+
+def group_commit(rows):
+    """Record a group commit of `rows` rows."""
+    with _lock:
+        group_commit_rows.observe((), rows)
+
+
+def group_commit_wait(seconds):
+    """Record how long an insert waited, from its submission, for its group commit to be done."""
+    with _lock:
+        group_commit_wait_seconds.observe((), seconds)
+
+
+@contextmanager
+def measure_request():
+    """Collect the storage operations run in the block into the `RequestTimings` yielded."""
+    timings = RequestTimings()
+    token = _request.set(timings)
+    try:
+        yield timings
+    finally:
+        _request.reset(token)
+
+
+def render(samples=()):
+    """
+    All metrics in the Prometheus text format, followed by the values read
+    elsewhere in `samples`: (name, "gauge" or "counter", help, [(labels, value)]).
+    """
+    lines = []
+    with _lock:
+        for metric in METRICS:
+            lines.extend(metric.render())
+    for name, kind, help, values in samples:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in values:
+            label_text = ",".join(f'{label}="{_escape(label_value)}"' for label, label_value in labels.items())
+            lines.append(f"{name}{{{label_text}}} {_number(value)}" if label_text else f"{name} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class StorageMetricsMiddleware:
+    """Times each request and its storage operations (see the module docstring)."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self._acall(request)
+        started = time.perf_counter()
+        with measure_request() as timings:
+            response = self.get_response(request)
+        return self._finish(request, response, timings, time.perf_counter() - started)
+
+    async def _acall(self, request):
+        started = time.perf_counter()
+        with measure_request() as timings:
+            response = await self.get_response(request)
+        return self._finish(request, response, timings, time.perf_counter() - started)
+
+    def _finish(self, request, response, timings, seconds):
+        match = request.resolver_match
+        endpoint = "/" + match.route if match is not None and match.route else "unmatched"
+        labels = (endpoint, request.method)
+        with _lock:
+            request_seconds.observe(labels, seconds)
+            request_storage_seconds.observe(labels, timings.seconds)
+            request_github_calls.observe(labels, timings.calls)
+            requests_total.inc((endpoint, request.method, str(response.status_code)))
+        # Streamed responses are timed up to their first byte
+        response["Server-Timing"] = timings.server_timing(seconds)
+        return response
@@ -0,0 +1,191 @@
+"""
+Filter, projection, sort and limit for table reads.
+
+A query comes with a `TableData.get` request:
+
+    {
+        "filter": {"status": "open", "total": {"gt": 100}, "tags": {"contains": "gift"}},
+        "fields": ["id", "total", "customer.name"],
+        "sort": ["-created_at", "total"],
+        "limit": 50
+    }
+
+Filter values are either a plain value (equality) or an object of operators:
+eq, ne, lt, gt, in and contains. Fields are dotted paths into nested objects
+and arrays of objects; a condition on an array holds when it holds for one of
+its items, and "contains" also matches substrings of strings. "-" in front
+of a sort field sorts it in descending order.
+
+The query is compiled once into plain functions and the rows are filtered in
+a single pass as they are decoded; with a limit, sorting keeps only that many
+rows in memory. Without sort the rows come out as they are read, which is
+what streamed responses rely on. Conditions a secondary index can answer
+narrow the segments that are read in the first place.
+"""
+import functools
+import heapq
+import itertools
+import json
+
+from .indexes import value_key
+
+OPERATORS = ("eq", "ne", "lt", "gt", "in", "contains")
+
+
+class QueryError(ValueError):
+    """The query in the request is malformed."""
+
+
+def _getter(field):
+    parts = field.split(".")
+
+    def get(row):
+        # The values found at `field`; arrays of objects are looked into.
+        values = [row]
+        for part in parts:
+            found = []
+            for value in values:
+                for item in value if isinstance(value, list) else [value]:
+                    if isinstance(item, dict) and part in item:
+                        found.append(item[part])
+            values = found
+        return values
+
+    return get
+
+
+def _items(values):
+    return [item for value in values for item in (value if isinstance(value, list) else [value])]
+
+
+def _compare(value, other, op):
+    try:
+        return value < other if op == "lt" else value > other
+    except TypeError:
+        return False
+
+
+def _keys(values):
+    return {value_key(value) for value in values}
+
+
+def _test(op, operand):
+    # Equality goes by the same key the hash indexes use, so True is not 1
+    # and a filter answers the same with or without an index.
+    if op == "eq":
+        key = value_key(operand)
+        return lambda values: key in _keys(values) or key in _keys(_items(values))
+    if op == "ne":
+        key = value_key(operand)
+        return lambda values: key not in _keys(values) and key not in _keys(_items(values))
+    if op in ("lt", "gt"):
+        return lambda values: any(_compare(item, operand, op) for item in _items(values))
+    if op == "in":
+        if not isinstance(operand, list):
+            raise QueryError("The 'in' operator needs a list of values")
+        keys = _keys(operand)
+        return lambda values: not keys.isdisjoint(_keys(_items(values)))
+    if op == "contains":
+        key = value_key(operand)
+        def contains(values):
+            for value in values:
+                if isinstance(value, list) and key in _keys(value):
+                    return True
+                if isinstance(value, str) and isinstance(operand, str) and operand in value:
+                    return True
+            return False
+        return contains
+    raise QueryError(f"Unknown operator '{op}', use one of: {', '.join(OPERATORS)}")
+
+
+def _sort_value(values):
+    # Missing values sort last; numbers, strings and anything else apart.
+    if not values:
+        return (1, 0, 0)
+    value = values[0]
+    if isinstance(value, (int, float)):
+        return (0, 0, value)
+    if isinstance(value, str):
+        return (0, 1, value)
+    return (0, 2, json.dumps(value, sort_keys=True))
+
+
+def _projector(fields):
+    tree = {}
+    for field in fields:
+        node = tree
+        for part in field.split("."):
+            node = node.setdefault(part, {})
+
+    def project(value, node):
+        if not node:
+            return value
+        if isinstance(value, list):
+            return [project(item, node) for item in value]
+        if isinstance(value, dict):
+            return {key: project(value[key], child) for key, child in node.items() if key in value}
+        return value
+
+    return lambda row: project(row, tree)
+
+
+class Query:
+    def __init__(self, filters=None, fields=None, sort=None, limit=None):
+        if filters is not None and not isinstance(filters, dict):
+            raise QueryError("Filter should be an object of field names and conditions")
+        if fields is not None and not (isinstance(fields, list) and all(isinstance(f, str) for f in fields)):
+            raise QueryError("Fields should be a list of field names")
+        if isinstance(sort, str):
+            sort = [sort]
+        if sort is not None and not (isinstance(sort, list) and all(isinstance(s, str) and s.strip("-") for s in sort)):
+            raise QueryError("Sort should be a list of field names")
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 0):
+            raise QueryError("Limit should be a non-negative integer")
+
+        self.conditions = []  # (field, op, operand)
+        for field, condition in (filters or {}).items():
+            if isinstance(condition, dict) and condition and all(key in OPERATORS for key in condition):
+                self.conditions.extend((field, op, operand) for op, operand in condition.items())
+            else:
+                self.conditions.append((field, "eq", condition))
+        self._tests = [(_getter(field), _test(op, operand)) for field, op, operand in self.conditions]
+        self._sort = [(_getter(key.lstrip("-")), key.startswith("-")) for key in sort or []]
+        self._project = _projector(fields) if fields else None
+        self.limit = limit
+
+    @classmethod
+    def from_request(cls, data):
+        return cls(data.get("filter"), data.get("fields"), data.get("sort"), data.get("limit"))
+
+    def matches(self, row):
+        return all(test(get(row)) for get, test in self._tests)
+
+    def project(self, row):
+        return self._project(row) if self._project else row
+
+    def _compare_rows(self, row, other):
+        for get, descending in self._sort:
+            a, b = _sort_value(get(row)), _sort_value(get(other))
+            if a != b:
+                if a[0] != b[0]:
+                    return -1 if a < b else 1  # Missing values last either way
+                return (1 if a < b else -1) if descending else (-1 if a < b else 1)
+        return 0
+
+    def run(self, table):
+        """Return the rows of `table` answering the query."""
+        return list(self.iter(table))
+
+    def iter(self, table):
+        """Yield the rows of `table` answering the query."""
+        rows = (row for row in table.scan(self.conditions) if self.matches(row))
+        if self._sort:
+            key = functools.cmp_to_key(self._compare_rows)
+            if self.limit is not None:
+                rows = heapq.nsmallest(self.limit, rows, key=key)
+            else:
+                rows = sorted(rows, key=key)
+        elif self.limit is not None:
+            rows = itertools.islice(rows, self.limit)
+        for row in rows:
+            yield self.project(row)
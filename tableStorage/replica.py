@@ -0,0 +1,459 @@
+"""
+Local clone of the data repository, serving the read-only endpoints.
+
+With `STORAGE_REPLICA_PATH` set, each worker process keeps a git clone of the
+data repository there (from `STORAGE_REPLICA_URL`, by default the repository
+the storage engine writes to). The table, schema and table listing reads and
+the database listing are served from its working tree instead of the network
+(see `engines.get_read_engine`); segments of `STORAGE_REPLICA_MMAP_MIN_BYTES`
+and more are memory-mapped rather than read.
+
+Writes still go to the storage engine, which hands every change it made to
+`Replica.apply` as soon as it is committed: the files are written to the
+working tree and the index right away, so the worker reads its own writes.
+Every `STORAGE_REPLICA_SYNC_INTERVAL` seconds (and on demand, see
+`views.ReplicaSync`) the clone fetches the branch and resets to it, keeping
+only the changes applied after the fetch started, which it may not include.
+
+Reads share the working tree, a reset or an applied change has it to itself.
+Each state of the working tree is also a git tree (the commit synced to, or
+the index written as a tree after an apply), and a read can ask for the
+state it started at: while the working tree is still at it, the file is read
+from there, otherwise from the git objects of that tree. This is how one
+`ReplicaStorageEngine` serves a table's manifest and its segments from the
+same tree even when a sync or a write lands in between.
+
+Every response served from the clone says how stale it may be
+(`ReplicaMiddleware`): `X-Replica-Commit` (the commit it was read at),
+`X-Replica-Behind` (commits the branch had beyond that commit when it was
+last fetched), `X-Replica-Own-Writes` (this worker's own writes since that
+commit, whose files it includes) and `X-Replica-Age` (seconds since the last
+sync). Writes of other workers since the last fetch are not known until the
+next one.
+
+The replica is started when the app loads (see `apps`), and its first sync
+runs in the background like the later ones: until it succeeds, reads go to
+the storage engine (`engines.get_read_engine`), so no request waits on it.
+"""
+import base64
+import contextlib
+import contextvars
+import mmap
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+_served = contextvars.ContextVar("replica_served", default=None)
+
+
+class ReplicaError(Exception):
+    """A git command on the clone failed."""
+
+
+class Snapshot:
+    """What a read from the clone was served at."""
+
+    __slots__ = ("commit", "commits", "own_writes", "synced_at", "tree")
+
+    def __init__(self, commit, own_writes, synced_at, tree=None, commits=0):
+        self.commit = commit
+        self.commits = commits  # in the history of `commit`
+        self.own_writes = own_writes
+        self.synced_at = synced_at  # monotonic time of the sync, None if never synced
+        self.tree = tree  # git tree of the working tree then, None if empty
+
+    def age(self):
+        return time.monotonic() - self.synced_at if self.synced_at is not None else None
+
+
+class _SharedLock:
+    """Held by many readers or by one writer; a waiting writer keeps new readers out."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._condition:
+            self._condition.wait_for(lambda: not self._writing and not self._writers_waiting)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._condition:
+            self._writers_waiting += 1
+            self._condition.wait_for(lambda: not self._writing and not self._readers)
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class Replica:
+    def __init__(self, path, url, branch="main", interval=0, mmap_min_bytes=None, auth_header=None):
+        self.path = Path(path)
+        self.url = url
+        self.branch = branch
+        self.interval = interval
+        self.mmap_min_bytes = mmap_min_bytes
+        self.auth_header = auth_header
+        self.head = None
+        self.head_commits = 0  # in the history of `head`
+        self.remote_head = None  # of the branch, as last fetched
+        self.remote_commits = 0
+        self.tree = None  # git tree of the working tree (see the module docstring)
+        self.synced_at = None
+        self.syncs = 0
+        self.failures = 0
+        self.commits_fetched = 0
+        self.last_sync_seconds = None
+        self.last_error = None
+        self.reads = 0
+        self.mapped_reads = 0
+        self._applied = []  # [(monotonic time, {path: content or None})] since the last sync
+        self._lock = threading.RLock()  # state and counters
+        self._tree_lock = _SharedLock()  # working tree and index
+        self._sync_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _git(self, *args, input=None, remote=False, check=True):
+        env = dict(os.environ)
+        if remote and self.auth_header:
+            # From the environment, so the token is neither stored in the
+            # clone's config nor shown in the process list
+            env.update(GIT_CONFIG_COUNT="1", GIT_CONFIG_KEY_0="http.extraHeader", GIT_CONFIG_VALUE_0=self.auth_header)
+        result = subprocess.run(["git", "-C", str(self.path), *args], input=input, capture_output=True, env=env)
+        if check and result.returncode != 0:
+            raise ReplicaError(result.stderr.decode("utf-8", "replace").strip())
+        return result
+
+    @property
+    def ready(self):
+        """Whether the clone synced at least once and may serve reads."""
+        return self.synced_at is not None
+
+    def start(self, wait=True):
+        """
+        Create the clone if needed, sync it once and start the scheduled
+        syncs. Without `wait` the first sync runs in the background as well.
+        """
+        if not (self.path / ".git").exists():
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._git("init", "--quiet", f"--initial-branch={self.branch}")
+            self._git("remote", "add", "origin", self.url)
+        if wait:
+            self._try_sync()
+        if (self.interval or not wait) and self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(not wait,), name="replica-sync", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _try_sync(self):
+        try:
+            self.sync()
+        except ReplicaError:
+            # Counted in `failures`; reads go to the storage engine until a
+            # sync succeeded, and the next one is tried on schedule
+            pass
+
+    def _run(self, first):
+        if first:
+            self._try_sync()
+        while self.interval and not self._stop.wait(self.interval):
+            self._try_sync()
+
+    def sync(self):
+        """Fetch the branch and move the clone to it; return the number of new commits."""
+        with self._sync_lock:
+            started = time.monotonic()
+            remote_ref = f"refs/remotes/origin/{self.branch}"
+            fetch = self._git(
+                "fetch", "--quiet", "--no-tags", "origin", f"+refs/heads/{self.branch}:{remote_ref}",
+                remote=True, check=False,
+            )
+            if fetch.returncode != 0:
+                error = fetch.stderr.decode("utf-8", "replace").strip()
+                if "couldn't find remote ref" not in error:
+                    with self._lock:
+                        self.failures += 1
+                        self.last_error = error
+                    raise ReplicaError(error)
+                # The branch does not exist yet: nothing to fetch
+                remote_head = None
+            else:
+                remote_head = self._git("rev-parse", remote_ref).stdout.decode().strip()
+            remote_commits = self.remote_commits
+            if remote_head is not None and remote_head != self.remote_head:
+                remote_commits = int(self._git("rev-list", "--count", remote_head).stdout)
+            with self._lock:
+                # Known to reads from now on, even those of the tree synced before
+                self.remote_head = remote_head
+                self.remote_commits = remote_commits
+            with self._tree_lock.exclusive(), self._lock:
+                fetched = 0
+                if remote_head is not None:
+                    if remote_head != self.head:
+                        since = f"{self.head}..{remote_head}" if self.head is not None else remote_head
+                        fetched = int(self._git("rev-list", "--count", since).stdout)
+                        self._git("reset", "--quiet", "--hard", remote_head)
+                        self.head = remote_head
+                        self.head_commits = remote_commits
+                        self.tree = remote_head
+                    # Changes applied since the fetch started may be missing from it
+                    self._applied = [applied for applied in self._applied if applied[0] >= started]
+                    if fetched:
+                        for _, changes in self._applied:
+                            self._write(changes)
+                self.syncs += 1
+                self.commits_fetched += fetched
+                self.synced_at = started
+                self.last_sync_seconds = time.monotonic() - started
+                self.last_error = None
+            return fetched
+
+    def _write(self, changes):
+        changes = {
+            # A `BlobRef` the commit moved: the clone holds the blob already
+            path: self._git("cat-file", "blob", content.sha).stdout
+            if content is not None and not isinstance(content, (str, bytes)) else content
+            for path, content in changes.items()
+        }
+        for path, content in changes.items():
+            full_path = self.path / path.strip("/")
+            if content is None:
+                if full_path.is_file():
+                    full_path.unlink()
+                    # Folders only exist while they hold files, as in git
+                    parent = full_path.parent
+                    while parent != self.path and not any(parent.iterdir()):
+                        parent.rmdir()
+                        parent = parent.parent
+                continue
+            full_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=full_path.parent, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(content.encode("utf-8") if isinstance(content, str) else content)
+            os.replace(tmp_path, full_path)
+        self._git("update-index", "--add", "--remove", "--", *(path.strip("/") for path in changes))
+        self.tree = self._git("write-tree").stdout.decode().strip()
+
+    def apply(self, changes):
+        """Reflect `changes` ({path: content or None}) the storage engine just committed."""
+        with self._tree_lock.exclusive(), self._lock:
+            self._write(changes)
+            self._applied.append((time.monotonic(), dict(changes)))
+
+    def snapshot(self):
+        """The current state of the working tree, for reads to ask for with `at`."""
+        with self._lock:
+            return Snapshot(self.head, len(self._applied), self.synced_at, self.tree, self.head_commits)
+
+    def behind(self, snapshot):
+        """Commits the branch had beyond the commit of `snapshot` when it was last fetched."""
+        with self._lock:
+            return max(self.remote_commits - snapshot.commits, 0)
+
+    def _serve(self, snapshot):
+        # Note what the current request read at (see `ReplicaMiddleware`)
+        served = _served.get()
+        if served is not None:
+            served.append(snapshot)
+
+    @contextlib.contextmanager
+    def _reading(self, at):
+        # Yields whether the working tree is at `at` (always, without `at`),
+        # and keeps it there meanwhile
+        with self._tree_lock.shared():
+            current = at is None or at.tree == self.tree
+            self._serve(at if at is not None else self.snapshot())
+            yield current
+
+    def files(self, folder, at=None):
+        """Return {path: blob SHA} of the files below `folder` ("" for all), as they were `at` a snapshot."""
+        folder = folder.strip("/")
+        pathspec = f"{folder}/" if folder else "."
+        with self._reading(at) as current:
+            if current:
+                output = self._git("ls-files", "--stage", "-z", "--", pathspec).stdout
+            elif at.tree is None:
+                output = b""
+            else:
+                output = self._git("ls-tree", "-r", "-z", at.tree, "--", pathspec).stdout
+        files = {}
+        for line in filter(None, output.decode("utf-8").split("\0")):
+            meta, path = line.split("\t", 1)
+            # "mode sha stage" from ls-files, "mode type sha" from ls-tree
+            files[path] = meta.split()[1 if current else 2]
+        return files
+
+    def read(self, path, at=None):
+        """
+        Return the content of `path` in the working tree, memory-mapped for
+        large row segments, or as it was `at` a snapshot (None if there is no
+        such file).
+        """
+        path = path.strip("/")
+        mapped = False
+        with self._reading(at) as current:
+            if current:
+                content, mapped = self._read_file(self.path / path)
+            elif at.tree is not None:
+                result = self._git("cat-file", "blob", f"{at.tree}:{path}", check=False)
+                content = result.stdout if result.returncode == 0 else None
+            else:
+                content = None
+        if content is None:
+            return None
+        with self._lock:
+            self.reads += 1
+            self.mapped_reads += 1 if mapped else 0
+        return content
+
+    def _read_file(self, full_path):
+        # (content, whether it is memory-mapped) of a file of the working tree
+        try:
+            with open(full_path, "rb") as file:
+                size = os.fstat(file.fileno()).st_size
+                mapped = bool(self.mmap_min_bytes) and size >= self.mmap_min_bytes and full_path.suffix == ".ndjson"
+                # The mapping stays valid when a sync replaces the file
+                return (mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if mapped else file.read()), mapped
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None, False
+
+    def stats(self):
+        with self._lock:
+            snapshot = Snapshot(self.head, len(self._applied), self.synced_at, commits=self.head_commits)
+            age = snapshot.age()
+            return {
+                "path": str(self.path),
+                "branch": self.branch,
+                "commit": self.head,
+                "remote_commit": self.remote_head,
+                "behind": self.behind(snapshot),
+                "own_writes": snapshot.own_writes,
+                "age_seconds": round(age, 3) if age is not None else None,
+                "sync_interval": self.interval,
+                "syncs": self.syncs,
+                "failures": self.failures,
+                "commits_fetched": self.commits_fetched,
+                "last_sync_seconds": round(self.last_sync_seconds, 3) if self.last_sync_seconds is not None else None,
+                "last_error": self.last_error,
+                "reads": self.reads,
+                "mapped_reads": self.mapped_reads,
+            }
+
+
+def clone_url():
+    """The repository the storage engine writes to, as a git remote."""
+    if settings.STORAGE_REPLICA_URL:
+        return settings.STORAGE_REPLICA_URL
+    if settings.STORAGE_ENGINE == "git":
+        return settings.STORAGE_LOCAL_PATH
+    api = urlparse(settings.GITHUB_API_URL)
+    if api.netloc == "api.github.com":
+        return f"https://github.com/{settings.GITHUB_REPO}.git"
+    # GitHub Enterprise serves the API under /api/v3
+    return f"{api.scheme}://{api.netloc}/{settings.GITHUB_REPO}.git"
+
+
+def _auth_header(url):
+    if not settings.GITHUB_TOKEN or not url.startswith(("https://", "http://")):
+        return None
+    credentials = base64.b64encode(f"x-access-token:{settings.GITHUB_TOKEN}".encode("utf-8")).decode("ascii")
+    return f"Authorization: Basic {credentials}"
+
+
+_replica = None
+_replica_lock = threading.Lock()
+
+
+def get_replica(create=True):
+    """Return the process wide `Replica`, or None when `STORAGE_REPLICA_PATH` is not set."""
+    global _replica
+    if not settings.STORAGE_REPLICA_PATH or settings.STORAGE_ENGINE == "local":
+        return None
+    if _replica is None and create:
+        with _replica_lock:
+            if _replica is None:
+                url = clone_url()
+                _replica = Replica(
+                    settings.STORAGE_REPLICA_PATH, url, settings.GITHUB_BRANCH or "main",
+                    settings.STORAGE_REPLICA_SYNC_INTERVAL, settings.STORAGE_REPLICA_MMAP_MIN_BYTES,
+                    _auth_header(url),
+                ).start(wait=False)
+    return _replica
+
+
+class ReplicaMiddleware:
+    """Adds the staleness of what a request read from the clone to its response (see the module docstring)."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self._acall(request)
+        served = []
+        token = _served.set(served)
+        try:
+            response = self.get_response(request)
+        finally:
+            _served.reset(token)
+        return self._finish(response, served)
+
+    async def _acall(self, request):
+        served = []
+        token = _served.set(served)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _served.reset(token)
+        return self._finish(response, served)
+
+    def _finish(self, response, served):
+        if served:
+            # The stalest read of the request
+            snapshot = min(served, key=lambda snapshot: snapshot.synced_at or 0)
+            age = snapshot.age()
+            if snapshot.commit:
+                response["X-Replica-Commit"] = snapshot.commit
+            replica = get_replica(create=False)
+            if replica is not None:
+                response["X-Replica-Behind"] = str(max(replica.behind(read) for read in served))
+            response["X-Replica-Own-Writes"] = str(max(read.own_writes for read in served))
+            response["X-Replica-Age"] = f"{age:.1f}" if age is not None else ""
+        return response
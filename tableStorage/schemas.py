@@ -0,0 +1,181 @@
+"""
+Table schemas and the rows they allow.
+
+A schema maps field names to a type: "string", "integer", "boolean",
+"array" or "object", a nested schema for an object, a list of simple types
+for an array of those, or a list holding one nested schema for an array of
+objects. Fields are optional and may be null; fields the schema does not
+name are rejected, except for the "id" every row gets.
+
+Before rows are written they are checked by a `RowValidator` compiled from
+the stored schema. Compiled validators are kept per schema blob SHA, so a
+schema is compiled once and reading it again is served from the blob cache.
+"""
+import json
+import threading
+from collections import OrderedDict
+
+from .engines import NotFound
+from .indexes import schema_fields, validate_indexes
+
+SIMPLE_TYPES = ("string", "integer", "boolean")
+FIELD_TYPES = SIMPLE_TYPES + ("array", "object")
+VALIDATOR_CACHE_SIZE = 256
+
+
+def validate_schema_field(field, field_type):
+    """Recursively validate schema fields to support nested objects and arrays"""
+    if isinstance(field_type, dict):
+        # If the field is a nested object, recursively validate its fields
+        for subfield, subfield_type in field_type.items():
+            validate_schema_field(subfield, subfield_type)
+    elif isinstance(field_type, list):
+        # If the field is an array, check the type of items inside the array
+        if len(field_type) == 1 and isinstance(field_type[0], dict):
+            # Array of objects (nested)
+            for subfield, subfield_type in field_type[0].items():
+                validate_schema_field(subfield, subfield_type)
+        else:
+            # If it's an array of simple types, validate each item
+            for item in field_type:
+                if item not in SIMPLE_TYPES:
+                    raise ValueError(f"Invalid array type '{item}' in field '{field}'")
+    elif field_type not in FIELD_TYPES:
+        raise ValueError(f"Invalid type '{field_type}' for field '{field}'")
+
+
+def validate_schema(schema):
+    """Raise `ValueError` unless the fields and indexes of `schema` are valid."""
+    for field, field_type in schema_fields(schema).items():
+        validate_schema_field(field, field_type)
+    validate_indexes(schema)
+
+
+_TYPE_CHECKS = {
+    "string": lambda value: isinstance(value, str),
+    "integer": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "boolean": lambda value: isinstance(value, bool),
+    "array": lambda value: isinstance(value, list),
+    "object": lambda value: isinstance(value, dict),
+}
+
+_TYPE_NAMES = {
+    "string": "a string", "integer": "an integer", "boolean": "a boolean",
+    "array": "an array", "object": "an object",
+}
+
+
+def _compile_object(fields, allowed=()):
+    checks = {field: _compile(field_type) for field, field_type in fields.items()}
+
+    def check(value, path, errors):
+        if not isinstance(value, dict):
+            errors.append(f"Field '{path}' should be an object" if path else "Row should be an object")
+            return
+        for field, item in value.items():
+            field_check = checks.get(field)
+            if field_check is None:
+                if field not in allowed:
+                    errors.append(f"Unknown field '{path}.{field}'" if path else f"Unknown field '{field}'")
+            elif item is not None:
+                field_check(item, f"{path}.{field}" if path else field, errors)
+
+    return check
+
+
+def _compile(field_type):
+    if isinstance(field_type, dict):
+        return _compile_object(field_type)
+
+    if isinstance(field_type, list):
+        if len(field_type) == 1 and isinstance(field_type[0], dict):
+            item_check = _compile_object(field_type[0])
+
+            def check(value, path, errors):
+                if not isinstance(value, list):
+                    errors.append(f"Field '{path}' should be an array")
+                    return
+                for index, item in enumerate(value):
+                    item_check(item, f"{path}[{index}]", errors)
+
+            return check
+
+        item_checks = [_TYPE_CHECKS[item_type] for item_type in field_type]
+        expected = " or ".join(_TYPE_NAMES[item_type] for item_type in field_type)
+
+        def check(value, path, errors):
+            if not isinstance(value, list):
+                errors.append(f"Field '{path}' should be an array")
+                return
+            if item_checks:
+                for index, item in enumerate(value):
+                    if not any(item_check(item) for item_check in item_checks):
+                        errors.append(f"Field '{path}[{index}]' should be {expected}")
+
+        return check
+
+    type_check = _TYPE_CHECKS[field_type]
+    message = f"should be {_TYPE_NAMES[field_type]}"
+
+    def check(value, path, errors):
+        if not type_check(value):
+            errors.append(f"Field '{path}' {message}")
+
+    return check
+
+
+class RowValidator:
+    """Checks rows against one schema, compiled into plain functions once."""
+
+    def __init__(self, schema):
+        self.fields = fields = schema_fields(schema)
+        self._check = _compile_object(fields, allowed=() if "id" in fields else ("id",))
+
+    def row_errors(self, row):
+        """Return the problems with `row`, an empty list when it is valid."""
+        errors = []
+        self._check(row, "", errors)
+        return errors
+
+    def errors(self, rows):
+        """Return [{"index": ..., "errors": [...]}] for the invalid ones of `rows`."""
+        invalid = []
+        for index, row in enumerate(rows):
+            errors = []
+            self._check(row, "", errors)
+            if errors:
+                invalid.append({"index": index, "errors": errors})
+        return invalid
+
+
+class _ValidatorCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._validators = OrderedDict()  # schema blob SHA -> RowValidator
+        self._lock = threading.Lock()
+
+    def get(self, engine, path):
+        """Return the validator for the schema stored at `path`, None if there is none."""
+        try:
+            schema_file = engine.read(path)
+        except NotFound:
+            return None
+        with self._lock:
+            validator = self._validators.get(schema_file.sha)
+            if validator is not None:
+                self._validators.move_to_end(schema_file.sha)
+                return validator
+        validator = RowValidator(json.loads(schema_file.decoded_content.decode("utf-8")))
+        with self._lock:
+            self._validators[schema_file.sha] = validator
+            while len(self._validators) > self.max_entries:
+                self._validators.popitem(last=False)
+        return validator
+
+
+_validators = _ValidatorCache(VALIDATOR_CACHE_SIZE)
+
+
+def get_row_validator(engine, path):
+    """Return the `RowValidator` of the schema at `path` (None if the table has no schema)."""
+    return _validators.get(engine, path)
@@ -0,0 +1,79 @@
+"""
+Streamed response bodies.
+
+Rows are encoded as they come and sent in chunks of about
+`TABLE_STREAM_CHUNK_BYTES`, so a response holds one chunk in memory and
+starts before the last segment of the table is read. Files can be fetched
+ahead of the response by a few threads with `prefetch`.
+"""
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+def stream_requested(value):
+    """Whether the `stream` parameter of a request (a JSON boolean or a query string) asks for a streamed body."""
+    if value is None or isinstance(value, bool):
+        return bool(value)
+    word = str(value).strip().lower()
+    if word in ("true", "1", "yes"):
+        return True
+    if word in ("false", "0", "no", ""):
+        return False
+    raise ValueError("Stream should be true or false")
+
+
+def chunked(pieces):
+    """Join `pieces` (str or bytes) into bytes chunks of about `TABLE_STREAM_CHUNK_BYTES`."""
+    chunk_size = settings.TABLE_STREAM_CHUNK_BYTES
+    buffer = []
+    size = 0
+    for piece in pieces:
+        if isinstance(piece, str):
+            piece = piece.encode("utf-8")
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def prefetch(items, fetch, workers):
+    """
+    Yield `fetch(item)` for each of `items`, in order, with up to `workers`
+    of them running ahead in threads. Only those are held in memory.
+    """
+    if workers <= 1:
+        yield from map(fetch, items)
+        return
+    pool = ThreadPoolExecutor(workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(fetch, item))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def json_array(rows):
+    """Yield `rows` encoded as one JSON array, the way DRF renders it."""
+    def pieces():
+        yield "["
+        for index, row in enumerate(rows):
+            if index:
+                yield ","
+            # Same escapes as rest_framework.renderers.JSONRenderer
+            yield json.dumps(row, ensure_ascii=False, separators=(",", ":")).replace(
+                "\u2028", "\\u2028").replace("\u2029", "\\u2029")
+        yield "]"
+
+    return chunked(pieces())
@@ -0,0 +1,730 @@
+"""
+Row level operations on the tables of a database.
+
+A table is a small manifest at `<database>/Tables/<table>.json` listing its
+row segments, which live next to it in `<database>/Tables/<table>/`:
+
+    {"format": "segments", "segments": ["000001", "000002"], "next_segment": 3}
+
+Each segment holds rows (objects carrying a unique "id") in the table's row
+format and is kept around `TABLE_SEGMENT_MAX_BYTES`:
+
+- "ndjson": one compact JSON object per line, decoded row by row;
+- "json": an indented JSON array, as tables were first stored.
+
+New tables use `TABLE_ROW_FORMAT` unless created with another one.
+
+A primary key index maps the id of every row outside the last segment to the
+segment holding it, split over `index_shards` files in
+`<database>/Tables/<table>/index/`. A lookup, update or delete by id reads
+one index file and at most two segments: the indexed one and the last one,
+which holds the rows inserted since. Rows enter the index when their segment
+stops being the last one, so plain inserts never rewrite it. That commit
+also rewrites the segment ending with `SEAL_MARKER`, so a writer still
+appending to it as the last segment fails its SHA check even when no row
+moved. Entries of deleted rows are left behind and simply not found in
+their segment.
+Secondary indexes declared in the schema (see `indexes`) are kept the same
+way, in `index/<field>/`: a hash index maps each value to the segments
+holding it, a sorted index keeps the range of values of each segment.
+Inserts only rewrite the last segment (or start a new one when it is full)
+and updates and deletes only the segments holding the rows they change, so a
+write costs the same however big the table is.
+Tables written before segments existed are a single JSON array in place of
+the manifest, and segments written before row formats existed are indented
+arrays; both are read as they are and rewritten in the default format by
+their first write.
+
+Every change is a small transaction: read the table at some SHA, apply the
+logical operation (append, delete by id, update by id) to the rows, and write
+the result only if the files are still at that SHA. When another writer got
+there first the storage engine raises `Conflict`; the table is then read
+again and the same operation re-applied, up to `TABLE_WRITE_RETRIES` times
+with jittered exponential backoff.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+import zlib
+
+from django.conf import settings
+
+from .engines import Conflict, NotFound
+from .indexes import field_values, range_may_match, value_key, value_range
+from .streaming import prefetch
+
+MANIFEST_FORMAT = "segments"
+
+# Row format -> file extension of its segments
+ROW_FORMATS = {"json": ".json", "ndjson": ".ndjson"}
+
+# Ends every segment but the last one; a blank line, which both formats skip
+SEAL_MARKER = "\n"
+
+
+class RowsNotFound(Exception):
+    """None of the requested ids are in the table."""
+
+
+class TransactionStats:
+    def __init__(self):
+        self.transactions = 0
+        self.conflicts = 0
+        self.retries = 0
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def record(self, conflicts, exhausted=False):
+        with self._lock:
+            self.transactions += 1
+            self.conflicts += conflicts
+            self.retries += conflicts - (1 if exhausted else 0)
+            self.exhausted += 1 if exhausted else 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "transactions": self.transactions,
+                "conflicts": self.conflicts,
+                "retries": self.retries,
+                "exhausted": self.exhausted,
+            }
+
+
+transaction_stats = TransactionStats()
+
+
+def table_path(database_name, table_name):
+    return f"{database_name}/Tables/{table_name}.json"
+
+
+def schema_path(database_name, table_name):
+    return f"{database_name}/Schema/{table_name}.json"
+
+
+def segment_folder(path):
+    """Return the folder holding the segments of the table at `path`."""
+    return path[:-len(".json")] if path.endswith(".json") else path
+
+
+def _index_description(index_type):
+    if index_type == "hash":
+        return {"type": "hash", "shards": settings.TABLE_INDEX_SHARDS or 1}
+    return {"type": index_type}
+
+
+def new_table(row_format=None, indexes=None):
+    """
+    Return the manifest of an empty table storing rows as `row_format`, with
+    the secondary `indexes` ({field: index type}).
+    """
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "row_format": row_format or settings.TABLE_ROW_FORMAT,
+        "segments": [],
+        "next_segment": 1,
+    }
+    if settings.TABLE_INDEX_SHARDS:
+        manifest["index_shards"] = settings.TABLE_INDEX_SHARDS
+    if indexes:
+        manifest["indexes"] = {field: _index_description(index_type) for field, index_type in indexes.items()}
+    return json.dumps(manifest, indent=4)
+
+
+def encode_rows(rows, row_format):
+    if row_format == "ndjson":
+        return "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows)
+    return json.dumps(rows, indent=4)
+
+
+def _lines(content):
+    # Lines of a memory-mapped segment, copying one line at a time
+    start = 0
+    while start < len(content):
+        end = content.find(b"\n", start)
+        if end == -1:
+            end = len(content)
+        yield content[start:end]
+        start = end + 1
+
+
+def decode_rows(content, row_format):
+    """Yield the rows stored in `content`, one line at a time for "ndjson"."""
+    if row_format == "ndjson":
+        for line in content.splitlines() if isinstance(content, bytes) else _lines(content):
+            if line.strip():
+                yield json.loads(line)
+        return
+    rows = json.loads(content.decode("utf-8"))
+    yield from rows if isinstance(rows, list) else [rows]
+
+
+def assign_ids(rows):
+    """Give every row without an "id" a new one and return all the ids."""
+    for row in rows:
+        if "id" not in row:
+            row["id"] = str(uuid.uuid4())
+    return [row["id"] for row in rows]
+
+
+def _row_size(row, row_format):
+    # About what the row takes up inside a segment.
+    if row_format == "ndjson":
+        return len(json.dumps(row, separators=(",", ":"))) + 1
+    return len(json.dumps(row, indent=4)) + 6
+
+
+def _ends_sealed(content, row_format):
+    # Encoded rows end with one newline as ndjson and none as a JSON array.
+    end = ("\n" if row_format == "ndjson" else "") + SEAL_MARKER
+    return len(content) >= len(end) and content[-len(end):] == end.encode("utf-8")
+
+
+class _Segment:
+    def __init__(self, name, path, row_format, content=None, sha=None):
+        self.name = name
+        self.path = path
+        self.row_format = row_format
+        self.content = content
+        self.sha = sha
+        self.size = len(content if content is not None else encode_rows([], row_format))
+        self.changed = False
+        self.sealed = False  # its rows were just added to the index
+        # Read ending with SEAL_MARKER: no longer the last segment, whatever the manifest read said
+        self.marked = content is not None and _ends_sealed(content, row_format)
+        self._rows = None if content is not None else []
+
+    def iter_rows(self):
+        """Yield the rows, decoding them one at a time until they are changed."""
+        if self._rows is not None:
+            return iter(self._rows)
+        return decode_rows(self.content, self.row_format)
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = list(decode_rows(self.content, self.row_format))
+            self.content = None
+        return self._rows
+
+    @rows.setter
+    def rows(self, rows):
+        self._rows = rows
+        self.content = None
+
+
+class _IndexFile:
+    def __init__(self, path, entries, sha=None, checked=True):
+        self.path = path
+        self.entries = entries
+        self.sha = sha
+        self.checked = checked  # False when built from scratch without reading the file
+        self.changed = False
+
+
+class Table:
+    """
+    A table as read at one version of its manifest.
+
+    Segments are read lazily. The write methods change the rows in memory;
+    `save` then writes the touched files, checking that none of them (nor
+    the manifest) changed since they were read.
+    """
+
+    def __init__(self, engine, path, sha=None, manifest=None, rows=None):
+        self.engine = engine
+        self.path = path
+        self.sha = sha
+        self.manifest = manifest  # None while the table is a single array
+        self._rows = rows
+        self._segments = {}
+        self._index = {}
+        self._removed = []
+        self._manifest_changed = False
+
+    @classmethod
+    def load(cls, engine, path, create=False):
+        """Read the table at `path`; with `create` a missing one is empty."""
+        try:
+            table_file = engine.read(path)
+        except NotFound:
+            if not create:
+                raise
+            return cls(engine, path, rows=[])
+        data = json.loads(table_file.decoded_content.decode("utf-8"))
+        if isinstance(data, dict) and data.get("format") == MANIFEST_FORMAT:
+            return cls(engine, path, table_file.sha, manifest=data)
+        if not isinstance(data, list):
+            data = [data]
+        return cls(engine, path, table_file.sha, rows=data)
+
+    @property
+    def segment_names(self):
+        return self.manifest["segments"] if self.manifest is not None else []
+
+    @property
+    def row_format(self):
+        if self.manifest is None:
+            return settings.TABLE_ROW_FORMAT
+        return self.manifest.get("row_format", "json")
+
+    def _segment_path(self, name):
+        return f"{segment_folder(self.path)}/{name}{ROW_FORMATS[self.row_format]}"
+
+    def _segment(self, name, sha=None, keep=True):
+        # Reads pass keep=False so that a scan holds one segment at a time.
+        segment = self._segments.get(name)
+        if segment is None:
+            path = self._segment_path(name)
+            try:
+                segment_file = self.engine.read(path, sha)
+            except NotFound:
+                # Dropped by a writer that also changed the manifest.
+                raise Conflict(path)
+            segment = _Segment(name, path, self.row_format, segment_file.decoded_content, segment_file.sha)
+            if keep:
+                self._segments[name] = segment
+        return segment
+
+    def _segments_in_order(self, keep=True, workers=1):
+        shas = {}
+        if len(self.segment_names) > 1:
+            # One listing gives every segment's SHA, so cached segments are
+            # served without asking whether each of them changed.
+            try:
+                shas = {entry.path: entry.sha for entry in self.engine.walk(segment_folder(self.path))}
+            except NotFound:
+                pass
+        yield from prefetch(
+            list(self.segment_names),
+            lambda name: self._segment(name, shas.get(self._segment_path(name)), keep),
+            workers,
+        )
+
+    def rows(self, names=None, workers=1):
+        """
+        Yield every row of the table, or those of the segments in `names`.
+        With `workers` > 1 that many segments are read ahead concurrently.
+        """
+        if self.manifest is None:
+            yield from self._rows
+            return
+        if names is None:
+            for segment in self._segments_in_order(keep=False, workers=workers):
+                yield from segment.iter_rows()
+            return
+        for name in list(self.segment_names):
+            if name in names:
+                yield from self._segment(name, keep=False).iter_rows()
+
+    @property
+    def indexed(self):
+        return self.manifest is not None and "index_shards" in self.manifest
+
+    @property
+    def secondary_indexes(self):
+        """{field: description} of the secondary indexes built for this table."""
+        return self.manifest.get("indexes", {}) if self.manifest is not None else {}
+
+    def _index_folder(self):
+        return f"{segment_folder(self.path)}/index"
+
+    def _shard_path(self, key, shards, field=None):
+        folder = self._index_folder() if field is None else f"{self._index_folder()}/{field}"
+        return f"{folder}/{zlib.crc32(key.encode('utf-8')) % shards:02d}.json"
+
+    def _ranges_path(self, field):
+        return f"{self._index_folder()}/{field}/ranges.json"
+
+    def _index_file(self, path, new=False):
+        index = self._index.get(path)
+        if index is None:
+            if new:
+                # A table getting a new index has no index files to read.
+                index = _IndexFile(path, {}, checked=False)
+            else:
+                try:
+                    index_file = self.engine.read(path)
+                    index = _IndexFile(path, json.loads(index_file.decoded_content.decode("utf-8")), index_file.sha)
+                except NotFound:
+                    index = _IndexFile(path, {})
+            self._index[path] = index
+        return index
+
+    def _index_ids(self, segment, rows):
+        for row in rows:
+            if "id" in row:
+                index = self._index_file(self._shard_path(str(row["id"]), self.manifest["index_shards"]))
+                index.entries[str(row["id"])] = segment.name
+                index.changed = True
+
+    def _index_values(self, segment, rows, fields):
+        for field in fields:
+            values = [value for row in rows for value in field_values(row, field)]
+            if not values:
+                continue
+            description = self.secondary_indexes[field]
+            if description["type"] == "hash":
+                for value in values:
+                    key = value_key(value)
+                    index = self._index_file(self._shard_path(key, description["shards"], field))
+                    names = index.entries.setdefault(key, [])
+                    if segment.name not in names:
+                        names.append(segment.name)
+                        index.changed = True
+                continue
+            index = self._index_file(self._ranges_path(field))
+            if segment.name in index.entries:
+                known = index.entries[segment.name]
+                values_range = value_range(known + values) if known is not None else None
+            else:
+                values_range = value_range(values)
+            if segment.name not in index.entries or index.entries[segment.name] != values_range:
+                index.entries[segment.name] = values_range
+                index.changed = True
+
+    def _seal(self, segment, fields=None):
+        # `segment` is no longer the last one: its rows go into the indexes,
+        # and the commit checks it is still what was indexed.
+        if fields is None:
+            if self.indexed:
+                self._index_ids(segment, segment.rows)
+            fields = list(self.secondary_indexes)
+        self._index_values(segment, segment.rows, fields)
+        segment.sealed = True
+
+    def _new_index(self):
+        for shard in range(self.manifest["index_shards"]):
+            self._index_file(f"{self._index_folder()}/{shard:02d}.json", new=True)
+
+    def _build_index(self, shards):
+        self.manifest["index_shards"] = shards
+        self._manifest_changed = True
+        self._new_index()
+        for segment in list(self._segments_in_order())[:-1]:
+            self._seal(segment, fields=[])
+            self._index_ids(segment, segment.rows)
+
+    def _new_secondary_index(self, field, index_type):
+        description = _index_description(index_type)
+        if index_type == "hash":
+            for shard in range(description["shards"]):
+                self._index_file(f"{self._index_folder()}/{field}/{shard:02d}.json", new=True)
+        else:
+            self._index_file(self._ranges_path(field), new=True)
+        return description
+
+    def set_indexes(self, declarations):
+        """Build the secondary indexes `declarations` ({field: type}) asks for and drop the others."""
+        self._convert()
+        indexes = self.manifest.setdefault("indexes", {})
+        for field in [field for field in indexes if declarations.get(field) != indexes[field]["type"]]:
+            del indexes[field]
+            self._manifest_changed = True
+            try:
+                self._removed.extend(
+                    entry for entry in self.engine.walk(f"{self._index_folder()}/{field}") if entry.type == "file"
+                )
+            except NotFound:
+                pass
+        added = [field for field in declarations if field not in indexes]
+        for field in added:
+            indexes[field] = self._new_secondary_index(field, declarations[field])
+            self._manifest_changed = True
+        if added:
+            for segment in list(self._segments_in_order())[:-1]:
+                self._seal(segment, added)
+
+    def segments_for(self, field, op, value):
+        """
+        Return the names of the segments that may hold rows where `field op
+        value` holds (op is eq, in, lt or gt), or None when no index helps.
+        """
+        description = self.secondary_indexes.get(field)
+        if description is None or op not in ("eq", "in", "lt", "gt"):
+            return None
+        if any(isinstance(item, list) for item in (value if op == "in" else [value])):
+            return None  # Arrays are indexed by their items, not as a whole
+        if description["type"] == "hash" and op not in ("eq", "in"):
+            return None
+        names = set(self.segment_names[-1:])
+        if description["type"] == "hash":
+            for item in ([value] if op == "eq" else value):
+                key = value_key(item)
+                index = self._index_file(self._shard_path(key, description["shards"], field))
+                names.update(index.entries.get(key, []))
+        else:
+            ranges = self._index_file(self._ranges_path(field)).entries
+            names.update(name for name, values_range in ranges.items() if range_may_match(values_range, op, value))
+        return names
+
+    def _segments_holding(self, ids):
+        """Yield the segments that may hold rows with `ids`, in table order."""
+        if not self.indexed:
+            yield from self._segments_in_order()
+            return
+        names = set(self.segment_names[-1:])
+        names.update(
+            self._index_file(self._shard_path(str(row_id), self.manifest["index_shards"])).entries.get(str(row_id))
+            for row_id in ids
+        )
+        for name in list(self.segment_names):
+            if name in names:
+                yield self._segment(name)
+
+    def find(self, row_id):
+        """Return the row with `row_id`, or None."""
+        if self.manifest is None:
+            rows = self._rows
+        else:
+            rows = (row for segment in self._segments_holding([row_id]) for row in segment.iter_rows())
+        return next((row for row in rows if row.get("id") == row_id), None)
+
+    def scan(self, conditions):
+        """
+        Yield the rows of the segments that may hold rows meeting every
+        (field, op, value) condition, as far as the indexes can tell.
+        """
+        names = None
+        for field, op, value in conditions:
+            candidates = self.segments_for(field, op, value)
+            if candidates is not None:
+                names = candidates if names is None else names & candidates
+        yield from self.rows(names)
+
+    def has_rows(self):
+        return next(self.rows(), None) is not None
+
+    def _file_entries(self):
+        try:
+            entries = self.engine.walk(segment_folder(self.path))
+        except NotFound:
+            return []
+        return [entry for entry in entries if entry.type == "file"]
+
+    def files(self):
+        """Return the paths of the manifest, the segments and the index."""
+        return [self.path] + [entry.path for entry in self._file_entries()]
+
+    def blobs(self):
+        """Return {path: blob SHA} of the manifest, the segments and the index, as read."""
+        return {self.path: self.sha, **{entry.path: entry.sha for entry in self._file_entries()}}
+
+    def _convert(self):
+        # The first write of a single array table splits it into segments, and
+        # that of a table with segments older than row formats rewrites them.
+        if self.manifest is None:
+            rows, self._rows = self._rows, None
+            self.manifest = json.loads(new_table())
+            self._manifest_changed = True
+            if self.indexed:
+                self._new_index()
+            self.append(rows)
+            return
+        if "row_format" not in self.manifest:
+            self._reformat(settings.TABLE_ROW_FORMAT)
+        if not self.indexed and settings.TABLE_INDEX_SHARDS:
+            self._build_index(settings.TABLE_INDEX_SHARDS)
+
+    def _reformat(self, row_format):
+        old_segments = list(self._segments_in_order())
+        self.manifest["row_format"] = row_format
+        self._manifest_changed = True
+        for old in old_segments:
+            segment = _Segment(old.name, self._segment_path(old.name), row_format)
+            segment.rows = old.rows
+            segment.size = sum(_row_size(row, row_format) for row in segment.rows)
+            segment.changed = True
+            if segment.path == old.path:
+                segment.sha = old.sha
+            else:
+                self._removed.append(old)
+            self._segments[old.name] = segment
+
+    def _new_segment(self):
+        if self.segment_names:
+            previous = self._segment(self.segment_names[-1])
+            self._seal(previous)
+            previous.changed = True  # to end it with SEAL_MARKER
+        name = f"{self.manifest['next_segment']:06d}"
+        self.manifest["next_segment"] += 1
+        self.manifest["segments"].append(name)
+        self._manifest_changed = True
+        segment = self._segments[name] = _Segment(name, self._segment_path(name), self.row_format)
+        return segment
+
+    def _remove_segment(self, segment):
+        self.manifest["segments"].remove(segment.name)
+        self._manifest_changed = True
+        self._removed.append(segment)
+
+    def append(self, rows):
+        self._convert()
+        max_bytes = settings.TABLE_SEGMENT_MAX_BYTES
+        tail = self._segment(self.segment_names[-1]) if self.segment_names else self._new_segment()
+        for row in rows:
+            size = _row_size(row, self.row_format)
+            if tail.rows and tail.size + size > max_bytes:
+                tail = self._new_segment()
+            tail.rows.append(row)
+            tail.size += size
+            tail.changed = True
+
+    def delete(self, ids):
+        """Delete the rows whose id is in `ids` and return how many there were."""
+        self._convert()
+        ids = set(ids)
+        deleted = 0
+        for segment in list(self._segments_holding(ids)):
+            remaining = [row for row in segment.rows if row.get("id") not in ids]
+            if len(remaining) == len(segment.rows):
+                continue
+            deleted += len(segment.rows) - len(remaining)
+            segment.rows = remaining
+            segment.changed = True
+            if not remaining and segment.name != self.segment_names[-1]:
+                self._remove_segment(segment)
+        return deleted
+
+    def update(self, row_id, changes):
+        """Update the fields of row `row_id` and return whether it was found."""
+        self._convert()
+        for segment in self._segments_holding([row_id]):
+            for row in segment.rows:
+                if row.get("id") == row_id:
+                    before = {field: field_values(row, field) for field in self.secondary_indexes}
+                    row.update(changes)  # Update only the provided fields
+                    segment.changed = True
+                    if segment.name != self.segment_names[-1]:
+                        if row.get("id") != row_id and self.indexed:
+                            self._index_ids(segment, [row])
+                        moved = [field for field in before if field_values(row, field) != before[field]]
+                        self._index_values(segment, [row], moved)
+                    return True
+        return False
+
+    def clear(self):
+        self._removed.extend(
+            _Segment(name, self._segment_path(name), self.row_format) for name in self.segment_names
+        )
+        if self.indexed or self.secondary_indexes:
+            try:
+                self._removed.extend(entry for entry in self.engine.walk(self._index_folder()) if entry.type == "file")
+            except NotFound:
+                pass
+        indexes = {field: index["type"] for field, index in self.secondary_indexes.items()}
+        # Segment names are never reused, see `save`.
+        next_segment = self.manifest["next_segment"] if self.manifest is not None else 1
+        # Still empty, in the row format and with the indexes the table had
+        self.manifest = json.loads(new_table(self.row_format, indexes))
+        self.manifest["next_segment"] = next_segment
+        self._manifest_changed = True
+        self._rows = None
+        self._segments = {}
+        self._index = {}
+
+    def save(self, message):
+        """Write the changes, raising `Conflict` if anything moved meanwhile."""
+        removed = {segment.path for segment in self._removed}
+        changed = [
+            segment for segment in self._segments.values()
+            if segment.changed and segment.path not in removed
+        ]
+        indexes = [index for index in self._index.values() if index.changed]
+        tail = self.segment_names[-1] if self.segment_names else None
+        if any(segment.name == tail and segment.marked for segment in changed):
+            raise Conflict(self.path)  # another writer sealed it after we read the manifest
+
+        def content(segment):
+            encoded = encode_rows(segment.rows, segment.row_format)
+            return encoded if segment.name == tail else encoded + SEAL_MARKER
+
+        if len(changed) == 1 and not self._manifest_changed and not indexes and changed[0].sha is not None:
+            # The common case, e.g. an insert into the last segment: a
+            # single file replaced if it is still at the SHA we read. That
+            # check alone is enough because a segment removed by someone else
+            # is never created again under the same name, and one sealed by
+            # someone else was rewritten ending with SEAL_MARKER.
+            segment = changed[0]
+            self.engine.write(segment.path, message, content(segment), segment.sha)
+            return
+
+        changes = {segment.path: content(segment) for segment in changed}
+        changes.update({index.path: json.dumps(index.entries, separators=(",", ":")) for index in indexes})
+        changes.update({path: None for path in removed})
+        if self._manifest_changed:
+            changes[self.path] = json.dumps(self.manifest, indent=4)
+        if not changes:
+            return
+        expected = {self.path: self.sha}
+        expected.update({
+            segment.path: segment.sha for segment in self._segments.values()
+            if segment.sealed and segment.sha is not None
+        })
+        expected.update({segment.path: segment.sha for segment in changed})
+        expected.update({index.path: index.sha for index in indexes if index.checked})
+        expected.update({segment.path: segment.sha for segment in self._removed if segment.sha is not None})
+        self.engine.commit(message, changes, expected)
+
+
+def table_blobs(engine, path):
+    """Return {path: blob SHA} of every file making up the table at `path`."""
+    return Table.load(engine, path).blobs()
+
+
+def transact(engine, path, operation, message, create=False):
+    """
+    Apply `operation(table)` to the `Table` at `path` and save the result.
+
+    `operation` changes the table through its write methods and returns the
+    value handed back to the caller; it may run several times if other
+    writers interfere. With `create` a missing table is treated as empty.
+    """
+    retries = settings.TABLE_WRITE_RETRIES
+    for attempt in range(retries + 1):
+        table = Table.load(engine, path, create)
+        try:
+            result = operation(table)
+            table.save(message)
+        except Conflict:
+            if attempt == retries:
+                transaction_stats.record(attempt + 1, exhausted=True)
+                raise
+            time.sleep(random.uniform(0, settings.TABLE_WRITE_RETRY_BACKOFF * 2 ** attempt))
+            continue
+        transaction_stats.record(attempt)
+        return result
+
+
+def append_rows(engine, database_name, table_name, rows):
+    """Append `rows` to the table, creating it if needed."""
+    transact(
+        engine, table_path(database_name, table_name),
+        lambda table: table.append(rows),
+        "Updated table with new data", create=True,
+    )
+
+
+def delete_rows(engine, path, ids):
+    """Delete the rows whose id is in `ids`; raise `RowsNotFound` if there are none."""
+    def operation(table):
+        if not table.delete(ids):
+            raise RowsNotFound()
+
+    transact(engine, path, operation, "Deleted objects from the JSON file")
+
+
+def clear_rows(engine, path):
+    """Delete every row of the table."""
+    transact(engine, path, lambda table: table.clear(), "Deleted all content from the JSON file")
+
+
+def update_row(engine, path, row_id, changes):
+    """Update the fields of row `row_id` with `changes`; raise `RowsNotFound` if it is missing."""
+    def operation(table):
+        if not table.update(row_id, changes):
+            raise RowsNotFound()
+
+    transact(engine, path, operation, "Updated an object in the JSON file")
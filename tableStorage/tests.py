@@ -1,3 +1,1409 @@
-from django.test import TestCase
+import base64
+import datetime
+import io
+import json
+import mmap
+import tarfile
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from github import Auth, Github, GithubException
+from rest_framework.renderers import JSONRenderer
+
+from .backfill import IndexBackfill
+from .cache import BlobCache, ObjectCache
+from .catalog import Catalog
+from .client import get_github, get_repo, reset, retry_policy
+from .engines import (
+    Conflict, GitHubStorageEngine, GitStorageEngine, LocalStorageEngine, NotFound, ReplicaStorageEngine,
+    SnapshotStorageEngine, StorageError, StoredFile, blob_sha, get_read_engine, get_storage_engine,
+)
+from .exports import export_database, export_table
+from .fakegithub import REPO_NAME, FakeGitHub
+from .governor import BULK, INTERACTIVE, WRITE, RateLimited, RateLimitGovernor, bulk
+from .groupcommit import GroupCommitter
+from .history import HistoryError, resolve, table_history
+from .imports import InvalidRows, get_import_tracker
+from .metrics import Histogram, measure_request
+from .query import Query, QueryError
+from .replica import Replica, ReplicaMiddleware, get_replica
+from .schemas import RowValidator, get_row_validator
+from .streaming import chunked, json_array, prefetch
+from .tables import (
+    ROW_FORMATS, Table, append_rows, clear_rows, decode_rows, delete_rows, encode_rows, new_table, transact,
+    transaction_stats, update_row,
+)
+from .wal import MergedTable, WriteAheadLog
+
+
+def contents_response(path, content, inline=True):
+    """What the contents API answers for a file, with or without its content."""
+    data = {
+        "type": "file",
+        "path": path,
+        "sha": blob_sha(content),
+        "size": len(content),
+        "encoding": "base64" if inline else "none",
+        "content": base64.b64encode(content).decode("ascii") if inline else "",
+    }
+    return 200, {"etag": '"etag"'}, json.dumps(data)
+
+
+def fake_github(test, **options):
+    """Return (server, repository handle) of a `FakeGitHub` running for the duration of `test`."""
+    fake = test.enterContext(FakeGitHub(seed=1, **options))
+    # Without PyGithub's spacing of calls, which only slows the tests down
+    github = Github(base_url=fake.url, auth=Auth.Token("test"), retry=None,
+                    seconds_between_requests=None, seconds_between_writes=None)
+    test.addCleanup(github.close)
+    return fake, github
+
+
+def fake_repo():
+    repo = mock.Mock()
+    repo.url = "https://api.github.com/repos/owner/repo"
+    repo.default_branch = "main"
+    repo.get_git_ref.return_value.object.sha = "head"
+    repo.get_git_commit.return_value.sha = "head"
+    repo.create_git_commit.return_value.sha = "commit"
+    return repo
+
+
+def tree_holding(repo, path, sha):
+    """Have the mock `repo` answer tree requests at its head with blob `sha` at `path`."""
+    names = path.split("/")
+    trees = {}
+    for depth, name in enumerate(names):
+        last = depth == len(names) - 1
+        element = mock.Mock(path=name, type="blob" if last else "tree", sha=sha if last else f"tree{depth + 1}")
+        trees[f"tree{depth}"] = [element]
+    repo.get_git_commit.return_value.tree.sha = "tree0"
+    repo.get_git_tree.side_effect = lambda tree_sha: mock.Mock(tree=trees[tree_sha])
+
+
+class StorageEngineTests(SimpleTestCase):
+    """What every engine does the same, checked on those without a network."""
+
+    def engines(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        return [LocalStorageEngine(f"{root}/local"), GitStorageEngine(f"{root}/data.git")]
+
+    def test_files_folders_and_listings(self):
+        for engine in self.engines():
+            with self.subTest(engine=type(engine).__name__):
+                engine.write("shop/Schema/orders.json", "Created schema", '{"qty": "integer"}')
+                sha = engine.write("shop/Tables/orders.json", "Created table", "[]")
+                stored = engine.read("shop/Tables/orders.json")
+                self.assertEqual((stored.decoded_content, stored.sha), (b"[]", sha))
+                self.assertEqual(sha, blob_sha(b"[]"))
+                self.assertEqual([(entry.path, entry.type) for entry in engine.list("shop")],
+                                 [("shop/Schema", "dir"), ("shop/Tables", "dir")])
+                self.assertEqual(len(engine.walk("shop")), 4)
+                self.assertEqual(engine.list_databases(), ["shop"])
+                self.assertEqual(engine.list_tables("shop"), ["orders"])
+                self.assertTrue(engine.database_exists("shop"))
+
+                engine.delete("shop/Tables/orders.json", "Deleted table", sha)
+                self.assertEqual([entry.path for entry in engine.list("shop")], ["shop/Schema"])
+                for missing in (lambda: engine.read("shop/Tables/orders.json"), lambda: engine.list("shop/Tables"),
+                                lambda: engine.delete("shop/Tables/orders.json", "Deleted table")):
+                    with self.assertRaises(NotFound):
+                        missing()
+
+    def test_writes_from_a_stale_read_conflict(self):
+        for engine in self.engines():
+            with self.subTest(engine=type(engine).__name__):
+                path = "shop/Tables/orders.json"
+                first = engine.write(path, "Created table", "[]")
+                second = engine.write(path, "Added rows", '[{"id": "a"}]', first)
+                with self.assertRaises(Conflict):
+                    engine.write(path, "Added rows", '[{"id": "b"}]', first)
+                with self.assertRaises(Conflict):
+                    engine.write(path, "Created table", "[]")  # it exists already
+                with self.assertRaises(Conflict):
+                    engine.delete(path, "Deleted table", first)
+                self.assertEqual(engine.read(path).sha, second)
+
+    def test_local_paths_stay_inside_the_root(self):
+        engine = self.engines()[0]
+        with self.assertRaises(StorageError):
+            engine.write("../outside.json", "Escaped", "[]")
+
+    def test_local_listings_hash_only_changed_files(self):
+        engine = self.engines()[0]
+        for name in ("orders", "users", "items"):
+            engine.write(f"shop/Tables/{name}.json", "Created table", "[]")
+        engine.walk("shop")
+        with mock.patch("tableStorage.engines.blob_sha", wraps=blob_sha) as hashed:
+            self.assertEqual({entry.sha for entry in engine.list("shop/Tables")}, {blob_sha(b"[]")})
+            engine.walk("shop")
+            self.assertEqual(hashed.call_count, 0)
+            engine.write("shop/Tables/users.json", "Added rows", "{}", blob_sha(b"[]"))
+            hashed.reset_mock()
+            shas = {entry.path: entry.sha for entry in engine.walk("shop")}
+            self.assertEqual(hashed.call_count, 1)
+        self.assertEqual(shas["shop/Tables/users.json"], blob_sha(b"{}"))
+
+    def test_engine_is_chosen_by_setting(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        for name, engine_class in (("local", LocalStorageEngine), ("git", GitStorageEngine)):
+            with override_settings(STORAGE_ENGINE=name, STORAGE_LOCAL_PATH=f"{root}/{name}"):
+                self.assertIsInstance(get_storage_engine(), engine_class)
+        with override_settings(STORAGE_ENGINE="ftp"), self.assertRaises(StorageError):
+            get_storage_engine()
+
+
+class WriteBatchTests(SimpleTestCase):
+    def engines(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        _, github = fake_github(self)
+        return [
+            LocalStorageEngine(f"{root}/local"), GitStorageEngine(f"{root}/data.git"),
+            GitHubStorageEngine(github.get_repo(REPO_NAME)),
+        ]
+
+    def files(self, engine):
+        paths = [entry.path for entry in engine.walk("") if entry.type == "file"]
+        return {path: engine.read(path).decoded_content for path in paths}
+
+    def test_changes_are_one_commit(self):
+        for engine in self.engines():
+            with self.subTest(engine=type(engine).__name__):
+                engine.write("shop/Tables/old.json", "Created table", "[]")
+                with engine.batch("Renamed table") as batch:
+                    batch.write("shop/Tables/new.json", "[]")
+                    batch.write("shop/Schema/new.json", "{}")
+                    batch.delete("shop/Tables/old.json")
+                self.assertEqual(self.files(engine), {"shop/Tables/new.json": b"[]", "shop/Schema/new.json": b"{}"})
+                if not isinstance(engine, LocalStorageEngine):
+                    self.assertEqual([commit["message"] for commit in engine.history(["shop"])],
+                                     ["Renamed table", "Created table"])
+
+    def test_nothing_is_written_when_the_block_raises(self):
+        for engine in self.engines():
+            with self.subTest(engine=type(engine).__name__):
+                with self.assertRaises(ValueError), engine.batch("Created table") as batch:
+                    batch.write("shop/Tables/orders.json", "[]")
+                    raise ValueError
+                self.assertEqual(self.files(engine), {})
+
+    def test_nothing_is_written_when_an_expected_path_changed(self):
+        for engine in self.engines():
+            with self.subTest(engine=type(engine).__name__):
+                engine.write("shop/Tables/orders.json", "Created table", "[]")
+                with self.assertRaises(Conflict), engine.batch("Created table") as batch:
+                    batch.write("shop/Schema/orders.json", "{}")
+                    batch.write("shop/Tables/orders.json", "[]")
+                    batch.expect("shop/Tables/orders.json", None)
+                self.assertEqual(self.files(engine), {"shop/Tables/orders.json": b"[]"})
+
+    def test_files_are_moved_by_blob_sha(self):
+        for engine in self.engines():
+            with self.subTest(engine=type(engine).__name__):
+                engine.write("shop/Tables/old.json", "Created table", "[1]")
+                sha = engine.read("shop/Tables/old.json").sha
+                with mock.patch.object(engine, "read", wraps=engine.read) as read, \
+                        mock.patch.object(engine, "blob", wraps=engine.blob) as blob:
+                    with engine.batch("Renamed table") as batch:
+                        batch.move("shop/Tables/old.json", "shop/Tables/new.json", sha)
+                self.assertEqual((read.call_count, blob.call_count), (0, 0))
+                self.assertEqual(self.files(engine), {"shop/Tables/new.json": b"[1]"})
+                self.assertEqual(engine.read("shop/Tables/new.json").sha, sha)
+
+    def test_moves_and_deletes_of_changed_files_conflict(self):
+        for engine in self.engines():
+            with self.subTest(engine=type(engine).__name__):
+                engine.write("shop/Tables/old.json", "Created table", "[1]")
+                engine.write("shop/Tables/gone.json", "Created table", "[2]")
+                shas = {path: engine.read(path).sha for path in ("shop/Tables/old.json", "shop/Tables/gone.json")}
+                engine.write("shop/Tables/old.json", "Inserted rows", "[1,3]", shas["shop/Tables/old.json"])
+                with self.assertRaises(Conflict), engine.batch("Renamed table") as batch:
+                    batch.move("shop/Tables/old.json", "shop/Tables/new.json", shas["shop/Tables/old.json"])
+                with self.assertRaises(Conflict), engine.batch("Deleted tables") as batch:
+                    batch.delete("shop/Tables/gone.json", shas["shop/Tables/gone.json"])
+                    batch.delete("shop/Tables/old.json", shas["shop/Tables/old.json"])
+                self.assertEqual(
+                    self.files(engine), {"shop/Tables/old.json": b"[1,3]", "shop/Tables/gone.json": b"[2]"},
+                )
+
+    def test_concurrent_commits_of_other_paths_all_land(self):
+        for engine in self.engines()[1:]:
+            with self.subTest(engine=type(engine).__name__):
+                def create(name):
+                    path = f"shop/Tables/{name}.json"
+                    engine.commit(f"Created table {name}", {path: "[]"}, expected={path: None})
+
+                threads = [threading.Thread(target=create, args=(f"t{i}",)) for i in range(6)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(len(self.files(engine)), 6)
+                self.assertEqual(len(engine.history(["shop"])), 6)
+
+
+@override_settings(GITHUB_CONTENTS_MAX_BYTES=100, GITHUB_RAW_DOWNLOAD_MIN_BYTES=1000, GITHUB_TOKEN="token")
+class GitHubLargeFileTests(SimpleTestCase):
+    path = "shop/Tables/orders/000001.ndjson"
+
+    def setUp(self):
+        self.repo = fake_repo()
+        self.engine = GitHubStorageEngine(self.repo)
+
+    def test_small_file_is_read_inline(self):
+        content = b'{"id": "1"}\n'
+        self.repo._requester.requestJson.return_value = contents_response(self.path, content)
+        stored = self.engine.read(self.path)
+        self.assertEqual(stored.decoded_content, content)
+        self.repo.get_git_blob.assert_not_called()
+
+    def test_large_file_is_read_from_blobs_api(self):
+        content = b'{"id": "1"}\n' * 50
+        self.repo._requester.requestJson.return_value = contents_response(self.path, content, inline=False)
+        self.repo.get_git_blob.return_value.content = base64.b64encode(content).decode("ascii")
+        with mock.patch("tableStorage.engines.requests.get") as get:
+            stored = self.engine.read(self.path)
+        self.assertEqual(stored.decoded_content, content)
+        self.assertEqual(stored.sha, blob_sha(content))
+        self.repo.get_git_blob.assert_called_once_with(blob_sha(content))
+        get.assert_not_called()
+
+    def test_largest_files_are_downloaded_raw(self):
+        content = b'{"id": "1"}\n' * 500
+        self.repo._requester.requestJson.return_value = contents_response(self.path, content, inline=False)
+        with mock.patch("tableStorage.engines.requests.get") as get:
+            get.return_value.status_code = 200
+            get.return_value.iter_content.return_value = [content[:2000], content[2000:]]
+            stored = self.engine.read(self.path)
+        self.assertEqual(stored.decoded_content, content)
+        self.repo.get_git_blob.assert_not_called()
+        url = get.call_args.args[0]
+        headers = get.call_args.kwargs["headers"]
+        self.assertEqual(url, f"{self.repo.url}/contents/{self.path}")
+        self.assertEqual(headers["Accept"], "application/vnd.github.raw")
+        self.assertEqual(headers["Authorization"], "token token")
+        self.assertTrue(get.call_args.kwargs["stream"])
+
+    def test_raw_download_of_deleted_file(self):
+        content = b"x" * 2000
+        self.repo._requester.requestJson.return_value = contents_response(self.path, content, inline=False)
+        with mock.patch("tableStorage.engines.requests.get") as get:
+            get.return_value.status_code = 404
+            with self.assertRaises(NotFound):
+                self.engine.read(self.path)
+
+    def test_small_file_is_written_with_contents_api(self):
+        self.repo.create_file.return_value = {"content": StoredFile(self.path, sha="new")}
+        self.assertEqual(self.engine.write(self.path, "Added rows", "x" * 100), "new")
+        self.repo.create_file.assert_called_once()
+        self.repo.create_git_blob.assert_not_called()
+
+    def test_large_file_is_written_as_blob(self):
+        content = b"x" * 101
+        tree_holding(self.repo, self.path, "old")
+        self.repo.create_git_blob.return_value.sha = blob_sha(content)
+        self.assertEqual(self.engine.write(self.path, "Added rows", content, sha="old"), blob_sha(content))
+        self.repo.create_file.assert_not_called()
+        self.repo.update_file.assert_not_called()
+        self.repo.create_git_blob.assert_called_once_with(base64.b64encode(content).decode("ascii"), "base64")
+        elements = self.repo.create_git_tree.call_args.args[0]
+        self.assertEqual([element._identity["sha"] for element in elements], [blob_sha(content)])
+        self.repo.get_git_ref.return_value.edit.assert_called_once_with("commit", force=False)
+
+    def test_large_file_write_conflict(self):
+        tree_holding(self.repo, self.path, "newer")
+        with self.assertRaises(Conflict):
+            self.engine.write(self.path, "Added rows", b"x" * 101, sha="old")
+        self.repo.create_git_blob.assert_not_called()
+        self.repo.get_git_ref.return_value.edit.assert_not_called()
+
+
+class RowValidatorTests(SimpleTestCase):
+    schema = {
+        "name": "string",
+        "qty": "integer",
+        "tags": ["string"],
+        "customer": {"name": "string", "vip": "boolean"},
+        "lines": [{"sku": "string"}],
+        "_indexes": [{"field": "customer.name"}],
+    }
+
+    def test_valid_rows(self):
+        validator = RowValidator(self.schema)
+        rows = [
+            {"name": "a", "qty": 1, "tags": ["x"], "customer": {"name": "c", "vip": False}, "lines": [{"sku": "s"}]},
+            {"id": "given", "name": None},
+            {},
+        ]
+        self.assertEqual(validator.errors(rows), [])
+
+    def test_errors_are_reported_per_row(self):
+        validator = RowValidator(self.schema)
+        rows = [
+            {"name": "a"},
+            {"qty": True, "other": 1},
+            {"tags": ["x", 2], "customer": {"vip": "yes"}, "lines": [{"sku": 1}]},
+            "not a row",
+        ]
+        self.assertEqual(validator.errors(rows), [
+            {"index": 1, "errors": ["Field 'qty' should be an integer", "Unknown field 'other'"]},
+            {"index": 2, "errors": [
+                "Field 'tags[1]' should be a string",
+                "Field 'customer.vip' should be a boolean",
+                "Field 'lines[0].sku' should be a string",
+            ]},
+            {"index": 3, "errors": ["Row should be an object"]},
+        ])
+
+    def test_index_declarations_are_not_fields(self):
+        self.assertEqual(RowValidator(self.schema).row_errors({"_indexes": []}), ["Unknown field '_indexes'"])
+
+    def test_validator_is_cached_by_schema_sha(self):
+        engine = LocalStorageEngine(self.enterContext(tempfile.TemporaryDirectory()))
+        sha = engine.write("shop/Schema/orders.json", "Created table", json.dumps(self.schema))
+        validator = get_row_validator(engine, "shop/Schema/orders.json")
+        self.assertIs(get_row_validator(engine, "shop/Schema/orders.json"), validator)
+        engine.write("shop/Schema/orders.json", "Updated schema", json.dumps({"qty": "string"}), sha)
+        changed = get_row_validator(engine, "shop/Schema/orders.json")
+        self.assertIsNot(changed, validator)
+        self.assertEqual(changed.row_errors({"qty": 1}), ["Field 'qty' should be a string"])
+        self.assertIsNone(get_row_validator(engine, "shop/Schema/missing.json"))
+
+
+@override_settings(TABLE_IMPORT_CHUNK_BYTES=1000, TABLE_SEGMENT_MAX_BYTES=2000)
+class BulkImportTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = LocalStorageEngine(self.enterContext(tempfile.TemporaryDirectory()))
+        schema = {"n": "integer", "ok": "boolean", "customer": {"name": "string"}, "tags": ["string"]}
+        self.engine.write("shop/Schema/orders.json", "Created table", json.dumps(schema))
+        self.validator = get_row_validator(self.engine, "shop/Schema/orders.json")
+
+    def rows(self):
+        return list(Table.load(self.engine, "shop/Tables/orders.json").rows())
+
+    def test_csv_import_in_chunks(self):
+        lines = [b"n,ok,customer.name,tags\n"] + [
+            f'{i},{"true" if i % 2 else "false"},name {i},"[""a""]"\n'.encode() for i in range(100)
+        ]
+        bulk_import = get_import_tracker().start("shop", "orders", "csv")
+        bulk_import.run(self.engine, self.validator, iter(lines))
+        status = bulk_import.status()
+        self.assertEqual((status["state"], status["rows_written"]), ("done", 100))
+        self.assertGreater(status["commits"], 1)
+        rows = self.rows()
+        self.assertEqual([row["n"] for row in rows], list(range(100)))
+        self.assertEqual(
+            {key: rows[1][key] for key in ("ok", "customer", "tags")},
+            {"ok": True, "customer": {"name": "name 1"}, "tags": ["a"]},
+        )
+        self.assertEqual(len({row["id"] for row in rows}), 100)
+
+    def test_nothing_is_written_when_a_row_is_invalid(self):
+        lines = [b'{"n": 1}\n', b'{"n": "two"}\n', b"{broken\n"]
+        bulk_import = get_import_tracker().start("shop", "orders", "ndjson")
+        with self.assertRaises(InvalidRows) as raised:
+            bulk_import.run(self.engine, self.validator, iter(lines))
+        self.assertEqual([row["line"] for row in raised.exception.rows], [2, 3])
+        self.assertEqual(bulk_import.status()["state"], "failed")
+        self.assertFalse(self.engine.exists("shop/Tables/orders.json"))
+
+
+class TableTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = LocalStorageEngine(self.enterContext(tempfile.TemporaryDirectory()))
+        self.path = "shop/Tables/orders.json"
+
+    def create(self, row_format=None, indexes=None):
+        self.engine.write(self.path, "Created table", new_table(row_format, indexes))
+
+    def load(self):
+        return Table.load(self.engine, self.path)
+
+    @override_settings(TABLE_SEGMENT_MAX_BYTES=200)
+    def test_rows_added_to_a_segment_sealed_meanwhile_are_indexed(self):
+        self.create(indexes={"qty": "hash"})
+        append_rows(self.engine, "shop", "orders", [{"id": "a", "qty": 1}])
+        stale = self.load()
+        # Another writer fills the last segment: it is sealed and indexed
+        # as it is, and a new one started
+        append_rows(self.engine, "shop", "orders", [{"id": "b", "qty": 2, "text": "x" * 200}])
+
+        def operation(table):
+            operation.calls += 1
+            table.append([{"id": "c", "qty": 3}])
+
+        operation.calls = 0
+        with mock.patch("tableStorage.tables.Table.load", side_effect=[stale, self.load()]):
+            transact(self.engine, self.path, operation, "Added rows")
+        self.assertEqual(operation.calls, 2)  # the stale write was refused
+        table = self.load()
+        self.assertEqual(table.find("c"), {"id": "c", "qty": 3})
+        self.assertIn({"id": "c", "qty": 3}, list(table.scan([("qty", "eq", 3)])))
+
+    @override_settings(TABLE_SEGMENT_MAX_BYTES=200)
+    def test_a_segment_read_before_it_was_sealed_is_not_appended_to(self):
+        self.create(indexes={"qty": "hash"})
+        append_rows(self.engine, "shop", "orders", [{"id": "a", "qty": 1}])
+        stale = self.load()
+        stale.find("a")  # reads the last segment before it is sealed
+        append_rows(self.engine, "shop", "orders", [{"id": "b", "qty": 2, "text": "x" * 200}])
+        stale.append([{"id": "c", "qty": 3}])
+        with self.assertRaises(Conflict):
+            stale.save("Added rows")
+
+    @override_settings(TABLE_INDEX_SHARDS=4)
+    def test_inserts_into_indexed_tables_write_one_file(self):
+        self.create(indexes={"qty": "hash"})
+        append_rows(self.engine, "shop", "orders", [{"id": "a", "qty": 1}])
+        with mock.patch.object(self.engine, "commit", wraps=self.engine.commit) as commit:
+            append_rows(self.engine, "shop", "orders", [{"id": "b", "qty": 2}])
+        self.assertEqual(commit.call_count, 0)
+        self.assertEqual([row["id"] for row in self.load().scan([("qty", "eq", 2)])], ["a", "b"])
+
+    @override_settings(TABLE_WRITE_RETRIES=50, TABLE_WRITE_RETRY_BACKOFF=0.005)
+    def test_concurrent_writers_all_land(self):
+        self.engine = GitStorageEngine(f"{self.enterContext(tempfile.TemporaryDirectory())}/data.git")
+        self.create()
+        append_rows(self.engine, "shop", "orders", [{"id": "counter", "count": 0}])
+
+        def write(i):
+            append_rows(self.engine, "shop", "orders", [{"id": str(i)}])
+            # Each update reads the count again when it is retried
+            transact(self.engine, self.path, lambda table: table.update(
+                "counter", {"count": table.find("counter")["count"] + 1}), "Counted")
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        table = self.load()
+        self.assertEqual(len(list(table.rows())), 7)
+        self.assertEqual(table.find("counter")["count"], 6)
+
+    @override_settings(TABLE_WRITE_RETRIES=2, TABLE_WRITE_RETRY_BACKOFF=0)
+    def test_retries_are_bounded(self):
+        self.create()
+        append_rows(self.engine, "shop", "orders", [{"id": "a", "qty": 1}])
+        before = transaction_stats.stats()
+        with mock.patch("tableStorage.tables.Table.save", side_effect=Conflict(self.path)) as save:
+            with self.assertRaises(Conflict):
+                update_row(self.engine, self.path, "a", {"qty": 2})
+        self.assertEqual(save.call_count, 3)
+        after = transaction_stats.stats()
+        self.assertEqual((after["exhausted"] - before["exhausted"], after["retries"] - before["retries"]), (1, 2))
+        self.assertEqual(self.load().find("a"), {"id": "a", "qty": 1})
+
+    @override_settings(TABLE_SEGMENT_MAX_BYTES=150)
+    def test_full_segments_roll_over(self):
+        self.create()
+        for i in range(10):
+            append_rows(self.engine, "shop", "orders", [{"id": str(i), "text": "x" * 40}])
+        table = self.load()
+        self.assertEqual(len(table.segment_names), 5)
+        self.assertEqual(
+            sorted(path for path in table.files() if "/index/" not in path),
+            [self.path] + [f"shop/Tables/orders/{name}.ndjson" for name in table.segment_names],
+        )
+        self.assertEqual([row["id"] for row in table.rows()], [str(i) for i in range(10)])
+        self.assertEqual(table.find("3"), {"id": "3", "text": "x" * 40})
+        self.assertIsNone(table.find("10"))
+
+    @override_settings(TABLE_SEGMENT_MAX_BYTES=100)
+    def test_emptied_segments_are_dropped(self):
+        self.create()
+        append_rows(self.engine, "shop", "orders", [{"id": str(i), "text": "x" * 40} for i in range(6)])
+        first = self.load().segment_names[0]
+        delete_rows(self.engine, self.path, ["0", "1"])
+        table = self.load()
+        self.assertNotIn(first, table.segment_names)
+        self.assertNotIn(f"shop/Tables/orders/{first}.ndjson", table.files())
+        self.assertEqual([row["id"] for row in table.rows()], ["2", "3", "4", "5"])
+
+    def test_single_array_table_is_split_by_its_first_write(self):
+        self.engine.write(self.path, "Created table", json.dumps([{"id": "a"}, {"id": "b"}]))
+        self.assertEqual(self.load().find("b"), {"id": "b"})
+        append_rows(self.engine, "shop", "orders", [{"id": "c"}])
+        table = self.load()
+        self.assertIsNotNone(table.manifest)
+        self.assertEqual([row["id"] for row in table.rows()], ["a", "b", "c"])
+
+    def test_rows_round_trip_in_each_format(self):
+        rows = [{"id": "a", "text": "two\nlines"}, {"id": "b", "tags": ["x", 1, True]}]
+        for row_format in ROW_FORMATS:
+            with self.subTest(row_format=row_format):
+                content = encode_rows(rows, row_format).encode("utf-8")
+                self.assertEqual(list(decode_rows(content, row_format)), rows)
+        self.assertEqual(encode_rows(rows, "ndjson").count("\n"), 2)
+        with tempfile.TemporaryFile() as file:
+            # Segments read from disk are memory-mapped
+            file.write(encode_rows(rows, "ndjson").encode("utf-8"))
+            file.flush()
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                self.assertEqual(list(decode_rows(content, "ndjson")), rows)
+
+    def test_table_keeps_its_row_format(self):
+        self.create("json")
+        append_rows(self.engine, "shop", "orders", [{"id": "a"}, {"id": "b"}])
+        table = self.load()
+        segment = self.engine.read(f"shop/Tables/orders/{table.segment_names[0]}.json")
+        self.assertEqual(json.loads(segment.decoded_content), [{"id": "a"}, {"id": "b"}])
+
+    @override_settings(TABLE_ROW_FORMAT="ndjson")
+    def test_segments_older_than_row_formats_are_rewritten(self):
+        manifest = {"format": "segments", "segments": ["000001"], "next_segment": 2}
+        self.engine.write(self.path, "Created table", json.dumps(manifest))
+        self.engine.write("shop/Tables/orders/000001.json", "Inserted rows", json.dumps([{"id": "a"}], indent=4))
+        self.assertEqual(self.load().find("a"), {"id": "a"})
+        append_rows(self.engine, "shop", "orders", [{"id": "b"}])
+        table = self.load()
+        self.assertEqual(table.row_format, "ndjson")
+        self.assertNotIn("shop/Tables/orders/000001.json", table.files())
+        segment = self.engine.read("shop/Tables/orders/000001.ndjson")
+        self.assertEqual(segment.decoded_content, b'{"id":"a"}\n{"id":"b"}\n')
+
+    @override_settings(TABLE_SEGMENT_MAX_BYTES=150, TABLE_INDEX_SHARDS=4)
+    def test_lookups_by_id_read_the_indexed_segment_only(self):
+        self.create()
+        append_rows(self.engine, "shop", "orders", [{"id": str(i), "text": "x" * 40} for i in range(10)])
+        table = self.load()
+        self.assertEqual(len(table.segment_names), 5)
+        with mock.patch.object(self.engine, "read", wraps=self.engine.read) as read:
+            self.assertEqual(table.find("2"), {"id": "2", "text": "x" * 40})
+        segments = [call.args[0] for call in read.call_args_list if "/index/" not in call.args[0]]
+        self.assertEqual(segments, [f"shop/Tables/orders/{table.segment_names[1]}.ndjson"])
+        self.assertEqual(read.call_count, 2)  # And one index shard
+
+        with mock.patch.object(self.engine, "commit", wraps=self.engine.commit) as commit:
+            update_row(self.engine, self.path, "2", {"qty": 1})
+        self.assertEqual(commit.call_count, 0)  # A single segment write
+        self.assertEqual(self.load().find("2"), {"id": "2", "text": "x" * 40, "qty": 1})
+
+    @override_settings(TABLE_SEGMENT_MAX_BYTES=150, TABLE_INDEX_SHARDS=0)
+    def test_index_is_built_by_the_first_write_once_enabled(self):
+        self.create()
+        append_rows(self.engine, "shop", "orders", [{"id": str(i), "text": "x" * 40} for i in range(6)])
+        self.assertFalse(self.load().indexed)
+        with override_settings(TABLE_INDEX_SHARDS=4):
+            append_rows(self.engine, "shop", "orders", [{"id": "6"}])
+        table = self.load()
+        self.assertTrue(table.indexed)
+        with mock.patch.object(self.engine, "read", wraps=self.engine.read) as read:
+            self.assertEqual(table.find("0"), {"id": "0", "text": "x" * 40})
+        self.assertEqual(read.call_count, 2)
+
+    def test_clear_keeps_the_row_format_and_indexes(self):
+        self.create("json", {"qty": "hash"})
+        append_rows(self.engine, "shop", "orders", [{"id": "a", "qty": 1}])
+        clear_rows(self.engine, self.path)
+        table = self.load()
+        self.assertEqual(table.row_format, "json")
+        self.assertEqual(list(table.secondary_indexes), ["qty"])
+        self.assertFalse(table.has_rows())
+
+
+@override_settings(TABLE_SEGMENT_MAX_BYTES=150)
+class IndexTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = LocalStorageEngine(self.enterContext(tempfile.TemporaryDirectory()))
+        self.path = "shop/Tables/orders.json"
+        self.rows = [{"id": str(i), "qty": i, "customer": {"name": f"c{i % 3}"}, "text": "x" * 40} for i in range(9)]
+
+    def create(self, indexes=None):
+        self.engine.write(self.path, "Created table", new_table(None, indexes))
+        append_rows(self.engine, "shop", "orders", self.rows)
+        return Table.load(self.engine, self.path)
+
+    def holding(self, table, predicate):
+        return {name for name in table.segment_names if any(predicate(row) for row in table.rows({name}))}
+
+    def test_hash_index_narrows_equality(self):
+        table = self.create({"customer.name": "hash"})
+        self.assertGreater(len(table.segment_names), 3)
+        names = table.segments_for("customer.name", "eq", "c1")
+        self.assertLess(len(names), len(table.segment_names))
+        self.assertLessEqual(self.holding(table, lambda row: row["customer"]["name"] == "c1"), names)
+        self.assertEqual(
+            table.segments_for("customer.name", "in", ["c1", "c2"]),
+            names | table.segments_for("customer.name", "eq", "c2"),
+        )
+        self.assertIsNone(table.segments_for("customer.name", "lt", "c1"))
+        self.assertIsNone(table.segments_for("qty", "eq", 1))
+
+    def test_sorted_index_narrows_ranges(self):
+        table = self.create({"qty": "sorted"})
+        names = table.segments_for("qty", "lt", 2)
+        self.assertEqual(names, self.holding(table, lambda row: row["qty"] < 2) | {table.segment_names[-1]})
+        self.assertLess(len(names), len(table.segment_names))
+        self.assertEqual(sorted(row["id"] for row in table.scan([("qty", "lt", 2)]) if row["qty"] < 2), ["0", "1"])
+
+    def test_updates_move_rows_in_the_indexes(self):
+        table = self.create({"qty": "sorted"})
+        update_row(self.engine, self.path, "0", {"qty": 100})
+        table = Table.load(self.engine, self.path)
+        self.assertIn(table.segment_names[0], table.segments_for("qty", "gt", 50))
+
+    def test_backfill_builds_the_declared_indexes(self):
+        table = self.create()
+        self.assertEqual(table.secondary_indexes, {})
+        schema = {"qty": "integer", "_indexes": [{"field": "qty", "type": "sorted"}]}
+        self.engine.write("shop/Schema/orders.json", "Created table", json.dumps(schema))
+        backfill = IndexBackfill()
+        backfill.schedule(self.engine, "shop", "orders").join()
+        self.assertEqual(backfill.stats()["shop/orders"]["state"], "done")
+        self.assertEqual(backfill.stats()["shop/orders"]["indexes"], ["qty"])
+        table = Table.load(self.engine, self.path)
+        self.assertEqual(table.segments_for("qty", "gt", 7), {table.segment_names[-1]})
+        self.assertEqual([row["id"] for row in table.rows()], [row["id"] for row in self.rows])
+
+        # Dropping the declaration drops the index
+        self.engine.write("shop/Schema/orders.json", "Updated schema", json.dumps({"qty": "integer"}),
+                          self.engine.read("shop/Schema/orders.json").sha)
+        backfill.schedule(self.engine, "shop", "orders").join()
+        table = Table.load(self.engine, self.path)
+        self.assertEqual(table.secondary_indexes, {})
+        self.assertFalse([path for path in table.files() if "/index/qty/" in path])
+
+    def test_failed_backfill_is_reported(self):
+        self.create()
+        backfill = IndexBackfill()
+        backfill.schedule(self.engine, "shop", "orders").join()
+        self.assertEqual(backfill.stats()["shop/orders"]["state"], "failed")
+
+
+class QueryTests(SimpleTestCase):
+    ROWS = [
+        {"id": "a", "total": 120, "paid": True, "tags": ["gift", "new"], "customer": {"name": "Ann"}},
+        {"id": "b", "total": 1, "paid": False, "tags": [], "customer": {"name": "Bob"}},
+        {"id": "c", "total": 40, "paid": 1, "tags": ["gift"], "customer": {"name": "Cy"}},
+        {"id": "d", "total": 300, "note": "gift wrap", "items": [{"sku": "x"}, {"sku": "y"}]},
+    ]
+
+    def setUp(self):
+        self.engine = LocalStorageEngine(self.enterContext(tempfile.TemporaryDirectory()))
+        for table_name, indexes in [("orders", None), ("indexed", {"paid": "hash"})]:
+            self.engine.write(f"shop/Tables/{table_name}.json", "Created table", new_table(None, indexes))
+            append_rows(self.engine, "shop", table_name, self.ROWS)
+
+    def run_query(self, filters=None, indexes=None, **options):
+        table = Table.load(self.engine, "shop/Tables/indexed.json" if indexes else "shop/Tables/orders.json")
+        return Query(filters, **options).run(table)
+
+    def ids(self, filters=None, indexes=None, **options):
+        return [row["id"] for row in self.run_query(filters, indexes, **options)]
+
+    def test_operators(self):
+        self.assertEqual(self.ids({"customer.name": "Bob"}), ["b"])
+        self.assertEqual(self.ids({"total": {"ne": 1}}), ["a", "c", "d"])
+        self.assertEqual(self.ids({"total": {"gt": 40, "lt": 300}}), ["a"])
+        self.assertEqual(self.ids({"items.sku": {"in": ["y", "z"]}}), ["d"])
+        self.assertEqual(self.ids({"tags": {"contains": "gift"}, "note": {"contains": "wrap"}}), [])
+        self.assertEqual(self.ids({"note": {"contains": "wrap"}}), ["d"])
+        self.assertEqual(self.ids({"tags": "new"}), ["a"])
+
+    def test_equality_tells_booleans_from_numbers(self):
+        for indexes in (None, {"paid": "hash"}):
+            self.assertEqual(self.ids({"paid": True}, indexes), ["a"])
+            self.assertEqual(self.ids({"paid": 1}, indexes), ["c"])
+            self.assertEqual(self.ids({"paid": {"in": [1]}}, indexes), ["c"])
+            self.assertEqual(self.ids({"paid": {"ne": True}}, indexes), ["b", "c", "d"])
+
+    def test_sort_fields_and_limit(self):
+        self.assertEqual(self.ids(sort=["-total"], limit=2), ["d", "a"])
+        self.assertEqual(self.ids(sort="customer.name"), ["a", "b", "c", "d"])  # missing values last
+        rows = self.run_query({"id": "a"}, fields=["id", "customer.name"])
+        self.assertEqual(rows, [{"id": "a", "customer": {"name": "Ann"}}])
+
+    def test_malformed_queries(self):
+        for filters, options in [([], {}), ({"id": {"in": "a"}}, {}), ({}, {"limit": -1}), ({}, {"sort": [1]})]:
+            with self.assertRaises(QueryError):
+                Query(filters, **options)
+
+
+@override_settings(TABLE_STREAM_CHUNK_BYTES=100)
+class StreamingTests(SimpleTestCase):
+    def test_pieces_are_sent_in_chunks(self):
+        chunks = list(chunked(["x" * 30] * 10 + [b"y"]))
+        self.assertEqual([len(chunk) for chunk in chunks], [120, 120, 61])
+        self.assertEqual(b"".join(chunks), b"x" * 300 + b"y")
+        self.assertEqual(list(chunked([])), [])
+
+    def test_rows_are_rendered_as_drf_does(self):
+        rows = [{"id": str(i), "text": "caf\u00e9 \u2028", "n": [i, None, True]} for i in range(20)]
+        self.assertEqual(b"".join(json_array(iter(rows))), JSONRenderer().render(rows))
+        self.assertEqual(b"".join(json_array(iter([]))), b"[]")
+
+    def test_rows_are_read_as_chunks_are_sent(self):
+        read = []
+
+        def rows():
+            for i in range(100):
+                read.append(i)
+                yield {"id": str(i)}
+
+        next(json_array(rows()))
+        self.assertLess(len(read), 20)
+
+    def test_prefetch_keeps_the_order_and_reads_ahead_a_few(self):
+        fetched = []
+
+        def fetch(item):
+            fetched.append(item)
+            time.sleep(0.01 * (5 - item % 5))
+            return item * 2
+
+        items = prefetch(range(20), fetch, 4)
+        self.assertEqual(next(items), 0)
+        self.assertLessEqual(len(fetched), 4)
+        self.assertEqual(list(items), [item * 2 for item in range(1, 20)])
+        self.assertEqual(list(prefetch(range(3), fetch, 1)), [0, 2, 4])
+
+
+class GroupCommitTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = GitStorageEngine(f"{self.enterContext(tempfile.TemporaryDirectory())}/data.git")
+        self.engine.write("shop/Tables/orders.json", "Created table", new_table())
+
+    def submit_all(self, committer, count):
+        errors = []
+
+        def submit(i):
+            try:
+                committer.submit(self.engine, "shop", "orders", [{"id": str(i)}])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_concurrent_inserts_share_a_commit(self):
+        committer = GroupCommitter(window=0.5, max_rows=100)
+        self.assertEqual(self.submit_all(committer, 5), [])
+        rows = Table.load(self.engine, "shop/Tables/orders.json").rows()
+        self.assertEqual(sorted(row["id"] for row in rows), ["0", "1", "2", "3", "4"])
+        self.assertEqual(len(self.engine.history(["shop/Tables"])), 2)  # created, then one insert
+        self.assertEqual((committer.stats()["flushes"], committer.stats()["largest_batch"]), (1, 5))
+
+    def test_group_sizes_and_waits_are_exported(self):
+        def exported():
+            lines = self.client.get("/metrics").content.decode().splitlines()
+            return {line.split()[0]: float(line.split()[1]) for line in lines
+                    if line.startswith(("storage_group_commit_rows", "storage_group_commit_wait_seconds"))}
+
+        before = exported()
+        self.assertEqual(self.submit_all(GroupCommitter(window=0.2, max_rows=100), 5), [])
+        after = exported()
+        changes = {name: after[name] - before.get(name, 0) for name in after}
+        self.assertEqual(changes["storage_group_commit_rows_count"], 1)
+        self.assertEqual(changes["storage_group_commit_rows_sum"], 5)
+        self.assertEqual(changes['storage_group_commit_rows_bucket{le="2"}'], 0)
+        self.assertEqual(changes['storage_group_commit_rows_bucket{le="5"}'], 1)
+        self.assertEqual(changes["storage_group_commit_wait_seconds_count"], 5)
+        self.assertGreaterEqual(changes["storage_group_commit_wait_seconds_sum"], 0.2)  # the leader waited the window
+
+    def test_a_full_batch_does_not_wait_for_the_window(self):
+        committer = GroupCommitter(window=30, max_rows=2)
+        started = time.monotonic()
+        self.assertEqual(self.submit_all(committer, 2), [])
+        self.assertLess(time.monotonic() - started, 10)
+
+    def test_every_caller_sees_the_error(self):
+        committer = GroupCommitter(window=0.5, max_rows=100)
+        with mock.patch("tableStorage.groupcommit.append_rows", side_effect=Conflict("shop/Tables/orders.json")):
+            errors = self.submit_all(committer, 3)
+        self.assertEqual([type(error) for error in errors], [Conflict] * 3)
+        self.assertEqual(committer.stats()["queue_depth"], 0)
+
+
+@override_settings(TABLE_SEGMENT_MAX_BYTES=500, TABLE_STREAM_CHUNK_BYTES=100, STORAGE_EXPORT_WORKERS=3)
+class ExportTests(SimpleTestCase):
+    schema = {"n": "integer", "customer": {"name": "string"}, "tags": ["string"]}
+
+    def setUp(self):
+        self.engine = LocalStorageEngine(self.enterContext(tempfile.TemporaryDirectory()))
+        self.engine.write("shop/Schema/orders.json", "Created table", json.dumps(self.schema))
+        self.rows = [{"id": str(i), "n": i, "customer": {"name": f"name {i}"}, "tags": ["a"]} for i in range(50)]
+        append_rows(self.engine, "shop", "orders", self.rows)
+
+    def table(self):
+        return Table.load(self.engine, "shop/Tables/orders.json")
+
+    def test_table_as_ndjson(self):
+        body = b"".join(export_table(self.table(), self.schema, "ndjson"))
+        self.assertEqual([json.loads(line) for line in body.splitlines()], self.rows)
+
+    def test_table_as_csv(self):
+        lines = b"".join(export_table(self.table(), self.schema, "csv")).decode().splitlines()
+        self.assertEqual(lines[:2], ["id,n,customer.name,tags", '0,0,name 0,"[""a""]"'])
+        self.assertEqual(len(lines), 51)
+
+    def test_database_as_tar(self):
+        archive = tarfile.open(fileobj=io.BytesIO(b"".join(export_database(self.engine, "shop", "tar"))))
+        files = {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+        self.assertEqual(json.loads(files["shop/Schema/orders.json"]), self.schema)
+        self.assertEqual([json.loads(line) for line in files["shop/Tables/orders.ndjson"].splitlines()], self.rows)
+
+
+class GitHubClientTests(SimpleTestCase):
+    def setUp(self):
+        self.fake = self.enterContext(FakeGitHub(seed=1))
+        self.enterContext(override_settings(GITHUB_API_URL=self.fake.url, GITHUB_REPO=REPO_NAME, GITHUB_TOKEN="t"))
+        reset()
+        self.addCleanup(reset)
+
+    def test_client_and_repository_are_shared(self):
+        self.assertIs(get_github(), get_github())
+        repo = get_repo()
+        calls = self.fake.stats()["calls"]
+        self.assertIs(get_repo(REPO_NAME), repo)
+        self.assertEqual(self.fake.stats()["calls"], calls)  # resolved once
+        client = get_github()
+        reset()
+        self.assertIsNot(get_github(), client)
+
+        # Workers asking at once still resolve it once
+        calls = self.fake.stats()["calls"]
+        repos = []
+        threads = [threading.Thread(target=lambda: repos.append(get_repo())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len({id(found) for found in repos}), 1)
+        self.assertIsNot(repos[0], repo)
+        self.assertEqual(self.fake.stats()["calls"], calls + 1)
+
+    def test_only_reads_are_retried(self):
+        retry = retry_policy()
+        self.assertTrue(retry.is_retry("GET", 502))
+        for method in ("POST", "PUT", "PATCH", "DELETE"):
+            self.assertFalse(retry.is_retry(method, 502))
+        self.assertFalse(retry.is_retry("GET", 404))
+        self.assertGreater(retry.backoff_factor, 0)
+        self.assertLessEqual(retry.total, 5)
+
+
+class RateLimitGovernorTests(SimpleTestCase):
+    def governor(self, rate=0, burst=10, reserve=100, max_wait=0.5, retries=2):
+        return RateLimitGovernor(rate, burst, reserve, max_wait, 60, retries, backoff=0.01)
+
+    def test_rate_limit_answer_is_retried(self):
+        governor = self.governor()
+        answers = [GithubException(429, None, {"Retry-After": "0"}), "result"]
+
+        def call():
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        self.assertEqual(governor.call(call), "result")
+        self.assertEqual(governor.stats()["retried"], 1)
+
+    def test_other_errors_are_not_retried(self):
+        governor = self.governor()
+        call = mock.Mock(side_effect=GithubException(403, {"message": "Forbidden"}, {}))
+        with self.assertRaises(GithubException):
+            governor.call(call)
+        call.assert_called_once()
+
+    def test_long_backoff_is_shed(self):
+        governor = self.governor()
+        call = mock.Mock(side_effect=GithubException(403, None, {"retry-after": "60"}))
+        with self.assertRaises(RateLimited) as raised:
+            governor.call(call)
+        self.assertGreaterEqual(raised.exception.retry_after, 60)
+        self.assertEqual(governor.stats()["shed"], 1)
+
+    def test_reserve_is_kept_for_interactive_reads(self):
+        governor = self.governor()
+        governor.observe({"X-RateLimit-Remaining": "50", "X-RateLimit-Limit": "5000",
+                          "X-RateLimit-Reset": str(int(time.time()) + 600)})
+        self.assertEqual(governor.call(lambda: "read"), "read")
+        with self.assertRaises(RateLimited):
+            governor.call(lambda: "write", write=True)
+        with bulk(), self.assertRaises(RateLimited):
+            governor.call(lambda: "import")
+        self.assertEqual(governor.stats()["remaining"], 50)
+
+    def test_empty_bucket_sheds_after_max_wait(self):
+        governor = self.governor(rate=1, burst=1)
+        governor.acquire(INTERACTIVE)
+        with self.assertRaises(RateLimited):
+            governor.acquire(INTERACTIVE)
+
+    def test_calls_are_counted_by_priority(self):
+        governor = self.governor(rate=100, burst=2)
+        for priority in (INTERACTIVE, WRITE, BULK, BULK):
+            governor.acquire(priority)
+        stats = governor.stats()
+        self.assertEqual(stats["calls"], {"interactive": 1, "write": 1, "bulk": 2})
+        self.assertGreater(stats["wait_seconds"]["bulk"], 0)
+
+
+class FakeGitHubTests(SimpleTestCase):
+    def engine(self, governor=None, **options):
+        fake, github = fake_github(self, **options)
+        repo = (governor.call if governor else lambda call: call())(lambda: github.get_repo(REPO_NAME))
+        return fake, GitHubStorageEngine(repo, governor=governor)
+
+    def test_files_and_commits(self):
+        _, engine = self.engine()
+        sha = engine.write("shop/Schema/orders.json", "Created schema", '{"id": "string"}')
+        self.assertEqual(engine.read("shop/Schema/orders.json").sha, sha)
+        engine.commit("Created table", {"shop/Tables/orders.json": "[]", "shop/Schema/orders.json": None})
+        paths = sorted(stored.path for stored in engine.walk("shop"))
+        self.assertEqual(paths, ["shop/Tables", "shop/Tables/orders.json"])
+
+    def test_injected_conflict(self):
+        _, engine = self.engine(conflict_rate=1)
+        with self.assertRaises(Conflict):
+            engine.write("shop/Tables/orders.json", "Created table", "[]")
+
+    def test_commit_is_rebuilt_on_a_moved_branch(self):
+        _, engine = self.engine()
+        create_git_commit = engine.repo.create_git_commit
+
+        def racing(*args):
+            # Another writer moves the branch once, after the tree was built
+            engine.repo.create_git_commit = create_git_commit
+            engine.write(racing.path, "Another writer", "{}")
+            return create_git_commit(*args)
+
+        racing.path = "shop/Schema/orders.json"
+        engine.repo.create_git_commit = racing
+        engine.commit("Created table", {"shop/Tables/orders.json": "[]"}, expected={"shop/Tables/orders.json": None})
+        paths = [stored.path for stored in engine.walk("shop") if stored.type == "file"]
+        self.assertEqual(sorted(paths), ["shop/Schema/orders.json", "shop/Tables/orders.json"])
+
+        # Unless it changed a path the commit expects
+        racing.path = "shop/Tables/items.json"
+        engine.repo.create_git_commit = racing
+        with self.assertRaises(Conflict):
+            engine.commit("Created table", {"shop/Tables/items.json": "[]"}, expected={"shop/Tables/items.json": None})
+
+    def test_expected_paths_of_large_folders_are_checked(self):
+        _, engine = self.engine(contents_max_entries=5)
+        engine.commit("Inserted rows", {f"shop/Tables/orders/{i:06d}.ndjson": str(i) for i in range(1, 9)})
+        path = "shop/Tables/orders/000008.ndjson"
+        self.assertEqual(len(engine.list("shop/Tables/orders")), 5)  # as GitHub's listings are cut
+        engine.commit("Inserted rows", {path: "9"}, expected={path: blob_sha(b"8")})
+        self.assertEqual(engine.read(path).decoded_content, b"9")
+        with self.assertRaises(Conflict):
+            engine.commit("Inserted rows", {path: "10"}, expected={path: blob_sha(b"8")})
+
+    def test_injected_rate_limit_is_retried(self):
+        governor = RateLimitGovernor(0, 10, 0, 5, 5, 50, backoff=0.01)
+        fake, engine = self.engine(governor, rate_limit_rate=0.5, retry_after=0)
+        engine.write("shop/Tables/orders.json", "Created table", "[]")
+        self.assertEqual(engine.read("shop/Tables/orders.json").decoded_content, b"[]")
+        self.assertEqual(governor.stats()["retried"], fake.stats()["rate_limited"])
+
+    def test_history(self):
+        _, engine = self.engine()
+        first = engine.commit("Created table", {"shop/Tables/orders.json": "[]"})
+        engine.commit("Created schema", {"shop/Schema/orders.json": "{}"})
+        second = engine.commit("Added rows", {"shop/Tables/orders.json": '[{"id": "a"}]'})
+        self.assertEqual(engine.resolve(first[:7]), first)
+        commits = engine.history(["shop/Tables/orders.json"])
+        self.assertEqual([commit["sha"] for commit in commits], [second, first])
+        self.assertEqual(commits[0]["message"], "Added rows")
+        snapshot = SnapshotStorageEngine(engine, first)
+        self.assertEqual(snapshot.read("shop/Tables/orders.json").decoded_content, b"[]")
+        self.assertEqual([stored.path for stored in snapshot.walk("shop")], ["shop/Tables", "shop/Tables/orders.json"])
+
+
+class WalkTests(SimpleTestCase):
+    files = {
+        "shop/Tables/orders.json": "[]", "shop/Tables/orders/000001.ndjson": "", "shop/Schema/orders.json": "{}",
+        "blog/Tables/posts.json": "[]", "blog/Schema/posts.json": "{}",
+    }
+
+    def engine(self, **options):
+        self.fake, github = fake_github(self, **options)
+        engine = GitHubStorageEngine(github.get_repo(REPO_NAME))
+        engine.commit("Created databases", self.files)
+        return engine
+
+    def walked(self, engine, path):
+        calls = self.fake.stats()["calls"]
+        paths = sorted(entry.path for entry in engine.walk(path) if entry.type == "file")
+        return paths, self.fake.stats()["calls"] - calls
+
+    def test_a_walk_is_one_tree_request(self):
+        engine = self.engine()
+        self.assertEqual(self.walked(engine, ""), (sorted(self.files), 1))
+        shop = sorted(path for path in self.files if path.startswith("shop/"))
+        self.assertEqual(self.walked(engine, "shop"), (shop, 2))  # and the listing giving its tree
+        with self.assertRaises(NotFound):
+            engine.walk("news")
+
+    def test_truncated_trees_are_walked_level_by_level(self):
+        engine = self.engine(tree_max_entries=3)
+        paths, calls = self.walked(engine, "")
+        self.assertEqual(paths, sorted(self.files))
+        self.assertGreater(calls, 1)
+
+
+class BlobCacheTests(SimpleTestCase):
+    path = "shop/Tables/orders.json"
+
+    def setUp(self):
+        self.fake, github = fake_github(self)
+        self.repo = github.get_repo(REPO_NAME)
+        self.other_worker = GitHubStorageEngine(self.repo)
+        self.other_worker.write(self.path, "Created table", "[]")
+
+    def engine(self, ttl=0):
+        self.cache = BlobCache(1024 * 1024, ttl)
+        return GitHubStorageEngine(self.repo, cache=self.cache)
+
+    def calls(self, function):
+        calls = self.fake.stats()["calls"]
+        result = function()
+        return result, self.fake.stats()["calls"] - calls
+
+    def test_unchanged_file_is_revalidated(self):
+        engine = self.engine()
+        self.assertEqual(engine.read(self.path).decoded_content, b"[]")
+        self.assertEqual(engine.read(self.path).decoded_content, b"[]")
+        self.assertEqual((self.cache.stats()["misses"], self.cache.stats()["revalidations"]), (1, 1))
+
+        sha = self.other_worker.write(self.path, "Added rows", '[{"id": "a"}]', blob_sha(b"[]"))
+        self.assertEqual(engine.read(self.path).decoded_content, b'[{"id": "a"}]')
+        self.assertEqual(self.cache.get(self.path).sha, sha)
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_fresh_entries_and_known_shas_are_served_without_a_request(self):
+        engine = self.engine(ttl=60)
+        engine.read(self.path)
+        self.assertEqual(self.calls(lambda: engine.read(self.path).decoded_content), (b"[]", 0))
+
+        engine = self.engine()
+        engine.read(self.path)
+        self.assertEqual(self.calls(lambda: engine.read(self.path, blob_sha(b"[]")).decoded_content), (b"[]", 0))
+
+    def test_own_writes_are_cached(self):
+        engine = self.engine(ttl=60)
+        engine.write(self.path, "Added rows", '[{"id": "a"}]', blob_sha(b"[]"))
+        self.assertEqual(self.calls(lambda: engine.read(self.path).decoded_content), (b'[{"id": "a"}]', 0))
+        engine.delete(self.path, "Deleted table")
+        self.assertIsNone(self.cache.get(self.path))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = BlobCache(10)
+        cache.put("a", "1", b"aaaa")
+        cache.put("b", "2", b"bbbb")
+        cache.get("a")
+        cache.put("c", "3", b"cccc")
+        self.assertEqual([path for path in "abc" if cache.get(path)], ["a", "c"])
+        cache.put("d", "4", b"d" * 11)  # larger than the whole cache
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual((cache.stats()["bytes"], cache.stats()["evictions"]), (8, 1))
+
+
+class CatalogTests(SimpleTestCase):
+    def setUp(self):
+        self.fake, github = fake_github(self)
+        self.repo = github.get_repo(REPO_NAME)
+        self.other_worker = GitHubStorageEngine(self.repo)
+        self.other_worker.commit("Created database", {"shop/Tables/.gitkeep": "", "shop/Schema/.gitkeep": ""})
+        self.other_worker.write("shop/Tables/orders.json", "Created table", "[]")
+        self.catalog = Catalog(ttl=60)
+        self.engine = GitHubStorageEngine(self.repo, catalog=self.catalog)
+
+    def calls(self, function):
+        calls = self.fake.stats()["calls"]
+        result = function()
+        return result, self.fake.stats()["calls"] - calls
+
+    def test_listings_are_served_from_one_walk(self):
+        self.assertEqual(self.calls(self.engine.list_databases)[0], ["shop"])
+        self.assertEqual(self.calls(lambda: self.engine.list_tables("shop")), (["orders"], 0))
+        self.assertEqual(self.calls(lambda: self.engine.database_exists("blog")), (False, 0))
+
+    def test_writes_of_the_api_are_tracked(self):
+        self.engine.list_databases()
+        self.engine.write("shop/Tables/items.json", "Created table", "[]")
+        self.engine.commit("Created database", {"blog/Tables/.gitkeep": "", "blog/Schema/.gitkeep": ""})
+        self.assertEqual(self.calls(lambda: self.engine.list_tables("shop")), (["items", "orders"], 0))
+        self.assertEqual(self.calls(self.engine.list_databases), (["blog", "shop"], 0))
+
+        self.engine.delete("shop/Tables/items.json", "Deleted table")
+        self.assertEqual(self.calls(lambda: self.engine.list_tables("shop")), (["orders"], 0))
+        # Deleting database files may delete the database: it is walked again
+        self.engine.commit("Deleted database", {"blog/Tables/.gitkeep": None, "blog/Schema/.gitkeep": None})
+        databases, calls = self.calls(self.engine.list_databases)
+        self.assertEqual(databases, ["shop"])
+        self.assertGreater(calls, 0)
+
+    def test_changes_made_elsewhere_show_after_the_ttl(self):
+        self.engine.list_databases()
+        self.other_worker.write("shop/Tables/items.json", "Created table", "[]")
+        self.assertEqual(self.engine.list_tables("shop"), ["orders"])
+        with mock.patch("tableStorage.catalog.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertEqual(self.engine.list_tables("shop"), ["items", "orders"])
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = LocalStorageEngine(self.enterContext(tempfile.TemporaryDirectory()))
+
+    def test_operations_of_a_request_are_added_up(self):
+        with measure_request() as timings:
+            sha = self.engine.write("shop/Tables/orders.json", "Created table", "[]")
+            # Reads the file first, as part of the delete
+            self.engine.delete("shop/Tables/orders.json", "Deleted table")
+        self.assertTrue(sha)
+        self.assertEqual({name: count for name, (count, _) in timings.operations.items()}, {"write": 1, "delete": 1})
+        self.assertRegex(timings.server_timing(0.5), r'^write;dur=[0-9.]+;desc="1 op", .*total;dur=500\.0$')
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("latency_seconds", "Latency.", ("operation",), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(("read",), value)
+        lines = list(histogram.render())
+        self.assertIn('latency_seconds_bucket{operation="read",le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{operation="read",le="1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{operation="read",le="+Inf"} 3', lines)
+        self.assertIn('latency_seconds_count{operation="read"} 3', lines)
+
+    def test_metrics_endpoint(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE storage_operation_seconds histogram", response.content.decode())
+        self.assertIn("total;dur=", response["Server-Timing"])
+
+
+class ReplicaTests(SimpleTestCase):
+    def setUp(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        self.primary = GitStorageEngine(f"{root}/data.git")
+        self.replica = Replica(f"{root}/clone", f"{root}/data.git", mmap_min_bytes=64).start()
+        self.primary.replica = self.replica
+
+    @property
+    def engine(self):
+        # A new one for each read, as for each request
+        return ReplicaStorageEngine(self.replica)
+
+    def test_own_writes_are_read_at_once(self):
+        self.primary.commit("Created database", {"shop/Tables/.gitkeep": "", "shop/Schema/.gitkeep": ""})
+        self.primary.write("shop/Tables/orders.json", "Created table", "[]")
+        self.assertEqual(self.engine.list_databases(), ["shop"])
+        self.assertEqual(self.engine.list_tables("shop"), ["orders"])
+        self.assertEqual(self.engine.read("shop/Tables/orders.json").decoded_content, b"[]")
+        self.assertEqual(self.replica.snapshot().own_writes, 2)
+
+        self.primary.delete("shop/Tables/orders.json", "Deleted table")
+        self.assertEqual(self.engine.list_tables("shop"), [])
+
+    def test_moved_files_are_reflected(self):
+        self.primary.write("shop/Tables/orders.json", "Created table", "[1]")
+        sha = self.primary.read("shop/Tables/orders.json").sha
+        with self.primary.batch("Renamed table") as batch:
+            batch.move("shop/Tables/orders.json", "shop/Tables/moved.json", sha)
+        self.assertEqual(self.engine.list_tables("shop"), ["moved"])
+        self.assertEqual(self.engine.read("shop/Tables/moved.json").decoded_content, b"[1]")
+
+    def test_sync_brings_in_writes_of_other_workers(self):
+        GitStorageEngine(self.primary.root).write("shop/Tables/orders.json", "Created table", "[]")
+        with self.assertRaises(NotFound):
+            self.engine.read("shop/Tables/orders.json")
+        self.assertEqual(self.replica.sync(), 1)
+        self.assertEqual(self.engine.read("shop/Tables/orders.json").decoded_content, b"[]")
+        self.assertEqual(self.replica.snapshot().own_writes, 0)
+
+    def test_reads_of_one_engine_stay_at_one_tree(self):
+        self.primary.commit("Created table", {"shop/Tables/orders.json": "1", "shop/Tables/orders/000001.ndjson": "a"})
+        engine = self.engine
+        self.assertEqual(engine.read("shop/Tables/orders.json").decoded_content, b"1")
+        # Another worker replaces the segment, then this one writes too
+        GitStorageEngine(self.primary.root).commit("Compacted", {
+            "shop/Tables/orders.json": "2", "shop/Tables/orders/000001.ndjson": None,
+            "shop/Tables/orders/000002.ndjson": "b",
+        })
+        self.replica.sync()
+        self.primary.commit("Changed", {"shop/Tables/orders.json": "3"})
+
+        self.assertEqual(engine.read("shop/Tables/orders/000001.ndjson").decoded_content, b"a")
+        segments = [entry.path for entry in engine.walk("shop/Tables/orders")]
+        self.assertEqual(segments, ["shop/Tables/orders/000001.ndjson"])
+        self.assertEqual(self.engine.read("shop/Tables/orders.json").decoded_content, b"3")
+        with self.assertRaises(NotFound):
+            self.engine.read("shop/Tables/orders/000001.ndjson")
+
+    def test_sync_waits_for_reads_in_progress(self):
+        GitStorageEngine(self.primary.root).write("shop/Tables/orders.json", "Created table", "[]")
+        sync = threading.Thread(target=self.replica.sync)
+        with self.replica._reading(None):
+            sync.start()
+            sync.join(0.3)
+            self.assertTrue(sync.is_alive())  # fetched, waiting to reset the working tree
+        sync.join()
+        self.assertEqual(self.engine.read("shop/Tables/orders.json").decoded_content, b"[]")
+
+    def test_responses_say_how_far_behind_they_were_read(self):
+        other = GitStorageEngine(self.primary.root)  # another worker, unknown to the clone
+        other.write("shop/Tables/orders.json", "Created table", "1")
+        self.replica.sync()
+        read_at = self.replica.head
+
+        def view(request):
+            engine = self.engine
+            engine.read("shop/Tables/orders.json")
+            for content in ("2", "3"):
+                other.write("shop/Tables/orders.json", "Changed", content, other.read("shop/Tables/orders.json").sha)
+            self.replica.sync()
+            self.assertEqual(engine.read("shop/Tables/orders.json").decoded_content, b"1")
+            return HttpResponse()
+
+        with mock.patch("tableStorage.replica.get_replica", return_value=self.replica):
+            response = ReplicaMiddleware(view)(RequestFactory().get("/table/schema/"))
+        self.assertEqual((response["X-Replica-Commit"], response["X-Replica-Behind"]), (read_at, "2"))
+        self.assertEqual(self.replica.behind(self.replica.snapshot()), 0)
+
+    def test_first_sync_runs_in_the_background(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        release = threading.Event()
+        sync = Replica.sync
+
+        def blocked_sync(replica):
+            release.wait(5)
+            return sync(replica)
+
+        replica_settings = override_settings(
+            STORAGE_ENGINE="git", STORAGE_LOCAL_PATH=str(self.primary.root), STORAGE_REPLICA_PATH=f"{root}/clone",
+            STORAGE_REPLICA_URL="", STORAGE_REPLICA_SYNC_INTERVAL=0, GITHUB_BRANCH="main",
+        )
+        with replica_settings, mock.patch("tableStorage.replica._replica", None), \
+                mock.patch.object(Replica, "sync", blocked_sync):
+            replica = get_replica()
+            self.addCleanup(replica.stop)
+            self.assertFalse(replica.ready)
+            self.assertIsInstance(get_read_engine(), GitStorageEngine)  # the primary meanwhile
+            release.set()
+            replica._thread.join(5)
+            self.assertTrue(replica.ready)
+            self.assertIsInstance(get_read_engine(), ReplicaStorageEngine)
+
+    def test_large_segments_are_memory_mapped(self):
+        rows = [{"id": str(i), "qty": i} for i in range(10)]
+        content = "".join(json.dumps(row) + "\n" for row in rows)
+        self.primary.write("shop/Tables/orders/000001.ndjson", "Inserted rows", content)
+        segment = self.engine.read("shop/Tables/orders/000001.ndjson")
+        self.assertIsInstance(segment.decoded_content, mmap.mmap)
+        self.assertEqual(segment.sha, blob_sha(content.encode("utf-8")))
+        self.assertEqual(list(decode_rows(segment.decoded_content, "ndjson")), rows)
+
+
+class WriteAheadLogTests(SimpleTestCase):
+    def setUp(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        self.engine = LocalStorageEngine(f"{root}/storage")
+        self.log = WriteAheadLog(f"{root}/wal.sqlite3")
+        self.path = "shop/Tables/orders.json"
+
+    def rows(self):
+        return list(Table.load(self.engine, self.path).rows())
+
+    def test_writes_of_a_table_are_shipped_in_one_commit(self):
+        self.log.append(self.path, "insert", {"rows": [{"id": "a", "qty": 1}, {"id": "b", "qty": 2}]})
+        self.log.append(self.path, "update", {"id": "a", "data": {"qty": 5}})
+        self.log.append(self.path, "delete", {"ids": ["b"]})
+        self.log.append(self.path, "update", {"id": "missing", "data": {"qty": 1}})
+
+        self.assertEqual(self.log.ship(self.engine), 4)
+        self.assertEqual(self.rows(), [{"id": "a", "qty": 5}])
+        stats = self.log.stats()
+        self.assertEqual((stats["backlog"], stats["commits"], stats["shipped"], stats["failed"]), (0, 1, 3, 1))
+        self.assertEqual(stats["recent_failures"][0]["error"], "Object not found")
+
+    def test_reads_see_pending_writes(self):
+        append_rows(self.engine, "shop", "orders", [{"id": "a", "qty": 1}, {"id": "b", "qty": 2}])
+        self.log.append(self.path, "update", {"id": "a", "data": {"qty": 9}})
+        self.log.append(self.path, "delete", {"ids": ["b"]})
+        self.log.append(self.path, "insert", {"rows": [{"id": "c", "qty": 3}]})
+
+        table = MergedTable(Table.load(self.engine, self.path), self.log.pending(self.path))
+        self.assertEqual(list(table.scan([])), [{"id": "a", "qty": 9}, {"id": "c", "qty": 3}])
+        self.assertIsNone(table.find("b"))
+        self.assertEqual(self.log.stats()["backlog"], 3)
+
+    def test_insert_retried_after_a_crash_is_not_applied_twice(self):
+        self.log.append(self.path, "insert", {"rows": [{"id": "a", "qty": 1}]})
+        # Committed by an attempt that died before marking it shipped
+        append_rows(self.engine, "shop", "orders", [{"id": "a", "qty": 1}])
+        self.log._connection().execute("UPDATE entries SET attempts = 1")
+
+        self.log.ship(self.engine)
+        self.assertEqual(self.rows(), [{"id": "a", "qty": 1}])
+
+
+    def test_writes_that_keep_failing_are_given_up(self):
+        self.log.max_attempts = 3
+        self.log.append(self.path, "insert", {"rows": [{"id": "a", "qty": 1}]})
+        with mock.patch("tableStorage.wal.transact", side_effect=Conflict(self.path)):
+            self.assertEqual([self.log.ship(self.engine) for _ in range(4)], [0, 0, 1, 0])
+        stats = self.log.stats()
+        self.assertEqual((stats["backlog"], stats["failed"]), (0, 1))
+        self.assertEqual(stats["recent_failures"][0]["error"], str(Conflict(self.path)))
+
+    def test_schema_and_export_see_pending_writes(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(STORAGE_ENGINE="local", STORAGE_LOCAL_PATH=root))
+        self.enterContext(mock.patch("tableStorage.wal.get_write_log", return_value=self.log))
+        client = self.client
+        client.post("/database/folders/", {"database_name": "shop"}, content_type="application/json")
+        schema = {"database_name": "shop", "table_name": "orders", "schema": {"qty": "integer"}}
+        client.post("/table/table/", schema, content_type="application/json")
+        self.log.append(self.path, "insert", {"rows": [{"id": "a", "qty": 1}]})
+
+        changed = {**schema, "schema": {"total": "integer"}}
+        self.assertEqual(client.post("/table/schema/", changed, content_type="application/json").status_code, 400)
+        response = client.get("/table/table-data/export/", {"database_name": "shop", "table_name": "orders"})
+        self.assertEqual(b"".join(response.streaming_content), b'{"id":"a","qty":1}\n')
+
+class HistoryTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = GitStorageEngine(f"{self.enterContext(tempfile.TemporaryDirectory())}/data.git")
+        self.path = "shop/Tables/orders.json"
+
+    def test_table_as_of_a_commit_or_a_time(self):
+        append_rows(self.engine, "shop", "orders", [{"id": "a"}])
+        first = self.engine.resolve()
+        moment = datetime.datetime.now(datetime.timezone.utc)
+        time.sleep(1.1)  # commit times have whole seconds
+        append_rows(self.engine, "shop", "orders", [{"id": "b"}])
+
+        self.assertEqual([commit["sha"] for commit in table_history(self.engine, "shop", "orders")][1], first)
+        self.assertEqual(resolve(self.engine, at=moment.isoformat()), first)
+        self.assertEqual(resolve(self.engine, at=str(moment.timestamp())), first)
+        table = Table.load(SnapshotStorageEngine(self.engine, first), self.path)
+        self.assertEqual(list(table.rows()), [{"id": "a"}])
+        with self.assertRaises(NotFound):
+            resolve(self.engine, at="2000-01-01T00:00:00Z")
+        with self.assertRaises(HistoryError):
+            resolve(self.engine, at="yesterday")
+
+    def test_objects_of_a_commit_are_fetched_once(self):
+        append_rows(self.engine, "shop", "orders", [{"id": "a"}])
+        commit = self.engine.resolve()
+        cache = ObjectCache(1024 * 1024)
+        with mock.patch.object(self.engine, "tree", wraps=self.engine.tree) as tree, \
+                mock.patch.object(self.engine, "blob", wraps=self.engine.blob) as blob:
+            for _ in range(3):
+                self.assertEqual(list(Table.load(SnapshotStorageEngine(self.engine, commit, cache), self.path).rows()),
+                                 [{"id": "a"}])
+        self.assertEqual(tree.call_count, 1)
+        self.assertEqual(blob.call_count, 2)  # the manifest and its segment
+        with self.assertRaises(StorageError):
+            SnapshotStorageEngine(self.engine, commit, cache).write(self.path, "Changed", "[]")
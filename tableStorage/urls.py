@@ -0,0 +1,7 @@
+from django.urls import path
+from .views import ReplicaSync, StorageStats
+
+urlpatterns = [
+    path("stats/", StorageStats.as_view(), name="storage-stats"),
+    path("replica/", ReplicaSync.as_view(), name="storage-replica"),
+]
@@ -1,3 +1,108 @@
-from django.shortcuts import render
+from django.http import HttpResponse
+from rest_framework.response import Response
+from rest_framework import status, views
+from . import metrics as storage_metrics
+from .aio import sync_view_stats
+from .backfill import get_index_backfill
+from .cache import get_blob_cache, get_object_cache
+from .governor import get_governor
+from .groupcommit import get_group_committer
+from .imports import get_import_tracker
+from .replica import ReplicaError, get_replica
+from .tables import transaction_stats
+from .wal import get_write_log
 
-# Create your views here.
+
+class StorageStats(views.APIView):
+
+    def get(self, request, *args, **kwargs):
+        """Report the counters of the storage layer caches"""
+        cache = get_blob_cache()
+        object_cache = get_object_cache()
+        committer = get_group_committer()
+        governor = get_governor(create=False)
+        replica = get_replica(create=False)
+        write_log = get_write_log(create=False)
+        return Response({
+            "blob_cache": cache.stats() if cache else None,
+            "object_cache": object_cache.stats() if object_cache else None,
+            "group_commit": committer.stats() if committer else None,
+            "table_writes": transaction_stats.stats(),
+            "index_builds": get_index_backfill().stats(),
+            "imports": get_import_tracker().stats(),
+            "sync_views": sync_view_stats.stats(),
+            "rate_limit": governor.stats() if governor else None,
+            "replica": replica.stats() if replica else None,
+            "write_log": write_log.stats() if write_log else None,
+        }, status=status.HTTP_200_OK)
+
+
+class ReplicaSync(views.APIView):
+
+    def get(self, request, *args, **kwargs):
+        """Report the state of the local clone"""
+        replica = get_replica()
+        if replica is None:
+            return Response({"error": "The local replica is not enabled"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(replica.stats(), status=status.HTTP_200_OK)
+
+    def post(self, request, *args, **kwargs):
+        """Bring the local clone up to date now"""
+        replica = get_replica()
+        if replica is None:
+            return Response({"error": "The local replica is not enabled"}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            fetched = replica.sync()
+        except ReplicaError as e:
+            return Response({"error": str(e)}, status=status.HTTP_502_BAD_GATEWAY)
+        return Response({"fetched": fetched, **replica.stats()}, status=status.HTTP_200_OK)
+
+
+def metrics(request):
+    """Serve the storage metrics in the Prometheus text format"""
+    cache = get_blob_cache()
+    object_cache = get_object_cache()
+    governor = get_governor(create=False)
+    replica = get_replica(create=False)
+    write_log = get_write_log(create=False)
+    samples = []
+    if cache:
+        samples.append(("storage_cache_bytes", "gauge", "Size of the cached file contents.",
+                        [({}, cache.stats()["bytes"])]))
+    if object_cache:
+        object_stats = object_cache.stats()
+        samples.append(("storage_object_cache_bytes", "gauge", "Size of the cached blobs and trees of past commits.",
+                        [({}, object_stats["bytes"])]))
+        samples.append(("storage_object_cache_requests_total", "counter", "Lookups in the cache of past commits.",
+                        [({"result": "hit"}, object_stats["hits"]), ({"result": "miss"}, object_stats["misses"])]))
+    if governor:
+        rate_limit = governor.stats()
+        if rate_limit["remaining"] is not None:
+            samples.append(("github_rate_limit_remaining", "gauge", "GitHub requests left before the quota resets.",
+                            [({}, rate_limit["remaining"])]))
+        samples.append(("github_rate_limit_queued", "gauge", "Calls waiting for the rate-limit governor.",
+                        [({"priority": name}, count) for name, count in rate_limit["queued"].items()]))
+        samples.append(("github_rate_limit_wait_seconds_total", "counter", "Time calls waited for the governor.",
+                        [({"priority": name}, seconds) for name, seconds in rate_limit["wait_seconds"].items()]))
+        samples.append(("github_rate_limit_shed_total", "counter", "Calls turned away by the governor.",
+                        [({}, rate_limit["shed"])]))
+    samples.append(("storage_sync_views_in_flight", "gauge", "Sync views async views are running in threads.",
+                    [({}, sync_view_stats.stats()["in_flight"])]))
+    if replica:
+        replica_stats = replica.stats()
+        samples.append(("storage_replica_own_writes", "gauge", "Own writes applied to the clone since it synced.",
+                        [({}, replica_stats["own_writes"])]))
+        if replica_stats["age_seconds"] is not None:
+            samples.append(("storage_replica_age_seconds", "gauge", "Seconds since the local clone last synced.",
+                            [({}, replica_stats["age_seconds"])]))
+        samples.append(("storage_replica_sync_failures_total", "counter", "Syncs of the local clone that failed.",
+                        [({}, replica_stats["failures"])]))
+    if write_log:
+        log_stats = write_log.stats()
+        samples.append(("storage_wal_backlog", "gauge", "Logged writes not shipped to storage yet.",
+                        [({}, log_stats["backlog"])]))
+        samples.append(("storage_wal_lag_seconds", "gauge", "Age of the oldest logged write not shipped yet.",
+                        [({}, log_stats["lag_seconds"])]))
+        samples.append(("storage_wal_shipped_total", "counter", "Logged writes shipped by this process.",
+                        [({"result": "shipped"}, log_stats["shipped"]), ({"result": "failed"}, log_stats["failed"])]))
+    return HttpResponse(storage_metrics.render(samples), content_type="text/plain; version=0.0.4; charset=utf-8")
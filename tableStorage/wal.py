@@ -0,0 +1,383 @@
+"""
+Write-ahead log for row writes.
+
+With `TABLE_WAL_PATH` set, `TableData` inserts, updates and deletes are not
+written to storage while the client waits. Each one is appended to a SQLite
+log on the local disk (WAL journal, `synchronous=FULL`, so it is fsynced
+before the append returns) and answered with a 202 carrying its sequence
+number. A shipper thread replays the log to storage in order: the pending
+writes of a table, up to `TABLE_WAL_BATCH_MAX` of them, become one table
+transaction and one commit.
+
+Every process on the host shares the log; one of them at a time holds the
+shipper lease. A write is marked shipped once its commit is done; if the
+process dies in between, the write is applied again by the next shipper,
+which skips the rows of such inserts that are already in the table.
+Updates and deletes of rows that do not exist are marked failed, as are
+writes to tables that do not exist; other errors are retried on the next
+round, up to `TABLE_WAL_MAX_ATTEMPTS` times before the writes are marked
+failed as well.
+
+`load_table` applies the writes still waiting in the log on top of what
+storage has, so reads on the host see every write it acknowledged.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+from .engines import NotFound, get_storage_engine
+from .tables import Table, transact
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    op TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_by_state ON entries (state, path, seq);
+CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL);
+"""
+
+OPERATIONS = ("insert", "update", "delete", "clear")
+LEASE_SECONDS = 60
+
+
+class LogEntry:
+    __slots__ = ("seq", "path", "op", "payload", "created_at", "attempts")
+
+    def __init__(self, seq, path, op, payload, created_at, attempts=0):
+        self.seq = seq
+        self.path = path
+        self.op = op
+        self.payload = json.loads(payload) if isinstance(payload, str) else payload
+        self.created_at = created_at
+        self.attempts = attempts
+
+
+class WriteAheadLog:
+    def __init__(self, path, batch_max=500, interval=0, max_attempts=10):
+        self.path = str(path)
+        self.batch_max = batch_max
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+        self.appended = 0
+        self.shipped = 0
+        self.failed = 0
+        self.commits = 0
+        self.ship_seconds = 0.0
+        self.last_shipped_seq = None
+        self.last_error = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit: every statement outside BEGIN is its own transaction
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            self._local.connection = connection
+        return connection
+
+    def append(self, path, op, payload):
+        """Log a write to the table at `path`, durably, and return its sequence number."""
+        if op not in OPERATIONS:
+            raise ValueError(f"Unknown logged operation '{op}'")
+        cursor = self._connection().execute(
+            "INSERT INTO entries (path, op, payload, created_at) VALUES (?, ?, ?, ?)",
+            (path, op, json.dumps(payload, separators=(",", ":")), time.time()),
+        )
+        with self._lock:
+            self.appended += 1
+        self._wake.set()
+        return cursor.lastrowid
+
+    def pending(self, path):
+        """Return the `LogEntry` writes to the table at `path` not shipped yet, oldest first."""
+        rows = self._connection().execute(
+            "SELECT seq, path, op, payload, created_at, attempts FROM entries"
+            " WHERE state = 'pending' AND path = ? ORDER BY seq",
+            (path,),
+        ).fetchall()
+        return [LogEntry(*row) for row in rows]
+
+    def _acquire_lease(self):
+        connection = self._connection()
+        now = time.time()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT holder, expires_at FROM lease WHERE name = 'shipper'").fetchone()
+            if row is not None and row[0] != self.holder and row[1] > now:
+                return False
+            connection.execute(
+                "INSERT OR REPLACE INTO lease (name, holder, expires_at) VALUES ('shipper', ?, ?)",
+                (self.holder, now + LEASE_SECONDS),
+            )
+            return True
+
+    def ship(self, engine):
+        """
+        Replay pending writes to `engine`, one batch per table, if this
+        process holds the shipper lease; return the number of writes done.
+        """
+        if not self._acquire_lease():
+            return 0
+        connection = self._connection()
+        rows = connection.execute(
+            "SELECT seq, path, op, payload, created_at, attempts FROM entries WHERE state = 'pending' ORDER BY seq"
+        ).fetchall()
+        batches = {}
+        for row in rows:
+            batch = batches.setdefault(row[1], [])
+            if len(batch) < self.batch_max:
+                batch.append(LogEntry(*row))
+        done = 0
+        for path, entries in batches.items():
+            done += self._ship_batch(engine, path, entries)
+        return done
+
+    def _ship_batch(self, engine, path, entries):
+        connection = self._connection()
+        seqs = [entry.seq for entry in entries]
+        placeholders = ",".join("?" * len(seqs))
+        # Counted before the commit: a later attempt then knows it may be done already
+        connection.execute(f"UPDATE entries SET attempts = attempts + 1 WHERE seq IN ({placeholders})", seqs)
+        failures = {}
+
+        def operation(table):
+            failures.clear()
+            for entry in entries:
+                error = _apply(table, entry)
+                if error:
+                    failures[entry.seq] = error
+
+        started = time.monotonic()
+        try:
+            transact(
+                engine, path, operation, f"Applied {len(entries)} logged writes",
+                create=any(entry.op == "insert" for entry in entries),
+            )
+        except NotFound:
+            failures = {seq: "Table not found" for seq in seqs}
+        except Exception as e:
+            # Conflicts, rate limits, network: the batch stays pending, but
+            # not forever, or a write that always fails holds up its table
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.execute(f"UPDATE entries SET error = ? WHERE seq IN ({placeholders})", [str(e), *seqs])
+                given_up = connection.execute(
+                    f"UPDATE entries SET state = 'failed' WHERE attempts >= ? AND seq IN ({placeholders})",
+                    [self.max_attempts, *seqs],
+                ).rowcount
+            with self._lock:
+                self.last_error = f"{path}: {e}"
+                self.failed += given_up
+            return given_up
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            for seq, error in failures.items():
+                connection.execute("UPDATE entries SET state = 'failed', error = ? WHERE seq = ?", (error, seq))
+            connection.execute(f"DELETE FROM entries WHERE state = 'pending' AND seq IN ({placeholders})", seqs)
+        with self._lock:
+            self.commits += 1
+            self.shipped += len(entries) - len(failures)
+            self.failed += len(failures)
+            self.ship_seconds += time.monotonic() - started
+            self.last_shipped_seq = max(seqs)
+        return len(entries)
+
+    def start(self):
+        """Start shipping in a background thread, every `interval` seconds at most."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="wal-shipper", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Woken by appends in this process; the others are found by polling
+            self._wake.wait(self.interval or None)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                while self.ship(get_storage_engine()):
+                    pass
+            except Exception as e:
+                with self._lock:
+                    self.last_error = str(e)
+            if self.interval:
+                self._stop.wait(self.interval)
+
+    def stats(self):
+        connection = self._connection()
+        backlog, oldest = connection.execute(
+            "SELECT COUNT(*), MIN(created_at) FROM entries WHERE state = 'pending'"
+        ).fetchone()
+        failed = connection.execute(
+            "SELECT seq, path, op, error FROM entries WHERE state = 'failed' ORDER BY seq DESC LIMIT 10"
+        ).fetchall()
+        lease = connection.execute("SELECT holder, expires_at FROM lease WHERE name = 'shipper'").fetchone()
+        with self._lock:
+            return {
+                "backlog": backlog,
+                "lag_seconds": round(time.time() - oldest, 3) if oldest is not None else 0,
+                "appended": self.appended,
+                "shipped": self.shipped,
+                "failed": self.failed,
+                "commits": self.commits,
+                "average_ship_seconds": self.ship_seconds / self.commits if self.commits else 0,
+                "last_shipped_seq": self.last_shipped_seq,
+                "last_error": self.last_error,
+                "shipper": lease[0] if lease is not None and lease[1] > time.time() else None,
+                "recent_failures": [
+                    {"seq": seq, "path": path, "op": op, "error": error} for seq, path, op, error in failed
+                ],
+            }
+
+
+def _apply(table, entry):
+    # Apply one logged write to `table`; return why it failed, if it did
+    payload = entry.payload
+    if entry.op == "insert":
+        rows = payload["rows"]
+        if entry.attempts:
+            # Maybe committed by an attempt that did not get to mark it shipped
+            rows = [row for row in rows if table.find(row["id"]) is None]
+        if rows:
+            table.append([dict(row) for row in rows])
+    elif entry.op == "update":
+        if not table.update(payload["id"], dict(payload["data"])):
+            return "Object not found"
+    elif entry.op == "delete":
+        if not table.delete(payload["ids"]) and not entry.attempts:
+            return "Objects not found"
+    elif entry.op == "clear":
+        table.clear()
+    return None
+
+
+_MISSING = object()
+
+
+class MergedTable:
+    """
+    A `Table` with the pending writes of the log applied on top, for reads
+    (`find`, `scan` and `rows`, see `query` and `exports`).
+    """
+
+    def __init__(self, table, entries):
+        self.table = table
+        self.cleared = False
+        self.changed = {}  # id -> row (None: deleted) for the ids the entries touch
+        self.inserted = []  # ids inserted by the entries, in order
+        self._updated = False
+        for entry in entries:
+            self._apply(entry)
+
+    def _current(self, row_id):
+        row = self.changed.get(row_id, _MISSING)
+        if row is _MISSING:
+            row = None if self.cleared else self.table.find(row_id)
+        return row
+
+    def _apply(self, entry):
+        payload = entry.payload
+        if entry.op == "insert":
+            for row in payload["rows"]:
+                self.changed[row["id"]] = dict(row)
+                if row["id"] not in self.inserted:
+                    self.inserted.append(row["id"])
+        elif entry.op == "update":
+            row = self._current(payload["id"])
+            if row is not None:
+                self.changed[payload["id"]] = {**row, **payload["data"]}
+                self._updated = True
+        elif entry.op == "delete":
+            for row_id in payload["ids"]:
+                self.changed[row_id] = None
+        elif entry.op == "clear":
+            self.cleared = True
+            self.changed = {}
+            self.inserted = []
+
+    def find(self, row_id):
+        row = self.changed.get(row_id, _MISSING)
+        if row is not _MISSING:
+            return row
+        return None if self.cleared else self.table.find(row_id)
+
+    def _merge(self, rows):
+        inserted = set(self.inserted)
+        for row in rows:
+            row_id = row.get("id")
+            if row_id in inserted:
+                continue  # shipped meanwhile, comes below
+            row = self.changed.get(row_id, row)
+            if row is not None:
+                yield row
+        for row_id in self.inserted:
+            if self.changed[row_id] is not None:
+                yield self.changed[row_id]
+
+    def scan(self, conditions):
+        # Updated rows may meet conditions the indexes ruled out
+        return self._merge(() if self.cleared else self.table.scan([] if self._updated else conditions))
+
+    def rows(self, workers=1):
+        return self._merge(() if self.cleared else self.table.rows(workers=workers))
+
+    def has_rows(self):
+        return next(self.rows(), None) is not None
+
+
+def load_table(engine, path, create=False):
+    """`Table.load` for reads, with the writes still waiting in the log applied on top."""
+    log = get_write_log()
+    # Read the log first: a write shipped meanwhile is then both in the table
+    # and in the log, and applying it again changes nothing
+    entries = log.pending(path) if log is not None else []
+    table = Table.load(engine, path, create=create or bool(entries))
+    return MergedTable(table, entries) if entries else table
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_write_log(create=True):
+    """Return the process wide `WriteAheadLog` (shipping started), or None when `TABLE_WAL_PATH` is not set."""
+    global _log
+    if not settings.TABLE_WAL_PATH:
+        return None
+    if _log is None and create:
+        with _log_lock:
+            if _log is None:
+                _log = WriteAheadLog(
+                    settings.TABLE_WAL_PATH, settings.TABLE_WAL_BATCH_MAX, settings.TABLE_WAL_SHIP_INTERVAL,
+                    settings.TABLE_WAL_MAX_ATTEMPTS,
+                ).start()
+    return _log